@@ -0,0 +1 @@
+from neurosegmenter.augmentations.augmentation import Augmentation, augment_dataset
\ No newline at end of file
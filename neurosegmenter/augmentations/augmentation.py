@@ -0,0 +1,107 @@
+"""Batched in-graph augmentation.
+
+Augmentations transform whole batches, shaped (batch, *spatial, channels)
+with 2 or 3 spatial axes, drawing independent random parameters for every
+sample. They are plain tensorflow ops, so they can be XLA compiled and run
+inside the tf.data pipeline, in parallel with the training step.
+"""
+import itertools
+from typing import Any, Optional, Protocol, Sequence
+
+import tensorflow as tf
+
+
+class Augmentation(Protocol):
+    def __call__(self, x: tf.Tensor, y: Optional[tf.Tensor] = None) -> tuple[tf.Tensor, Optional[tf.Tensor]]:
+        ...
+
+
+def sample_mask(x: tf.Tensor, probability: float) -> tf.Tensor:
+    """Per-sample boolean mask, True for the samples to transform, shaped for broadcasting against x."""
+    batch_size = tf.shape(x)[0]
+    mask = tf.random.uniform([batch_size]) < probability
+    return tf.reshape(mask, [batch_size] + [1] * (x.shape.rank - 1))
+
+
+def sample_uniform(x: tf.Tensor, low: float, high: float) -> tf.Tensor:
+    """Per-sample uniform values, shaped for broadcasting against x."""
+    batch_size = tf.shape(x)[0]
+    return tf.random.uniform([batch_size] + [1] * (x.shape.rank - 1), low, high, dtype=x.dtype)
+
+
+def to_float(x: tf.Tensor) -> tf.Tensor:
+    """Floating point values of x, integer inputs are cast to float32."""
+    return x if x.dtype.is_floating else tf.cast(x, tf.float32)
+
+
+def restore_dtype(values: tf.Tensor, dtype: tf.DType) -> tf.Tensor:
+    """Cast values computed by to_float back to dtype, rounded and clipped to its range for integers."""
+    if dtype.is_integer:
+        return tf.saturate_cast(tf.round(values), dtype)
+    return tf.cast(values, dtype)
+
+
+def interpolate(volume: tf.Tensor, coordinates: tf.Tensor, linear: bool = True) -> tf.Tensor:
+    """Sample a batch of volumes at voxel coordinates.
+
+    volume: (batch, *spatial, channels); coordinates: (batch, *output_spatial, ndim).
+    Linear or nearest neighbour interpolation, coordinates outside of the
+    volume take the border values.
+    """
+    ndim = coordinates.shape[-1]
+    spatial = tf.shape(volume)[1:1 + ndim]
+    max_index = tf.cast(spatial - 1, coordinates.dtype)
+    batch_shape = tf.shape(coordinates)[:-1]
+    batch_index = tf.reshape(tf.range(batch_shape[0]), [-1] + [1] * ndim)
+    batch_index = tf.broadcast_to(batch_index, batch_shape)[..., None]
+
+    def gather(index: tf.Tensor) -> tf.Tensor:
+        index = tf.cast(tf.clip_by_value(index, 0, max_index), tf.int32)
+        return tf.gather_nd(volume, tf.concat([batch_index, index], axis=-1))
+
+    if not linear:
+        return gather(tf.round(coordinates))
+    floor = tf.floor(coordinates)
+    fraction = coordinates - floor
+    output = 0.
+    for corner in itertools.product((0., 1.), repeat=ndim):
+        corner = tf.constant(corner, dtype=coordinates.dtype)
+        weight = tf.reduce_prod(corner * fraction + (1 - corner) * (1 - fraction), axis=-1, keepdims=True)
+        output += tf.cast(weight, volume.dtype) * gather(floor + corner)
+    return output
+
+
+def apply_augmentations(augmentations: Sequence[Augmentation], jit_compile: bool = True) -> Any:
+    """Function applying augmentations in order to a batch, x, (x, y) or (x, y, sample weights).
+
+    Sample weights are transformed as labels, stacked on the label channels.
+    """
+
+    @tf.function(jit_compile=jit_compile)
+    def augment(x: tf.Tensor, y: Optional[tf.Tensor] = None) -> tuple[tf.Tensor, Optional[tf.Tensor]]:
+        for augmentation in augmentations:
+            x, y = augmentation(x, y)
+        return x, y
+
+    def augment_element(*element: tf.Tensor) -> Any:
+        if len(element) == 1:
+            return augment(element[0])[0]
+        if len(element) == 3:
+            x, y, w = element
+            x, yw = augment(x, tf.concat([tf.cast(y, w.dtype), w], axis=-1))
+            channels = y.shape[-1]
+            return x, tf.cast(yw[..., :channels], y.dtype), yw[..., channels:]
+        return augment(*element)
+    return augment_element
+
+
+def augment_dataset(dataset: tf.data.Dataset,
+                    augmentations: Sequence[Augmentation],
+                    num_parallel_calls: int = tf.data.AUTOTUNE,
+                    jit_compile: bool = True) -> tf.data.Dataset:
+    """Augment a batched dataset, with batches augmented in parallel with the consumer."""
+    if not augmentations:
+        return dataset
+    return dataset.map(apply_augmentations(augmentations, jit_compile),
+                       num_parallel_calls=num_parallel_calls,
+                       deterministic=False)
@@ -0,0 +1,221 @@
+from typing import Optional
+
+import numpy as np
+import tensorflow as tf
+
+from neurosegmenter.augmentations import Augmentation
+from neurosegmenter.augmentations.augmentation import interpolate, restore_dtype, sample_mask, sample_uniform, to_float
+from neurosegmenter.plugins import Plugin, PluginType, PluginParameter
+from neurosegmenter.plugins import register_plugin
+
+plugins = []
+
+class RandomFlip(Plugin, Augmentation):
+    """Flips every sample along each of the given spatial axes with independent probabilities."""
+    name: str = "Random Flip"
+    description: str = "Random flips along spatial axes"
+    type: PluginType = PluginType.AUGMENTATION
+    path: str = "augmentations.random_flip"
+    parameters: list[PluginParameter] = [
+        PluginParameter(name="probability",
+                        description="Probability of flipping a sample along each axis.",
+                        type=float,
+                        default=0.5,
+                        path="augmentations.random_flip.probability"),
+        PluginParameter(name="axes",
+                        description="Spatial axes (0-based, batch and channel axes excluded) to flip, if None all of them.",
+                        type=list,
+                        default=None,
+                        path="augmentations.random_flip.axes"),
+    ]
+
+    probability: float
+    axes: Optional[list]
+
+    def __call__(self, x: tf.Tensor, y: Optional[tf.Tensor] = None) -> tuple[tf.Tensor, Optional[tf.Tensor]]:
+        ndim = x.shape.rank - 2
+        for axis in (self.axes if self.axes is not None else range(ndim)):
+            mask = sample_mask(x, self.probability)
+            x = tf.where(mask, tf.reverse(x, [axis + 1]), x)
+            if y is not None:
+                y = tf.where(mask, tf.reverse(y, [axis + 1]), y)
+        return x, y
+
+plugins.append(RandomFlip)
+
+class RandomRotation90(Plugin, Augmentation):
+    """Rotates every sample by a random multiple of 90 degrees in a plane.
+
+    If the plane is not square only 180 degree rotations are drawn, so the
+    batch keeps its shape.
+    """
+    name: str = "Random Rotation 90"
+    description: str = "Random 90 degree rotations in a plane"
+    type: PluginType = PluginType.AUGMENTATION
+    path: str = "augmentations.random_rotation_90"
+    parameters: list[PluginParameter] = [
+        PluginParameter(name="probability",
+                        description="Probability of rotating a sample.",
+                        type=float,
+                        default=0.5,
+                        path="augmentations.random_rotation_90.probability"),
+        PluginParameter(name="axes",
+                        description="The two spatial axes (0-based) of the rotation plane.",
+                        type=list,
+                        default=[0, 1],
+                        path="augmentations.random_rotation_90.axes"),
+    ]
+
+    probability: float
+    axes: list
+
+    def _rotations(self, volume: tf.Tensor, square: bool) -> list[tf.Tensor]:
+        first, second = self.axes[0] + 1, self.axes[1] + 1
+        permutation = list(range(volume.shape.rank))
+        permutation[first], permutation[second] = second, first
+        rotated_180 = tf.reverse(volume, [first, second])
+        if not square:
+            return [volume, rotated_180]
+        rotated_90 = tf.reverse(tf.transpose(volume, permutation), [first])
+        return [volume, rotated_90, rotated_180, tf.reverse(tf.transpose(volume, permutation), [second])]
+
+    def __call__(self, x: tf.Tensor, y: Optional[tf.Tensor] = None) -> tuple[tf.Tensor, Optional[tf.Tensor]]:
+        square = x.shape[self.axes[0] + 1] == x.shape[self.axes[1] + 1]
+        n_rotations = 4 if square else 2
+        batch_size = tf.shape(x)[0]
+        # rotation 0 (identity) for the samples left untouched
+        k = tf.random.uniform([batch_size], 1, n_rotations, dtype=tf.int32)
+        k = tf.where(tf.random.uniform([batch_size]) < self.probability, k, 0)
+
+        def select(volume: tf.Tensor) -> tf.Tensor:
+            # every rotation is computed for the whole batch and the per-sample one is selected
+            rotations = tf.stack(self._rotations(volume, square), axis=1)
+            return tf.gather(rotations, k, axis=1, batch_dims=1)
+        return select(x), (select(y) if y is not None else None)
+
+plugins.append(RandomRotation90)
+
+class IntensityJitter(Plugin, Augmentation):
+    """Random per-sample contrast scaling and brightness shift of the inputs."""
+    name: str = "Intensity Jitter"
+    description: str = "Random contrast and brightness changes"
+    type: PluginType = PluginType.AUGMENTATION
+    path: str = "augmentations.intensity_jitter"
+    parameters: list[PluginParameter] = [
+        PluginParameter(name="probability",
+                        description="Probability of jittering a sample.",
+                        type=float,
+                        default=0.5,
+                        path="augmentations.intensity_jitter.probability"),
+        PluginParameter(name="contrast",
+                        description="Maximum relative contrast change, the scale is drawn in [1 - contrast, 1 + contrast].",
+                        type=float,
+                        default=0.2,
+                        path="augmentations.intensity_jitter.contrast"),
+        PluginParameter(name="brightness",
+                        description="Maximum absolute brightness shift.",
+                        type=float,
+                        default=0.1,
+                        path="augmentations.intensity_jitter.brightness"),
+    ]
+
+    probability: float
+    contrast: float
+    brightness: float
+
+    def __call__(self, x: tf.Tensor, y: Optional[tf.Tensor] = None) -> tuple[tf.Tensor, Optional[tf.Tensor]]:
+        values = to_float(x)
+        mask = sample_mask(values, self.probability)
+        scale = sample_uniform(values, 1 - self.contrast, 1 + self.contrast)
+        shift = sample_uniform(values, -self.brightness, self.brightness)
+        return restore_dtype(tf.where(mask, values * scale + shift, values), x.dtype), y
+
+plugins.append(IntensityJitter)
+
+class GaussianNoise(Plugin, Augmentation):
+    """Additive gaussian noise on the inputs, with a random standard deviation per sample."""
+    name: str = "Gaussian Noise"
+    description: str = "Additive gaussian noise"
+    type: PluginType = PluginType.AUGMENTATION
+    path: str = "augmentations.gaussian_noise"
+    parameters: list[PluginParameter] = [
+        PluginParameter(name="probability",
+                        description="Probability of adding noise to a sample.",
+                        type=float,
+                        default=0.5,
+                        path="augmentations.gaussian_noise.probability"),
+        PluginParameter(name="std",
+                        description="Maximum standard deviation of the noise, drawn in [0, std] per sample.",
+                        type=float,
+                        default=0.05,
+                        path="augmentations.gaussian_noise.std"),
+    ]
+
+    probability: float
+    std: float
+
+    def __call__(self, x: tf.Tensor, y: Optional[tf.Tensor] = None) -> tuple[tf.Tensor, Optional[tf.Tensor]]:
+        values = to_float(x)
+        mask = sample_mask(values, self.probability)
+        std = sample_uniform(values, 0., self.std)
+        return restore_dtype(tf.where(mask, values + std * tf.random.normal(tf.shape(values), dtype=values.dtype), values), x.dtype), y
+
+plugins.append(GaussianNoise)
+
+class ElasticDeformation(Plugin, Augmentation):
+    """Smooth random elastic deformation of the inputs and labels.
+
+    Random displacements are drawn on a coarse grid of control points, spaced
+    grid_spacing voxels apart, and linearly upsampled to a dense displacement
+    field. Inputs are resampled linearly, labels with nearest neighbours.
+    The batch must have a static spatial shape.
+    """
+    name: str = "Elastic Deformation"
+    description: str = "Random smooth elastic deformations"
+    type: PluginType = PluginType.AUGMENTATION
+    path: str = "augmentations.elastic_deformation"
+    parameters: list[PluginParameter] = [
+        PluginParameter(name="probability",
+                        description="Probability of deforming a sample.",
+                        type=float,
+                        default=0.3,
+                        path="augmentations.elastic_deformation.probability"),
+        PluginParameter(name="alpha",
+                        description="Standard deviation of the control point displacements, in voxels.",
+                        type=float,
+                        default=4.0,
+                        path="augmentations.elastic_deformation.alpha"),
+        PluginParameter(name="grid_spacing",
+                        description="Distance between the control points, in voxels.",
+                        type=int,
+                        default=16,
+                        path="augmentations.elastic_deformation.grid_spacing"),
+    ]
+
+    probability: float
+    alpha: float
+    grid_spacing: int
+
+    def __call__(self, x: tf.Tensor, y: Optional[tf.Tensor] = None) -> tuple[tf.Tensor, Optional[tf.Tensor]]:
+        spatial_shape = x.shape[1:-1]
+        ndim = len(spatial_shape)
+        batch_size = tf.shape(x)[0]
+        grid_shape = [int(np.ceil((size - 1) / self.grid_spacing)) + 1 for size in spatial_shape]
+        grid = tf.stack(tf.meshgrid(*[tf.range(size, dtype=tf.float32) for size in spatial_shape], indexing="ij"), axis=-1)
+        grid = tf.broadcast_to(grid, tf.concat([[batch_size], tf.shape(grid)], axis=0))
+
+        control_points = self.alpha * tf.random.normal(tf.concat([[batch_size], grid_shape, [ndim]], axis=0))
+        control_points *= tf.cast(tf.reshape(tf.random.uniform([batch_size]) < self.probability, [-1] + [1] * (ndim + 1)), tf.float32)
+        # position of every voxel on the control point grid
+        scale = tf.constant([(g - 1) / max(size - 1, 1) for g, size in zip(grid_shape, spatial_shape)], tf.float32)
+        displacement = interpolate(control_points, grid * scale, linear=True)
+        coordinates = grid + displacement
+        x_deformed = restore_dtype(interpolate(tf.cast(x, tf.float32), coordinates, linear=True), x.dtype)
+        y_deformed = interpolate(y, coordinates, linear=False) if y is not None else None
+        return x_deformed, y_deformed
+
+plugins.append(ElasticDeformation)
+
+
+for plugin in plugins:
+    register_plugin(plugin)
@@ -0,0 +1,4 @@
+from neurosegmenter.benchmarks.memory import MemorySampler, current_rss, peak_rss
+from neurosegmenter.benchmarks.benchmark import PluginBenchmark, BenchmarkResult, Regression
+from neurosegmenter.benchmarks.benchmark import save_results, load_results, compare_to_baseline
+from neurosegmenter.benchmarks.tuner import ThroughputTuner, TuningResult, TuningTrial, host_fingerprint
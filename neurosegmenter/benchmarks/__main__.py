@@ -0,0 +1,55 @@
+"""Benchmark the registered plugins.
+
+usage: python -m neurosegmenter.benchmarks --shape 64 64 64 --output results.json --baseline baseline.json
+       python -m neurosegmenter.benchmarks --types LOSS --plugins 'Compound Segmentation Loss' --compound-loss
+"""
+import argparse
+import sys
+
+from neurosegmenter.benchmarks import PluginBenchmark, save_results, load_results, compare_to_baseline
+from neurosegmenter.benchmarks.benchmark import BENCHMARKED_TYPES
+from neurosegmenter.plugins import PluginType, discover_plugins, load_plugins
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the registered neurosegmenter plugins")
+    parser.add_argument("--shape", type=int, nargs="+", default=[64, 64, 64], help="spatial shape of the synthetic batches")
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--types", nargs="+", default=[t.name for t in BENCHMARKED_TYPES], choices=[t.name for t in BENCHMARKED_TYPES])
+    parser.add_argument("--plugins", nargs="+", default=None, help="names of the plugins to benchmark, all by default")
+    parser.add_argument("--compound-loss", action="store_true",
+                        help="also time the Compound Segmentation Loss against the sum of its separate terms")
+    parser.add_argument("--load", nargs="+", default=[], help="extra plugin modules in neurosegmenter.plugins")
+    parser.add_argument("--output", default=None, help="json file for the results")
+    parser.add_argument("--baseline", default=None, help="json results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative latency increase flagged as regression")
+    args = parser.parse_args()
+
+    discover_plugins()
+    load_plugins(args.load)
+    benchmark = PluginBenchmark(shape=args.shape, batch_size=args.batch_size, channels=args.channels,
+                                warmup=args.warmup, repeats=args.repeats)
+    results = benchmark.run(types=[PluginType[t] for t in args.types], names=args.plugins)
+    if args.compound_loss:
+        results += benchmark.run_compound_loss()
+    for result in results:
+        if result.error:
+            print(f"{result.plugin:45s} {result.type:10s} ERROR {result.error}")
+        else:
+            print(f"{result.plugin:45s} {result.type:10s} p50 {result.latency_ms['p50']:9.2f} ms  "
+                  f"p99 {result.latency_ms['p99']:9.2f} ms  {result.throughput:10.1f} samples/s  "
+                  f"peak +{result.peak_memory_mb:8.1f} MB")
+    if args.output:
+        save_results(results, args.output, benchmark.metadata())
+    if args.baseline:
+        regressions = compare_to_baseline(results, load_results(args.baseline), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression.plugin}: {regression.baseline_ms:.2f} ms -> {regression.current_ms:.2f} ms "
+                  f"(+{regression.slowdown:.0%})")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
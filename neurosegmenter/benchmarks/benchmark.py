@@ -0,0 +1,222 @@
+"""Benchmarks of the registered loss, metric, optimizer and model plugins.
+
+Every plugin is timed on synthetic tensors: losses and metrics through
+__call__, optimizers through one get_optimizer().apply_gradients step and
+models through a forward/backward pass of get_model().
+Results are saved as json and can be compared against a stored baseline.
+"""
+import json
+import platform
+import time
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import Any, Callable, Optional, Sequence, Union
+
+import numpy as np
+import tensorflow as tf
+
+from neurosegmenter.benchmarks.memory import MemorySampler
+from neurosegmenter.plugins import LazyPlugin, PluginType, registered_plugins
+
+BENCHMARKED_TYPES = (PluginType.LOSS, PluginType.METRIC, PluginType.OPTIMIZER, PluginType.MODEL)
+
+
+@dataclass
+class BenchmarkResult:
+    plugin: str
+    type: str
+    latency_ms: dict[str, float] = field(default_factory=dict)
+    throughput: float = 0.0 # samples per second
+    peak_memory_mb: float = 0.0
+    error: Optional[str] = None
+
+
+@dataclass
+class Regression:
+    plugin: str
+    baseline_ms: float
+    current_ms: float
+
+    @property
+    def slowdown(self) -> float:
+        return self.current_ms / self.baseline_ms - 1
+
+
+class PluginBenchmark:
+    """Times the registered plugins on synthetic tensors.
+
+    shape: spatial shape of the synthetic batches.
+    batch_size / channels: leading and trailing dimensions of the batches.
+    parameters: number of weights updated in the optimizer benchmark.
+    warmup / repeats: untimed and timed iterations per plugin.
+    """
+
+    def __init__(self,
+                 shape: Sequence[int] = (64, 64, 64),
+                 batch_size: int = 2,
+                 channels: int = 1,
+                 parameters: int = 1_000_000,
+                 warmup: int = 2,
+                 repeats: int = 10,
+                 seed: int = 0) -> None:
+        self.shape = tuple(shape)
+        self.batch_size = batch_size
+        self.channels = channels
+        self.parameters = parameters
+        self.warmup = warmup
+        self.repeats = repeats
+        rng = np.random.default_rng(seed)
+        batch_shape = (batch_size,) + self.shape + (channels,)
+        self.y_true = tf.constant((rng.random(batch_shape) > 0.5).astype(np.float32))
+        self.y_pred = tf.constant(rng.random(batch_shape, dtype=np.float32))
+
+    def _loss_step(self, plugin: Any) -> Callable[[], Any]:
+        return lambda: plugin(self.y_true, self.y_pred)
+
+    def _optimizer_step(self, plugin: Any) -> Callable[[], Any]:
+        optimizer = plugin.get_optimizer()
+        variables = [tf.Variable(tf.random.normal([self.parameters]))]
+        gradients = [tf.random.normal([self.parameters])]
+        return lambda: optimizer.apply_gradients(zip(gradients, variables))
+
+    def _model_step(self, plugin: Any) -> Callable[[], Any]:
+        model = plugin.get_model()
+        spatial = list(self.shape) + [self.channels]
+        try:
+            # fill the unknown dimensions of the model input with the benchmark shape
+            shape = [self.batch_size] + [dim if dim is not None else spatial[i] for i, dim in enumerate(model.input_shape[1:])]
+        except AttributeError:
+            # subclassed models have no input shape until they are called
+            shape = [self.batch_size] + spatial
+        inputs = tf.random.uniform(shape)
+
+        @tf.function
+        def step() -> tf.Tensor:
+            with tf.GradientTape() as tape:
+                outputs = model(inputs, training=True)
+                loss = tf.reduce_mean(outputs)
+            return tape.gradient(loss, model.trainable_variables)
+        return step
+
+    def step_function(self, plugin: Any) -> Callable[[], Any]:
+        """The timed operation of a plugin instance."""
+        if plugin.type in (PluginType.LOSS, PluginType.METRIC):
+            return self._loss_step(plugin)
+        if plugin.type == PluginType.OPTIMIZER:
+            return self._optimizer_step(plugin)
+        if plugin.type == PluginType.MODEL:
+            return self._model_step(plugin)
+        raise ValueError(f"Plugin type {plugin.type} is not benchmarked")
+
+    def run_plugin(self, plugin: Any) -> BenchmarkResult:
+        """Benchmark one plugin (registry entry, class or instance)."""
+        if isinstance(plugin, (type, LazyPlugin)):
+            plugin = plugin()
+        return self._time(BenchmarkResult(plugin=plugin.name, type=plugin.type.name), lambda: self.step_function(plugin))
+
+    def _time(self, result: BenchmarkResult, make_step: Callable[[], Callable[[], Any]]) -> BenchmarkResult:
+        """Fill the latencies, throughput and memory of a result with the step built by make_step."""
+        try:
+            with MemorySampler() as memory:
+                step = make_step()
+                for _ in range(self.warmup):
+                    _block(step())
+                latencies = []
+                for _ in range(self.repeats):
+                    start = time.perf_counter()
+                    _block(step())
+                    latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"
+            return result
+        latencies_ms = np.array(latencies) * 1000
+        result.latency_ms = {
+            "mean": float(latencies_ms.mean()),
+            "p50": float(np.percentile(latencies_ms, 50)),
+            "p90": float(np.percentile(latencies_ms, 90)),
+            "p99": float(np.percentile(latencies_ms, 99)),
+        }
+        result.throughput = self.batch_size / (result.latency_ms["mean"] / 1000)
+        result.peak_memory_mb = memory.peak_increase / 2 ** 20
+        return result
+
+    def run_compound_loss(self, plugin: Optional[Any] = None) -> list[BenchmarkResult]:
+        """Compound Segmentation Loss against the sum of its terms computed as separate losses.
+
+        Both compute the same value (checked), the separate terms are the
+        binary cross entropy and the soft Tversky loss reduced one after the
+        other in a graph, as when summing two loss plugins.
+        """
+        plugin = plugin if plugin is not None else registered_plugins["Compound Segmentation Loss"]()
+        if isinstance(plugin, (type, LazyPlugin)):
+            plugin = plugin()
+        y_true, y_pred = self.y_true, self.y_pred
+        axes = list(range(y_pred.shape.rank - 1))
+
+        @tf.function
+        def separate() -> tf.Tensor:
+            probabilities = tf.sigmoid(y_pred) if plugin.from_logits else y_pred
+            bce = tf.reduce_mean(tf.keras.backend.binary_crossentropy(y_true, y_pred, from_logits=plugin.from_logits), axis=axes)
+            true_positives = tf.reduce_sum(y_true * probabilities, axis=axes)
+            false_positives = tf.reduce_sum(probabilities, axis=axes) - true_positives
+            false_negatives = tf.reduce_sum(y_true, axis=axes) - true_positives
+            tversky = (true_positives + plugin.smooth) / (true_positives + plugin.alpha * false_positives
+                                                         + plugin.beta * false_negatives + plugin.smooth)
+            per_class = plugin.bce_weight * bce + plugin.dice_weight * (1. - tversky)
+            class_weights = tf.ones_like(per_class) if plugin.class_weights is None else tf.constant(plugin.class_weights, tf.float32)
+            return tf.reduce_sum(per_class * class_weights) / tf.reduce_sum(class_weights)
+
+        np.testing.assert_allclose(float(plugin(y_true, y_pred)), float(separate()), rtol=1e-3)
+        return [self._time(BenchmarkResult(plugin=plugin.name, type=plugin.type.name), lambda: self._loss_step(plugin)),
+                self._time(BenchmarkResult(plugin=f"{plugin.name} (separate terms)", type=plugin.type.name), lambda: separate)]
+
+    def run(self, types: Sequence[PluginType] = BENCHMARKED_TYPES, names: Optional[Sequence[str]] = None) -> list[BenchmarkResult]:
+        """Benchmark the registered plugins of the given types (or names)."""
+        return [self.run_plugin(plugin) for name, plugin in list(registered_plugins.items())
+                if plugin.type in types and (names is None or name in names)]
+
+    def metadata(self) -> dict[str, Any]:
+        return {
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "tensorflow": tf.__version__,
+            "shape": list(self.shape),
+            "batch_size": self.batch_size,
+            "channels": self.channels,
+            "timestamp": time.time(),
+        }
+
+
+def _block(output: Any) -> None:
+    """Wait for asynchronous tensorflow results before stopping the clock."""
+    for tensor in tf.nest.flatten(output):
+        if hasattr(tensor, "numpy"):
+            tensor.numpy()
+
+
+def save_results(results: list[BenchmarkResult], path: Union[str, Path], metadata: Optional[dict] = None) -> None:
+    with open(path, "w") as f:
+        json.dump({"metadata": metadata or {}, "results": [asdict(result) for result in results]}, f, indent=2)
+
+
+def load_results(path: Union[str, Path]) -> list[BenchmarkResult]:
+    with open(path) as f:
+        return [BenchmarkResult(**result) for result in json.load(f)["results"]]
+
+
+def compare_to_baseline(results: list[BenchmarkResult],
+                        baseline: list[BenchmarkResult],
+                        threshold: float = 0.1,
+                        statistic: str = "p50") -> list[Regression]:
+    """Plugins whose latency grew by more than threshold (relative) with respect to the baseline."""
+    baseline_latency = {result.plugin: result.latency_ms.get(statistic) for result in baseline if not result.error}
+    regressions = []
+    for result in results:
+        previous = baseline_latency.get(result.plugin)
+        if result.error or not previous:
+            continue
+        current = result.latency_ms[statistic]
+        if current > previous * (1 + threshold):
+            regressions.append(Regression(result.plugin, previous, current))
+    return regressions
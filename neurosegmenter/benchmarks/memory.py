@@ -0,0 +1,55 @@
+"""Process memory measurements."""
+import os
+import resource
+import sys
+import threading
+from typing import Optional
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def current_rss() -> int:
+    """Resident set size of the process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        # no procfs, fall back to the peak
+        return peak_rss()
+
+def peak_rss() -> int:
+    """Peak resident set size of the process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class MemorySampler:
+    """Context manager sampling the RSS in a background thread to find the peak of a code block."""
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self) -> "MemorySampler":
+        self.baseline = self.peak = current_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+    @property
+    def peak_increase(self) -> int:
+        """Peak RSS above the RSS at the start of the block, in bytes."""
+        return self.peak - self.baseline
@@ -0,0 +1,235 @@
+"""Batch size and patch shape tuning of model plugins.
+
+Short timed training steps (forward, loss, backward and optimizer update)
+are run at increasing batch sizes for every candidate patch shape, within a
+memory budget, and the setting with the highest throughput (voxels per
+second) is returned. The memory of the next batch size is extrapolated from
+the measured one, so settings expected to exceed the budget are never run.
+Results are cached per (plugin parameters, host fingerprint).
+"""
+import json
+import os
+import platform
+import time
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import Any, Optional, Sequence
+
+import numpy as np
+import tensorflow as tf
+
+from neurosegmenter.benchmarks.benchmark import _block
+from neurosegmenter.benchmarks.memory import MemorySampler
+from neurosegmenter.config import config_hash, get_cache_dir, plugin_hash
+from neurosegmenter.models.precision import loss_scale_optimizer
+
+TUNING_VERSION = 1
+
+
+def host_fingerprint() -> dict[str, Any]:
+    """Hardware and software the tuned settings depend on."""
+    cpu_model = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpu_model = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), cpu_model)
+    except OSError:
+        pass
+    usable_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    return {
+        "machine": platform.machine(),
+        "cpu": cpu_model,
+        "cpus": usable_cpus,
+        "memory_mb": available_memory_mb(total=True),
+        "gpus": [tf.config.experimental.get_device_details(gpu).get("device_name", gpu.name)
+                 for gpu in tf.config.list_physical_devices("GPU")],
+        "tensorflow": tf.__version__,
+        "intra_op_threads": tf.config.threading.get_intra_op_parallelism_threads(),
+    }
+
+
+def available_memory_mb(total: bool = False) -> float:
+    """Available (or total) physical memory of the host, in MB."""
+    pages = os.sysconf("SC_PHYS_PAGES" if total else "SC_AVPHYS_PAGES")
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+@dataclass
+class TuningTrial:
+    batch_size: int
+    patch_shape: list[int]
+    step_ms: float = 0.0
+    throughput: float = 0.0 # voxels per second
+    peak_memory_mb: float = 0.0
+    error: Optional[str] = None
+
+
+@dataclass
+class TuningResult:
+    batch_size: int
+    patch_shape: list[int]
+    throughput: float
+    peak_memory_mb: float
+    trials: list[TuningTrial] = field(default_factory=list)
+    cached: bool = False
+
+
+class ThroughputTuner:
+    """Finds the batch size and patch shape with the highest training throughput.
+
+    patch_shapes: candidate spatial patch shapes (3D by default), shapes
+        that do not match the fixed input dimensions of the model are
+        skipped, tune() raises a ValueError if none matches (e.g. 2D models
+        need 2D patch shapes).
+    max_batch_size: batch sizes are doubled from 1 up to this value.
+    memory_budget_mb: peak memory increase allowed during a step (device
+        memory on GPU, process RSS above the start of the trial on CPU), by
+        default 80% of the available memory.
+    warmup / repeats: untimed and timed steps per setting.
+    """
+
+    def __init__(self,
+                 patch_shapes: Sequence[Sequence[int]] = ((32, 32, 32), (64, 64, 64), (96, 96, 96), (128, 128, 128)),
+                 max_batch_size: int = 64,
+                 memory_budget_mb: Optional[float] = None,
+                 channels: int = 1,
+                 warmup: int = 2,
+                 repeats: int = 5,
+                 use_cache: bool = True,
+                 seed: int = 0) -> None:
+        self.patch_shapes = [list(shape) for shape in patch_shapes]
+        self.max_batch_size = max_batch_size
+        self.memory_budget_mb = memory_budget_mb if memory_budget_mb is not None else 0.8 * available_memory_mb()
+        self.channels = channels
+        self.warmup = warmup
+        self.repeats = repeats
+        self.use_cache = use_cache
+        self.seed = seed
+
+    def cache_key(self, model: Any, optimizer: Any, loss: Any) -> str:
+        return config_hash({"version": TUNING_VERSION,
+                            "plugins": [plugin_hash(model), plugin_hash(optimizer), plugin_hash(loss)],
+                            "host": host_fingerprint(),
+                            "search": {"patch_shapes": self.patch_shapes, "max_batch_size": self.max_batch_size,
+                                       "memory_budget_mb": round(self.memory_budget_mb), "channels": self.channels}})
+
+    def _cache_path(self, key: str) -> Path:
+        return get_cache_dir("tuning") / f"{key}.json"
+
+    def _input_shape(self, keras_model: Any, batch_size: int, patch_shape: list[int]) -> Optional[list[int]]:
+        """Input batch shape, None if the patch shape does not fit the model input."""
+        spatial = patch_shape + [self.channels]
+        try:
+            model_shape = list(keras_model.input_shape[1:])
+        except AttributeError:
+            # subclassed models have no input shape until they are called
+            return [batch_size] + spatial
+        if len(model_shape) != len(spatial) or any(dim is not None and dim != size for dim, size in zip(model_shape, spatial)):
+            return None
+        return [batch_size] + spatial
+
+    def _peak_memory(self) -> float:
+        if tf.config.list_physical_devices("GPU"):
+            return tf.config.experimental.get_memory_info("GPU:0")["peak"] / 2 ** 20
+        return 0.0
+
+    def run_trial(self, keras_model: Any, optimizer: Any, loss: Any, batch_size: int, patch_shape: list[int]) -> TuningTrial:
+        """Time training steps at one setting."""
+        trial = TuningTrial(batch_size=batch_size, patch_shape=list(patch_shape))
+        shape = self._input_shape(keras_model, batch_size, patch_shape)
+        rng = np.random.default_rng(self.seed)
+        use_gpu = bool(tf.config.list_physical_devices("GPU"))
+        try:
+            if use_gpu:
+                tf.config.experimental.reset_memory_stats("GPU:0")
+            with MemorySampler() as memory:
+                inputs = tf.constant(rng.random(shape, dtype=np.float32))
+                outputs = keras_model(inputs, training=False)
+                targets = tf.constant((rng.random(outputs.shape) > 0.5).astype(np.float32))
+                optimizer = loss_scale_optimizer(optimizer, keras_model)
+                loss_scaling = isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+
+                @tf.function
+                def step() -> tf.Tensor:
+                    with tf.GradientTape() as tape:
+                        value = tf.reduce_mean(loss(targets, keras_model(inputs, training=True)))
+                        scaled = optimizer.get_scaled_loss(value) if loss_scaling else value
+                    gradients = tape.gradient(scaled, keras_model.trainable_variables)
+                    if loss_scaling:
+                        gradients = optimizer.get_unscaled_gradients(gradients)
+                    optimizer.apply_gradients(zip(gradients, keras_model.trainable_variables))
+                    return value
+
+                for _ in range(self.warmup):
+                    _block(step())
+                latencies = []
+                for _ in range(self.repeats):
+                    start = time.perf_counter()
+                    _block(step())
+                    latencies.append(time.perf_counter() - start)
+        except (tf.errors.ResourceExhaustedError, MemoryError) as e:
+            trial.error = f"{type(e).__name__}: out of memory"
+            return trial
+        trial.step_ms = float(np.median(latencies) * 1000)
+        trial.throughput = batch_size * int(np.prod(patch_shape)) / (trial.step_ms / 1000)
+        # process memory above the start of the trial, not of the tuning, so earlier trials do not add up
+        trial.peak_memory_mb = self._peak_memory() if use_gpu else memory.peak_increase / 2 ** 20
+        return trial
+
+    def tune(self, model: Any, optimizer: Any, loss: Any) -> TuningResult:
+        """Tune a model plugin trained with an optimizer and a loss plugin (instances)."""
+        key = self.cache_key(model, optimizer, loss)
+        if self.use_cache and self._cache_path(key).exists():
+            with open(self._cache_path(key)) as f:
+                data = json.load(f)
+            return TuningResult(**{**data, "trials": [TuningTrial(**trial) for trial in data["trials"]], "cached": True})
+
+        keras_model = model.get_model()
+        patch_shapes = [shape for shape in self.patch_shapes if self._input_shape(keras_model, 1, shape) is not None]
+        if not patch_shapes:
+            raise ValueError(f"None of the patch shapes {self.patch_shapes} with {self.channels} channel(s) matches "
+                             f"the model input shape {keras_model.input_shape}")
+        trials: list[TuningTrial] = []
+        # largest memory per voxel of a batch measured so far, memory grows (at most) linearly with the batch voxels
+        memory_per_voxel = 0.0
+        for patch_shape in patch_shapes:
+            best_throughput = 0.0
+            batch_size = 1
+            while batch_size <= self.max_batch_size:
+                voxels = batch_size * int(np.prod(patch_shape))
+                if memory_per_voxel * voxels > self.memory_budget_mb:
+                    break
+                # a fresh optimizer per setting, its slots are built for the model weights
+                trial = self.run_trial(keras_model, optimizer.get_optimizer(), loss, batch_size, patch_shape)
+                trials.append(trial)
+                if trial.error or trial.peak_memory_mb > self.memory_budget_mb or trial.throughput < best_throughput:
+                    # larger batches would not fit or are already slower
+                    break
+                best_throughput = trial.throughput
+                memory_per_voxel = max(memory_per_voxel, trial.peak_memory_mb / voxels)
+                batch_size *= 2
+        valid = [trial for trial in trials if not trial.error and trial.peak_memory_mb <= self.memory_budget_mb]
+        if not valid:
+            raise ValueError(f"No batch size and patch shape of {patch_shapes} fits the memory budget of {self.memory_budget_mb:.0f} MB")
+        best = max(valid, key=lambda trial: trial.throughput)
+        result = TuningResult(batch_size=best.batch_size, patch_shape=best.patch_shape, throughput=best.throughput,
+                              peak_memory_mb=best.peak_memory_mb, trials=trials)
+        if self.use_cache:
+            with open(self._cache_path(key), "w") as f:
+                json.dump(asdict(result), f, indent=2)
+        return result
+
+    @staticmethod
+    def apply(result: TuningResult, *plugins: Any) -> dict[str, Any]:
+        """Write the tuned setting to the batch_size / patch_shape parameters of plugins (e.g. datagens).
+
+        Returns the configuration (parameter path to value) of the written
+        parameters, to be saved with the other configuration values.
+        """
+        values = {"batch_size": result.batch_size, "patch_shape": list(result.patch_shape)}
+        config = {}
+        for plugin in plugins:
+            for parameter in plugin.parameters:
+                if parameter.name in values:
+                    setattr(plugin, parameter.name, values[parameter.name])
+                    config[parameter.path] = values[parameter.name]
+        return config
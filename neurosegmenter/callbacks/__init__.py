@@ -0,0 +1 @@
+from neurosegmenter.callbacks.callback import Callback
\ No newline at end of file
@@ -0,0 +1,7 @@
+from typing import Protocol
+from tensorflow import keras
+from keras import callbacks as keras_callbacks
+
+class Callback(Protocol):
+    def get_callback(self, *args, **kwargs) -> keras_callbacks.Callback:
+        ...
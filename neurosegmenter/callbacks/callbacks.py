@@ -0,0 +1,240 @@
+import csv
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+import tensorflow as tf
+from tensorflow import keras
+from keras import callbacks as keras_callbacks
+
+from neurosegmenter.benchmarks.memory import current_rss, peak_rss
+from neurosegmenter.callbacks import Callback
+from neurosegmenter.plugins import Plugin, PluginType, PluginParameter
+from neurosegmenter.plugins import register_plugin
+
+plugins = []
+
+class ProfilingCallback(Plugin, Callback):
+    """Records step/epoch timings and memory of a training run.
+
+    For every step: wall time, step time, host gap between steps, samples/sec
+    and RSS; for every epoch the totals plus the peak RSS. Records are buffered
+    and written as jsonl or csv every flush_every steps, an optional Chrome
+    trace (chrome://tracing, Perfetto) is written at the end of training.
+
+    The time the step waits on the input pipeline (input_wait) is measured
+    in the graph: the train step of the model is wrapped to record the time
+    its batch is available, which is compared with the start of the step,
+    so the dataset is left untouched (prefetching included). The wrapper is
+    installed by on_train_begin and removed at the end of fit, also when a
+    step raises; evaluate and predict never see it. The wait is not
+    measured (None) for jit compiled models or with steps_per_execution > 1.
+    """
+    name: str = "Profiling Callback"
+    description: str = "Step time, input stalls and memory profiling"
+    type: PluginType = PluginType.CALLBACK
+    path: str = "callbacks.profiling_callback"
+    parameters: list[PluginParameter] = [
+        PluginParameter(name="log_dir",
+                        description="Directory of the profiling logs.",
+                        type=str,
+                        default="profiling",
+                        path="callbacks.profiling_callback.log_dir"),
+        PluginParameter(name="format",
+                        description="Log format, 'jsonl' or 'csv'.",
+                        type=str,
+                        default="jsonl",
+                        path="callbacks.profiling_callback.format"),
+        PluginParameter(name="log_steps",
+                        description="Whether to log every step, otherwise only epochs are logged.",
+                        type=bool,
+                        default=True,
+                        path="callbacks.profiling_callback.log_steps"),
+        PluginParameter(name="flush_every",
+                        description="Number of buffered records written at once.",
+                        type=int,
+                        default=100,
+                        path="callbacks.profiling_callback.flush_every"),
+        PluginParameter(name="chrome_trace",
+                        description="Whether to export a Chrome trace of the steps.",
+                        type=bool,
+                        default=False,
+                        path="callbacks.profiling_callback.chrome_trace"),
+        PluginParameter(name="batch_size",
+                        description="Samples per step, used for samples/sec. If None, steps/sec are reported.",
+                        type=int,
+                        default=None,
+                        path="callbacks.profiling_callback.batch_size"),
+    ]
+
+    log_dir: str
+    format: str
+    log_steps: bool
+    flush_every: int
+    chrome_trace: bool
+    batch_size: Optional[int]
+
+    def get_callback(self) -> keras_callbacks.Callback:
+        return ProfilingCallback.ProfilingKerasCallback(self)
+
+    class ProfilingKerasCallback(keras_callbacks.Callback):
+        """keras callback, with the plugin instance as parent"""
+        def __init__(self, parent):
+            super().__init__()
+            self.parent = parent
+            self.records: list[dict[str, Any]] = []
+            self.trace_events: list[dict[str, Any]] = []
+            self.fieldnames: Optional[list[str]] = None
+            # train step of the model, while it is wrapped to time the input
+            self.train_step: Optional[Any] = None
+
+        def _log_path(self) -> Path:
+            return Path(self.parent.log_dir) / f"profile.{self.parent.format}"
+
+        def _flush(self) -> None:
+            if not self.records:
+                return
+            with open(self._log_path(), "a", newline="") as f:
+                if self.parent.format == "csv":
+                    if self.fieldnames is None:
+                        self.fieldnames = ["type", "epoch", "step", "wall", "step_time", "input_wait", "compute_time",
+                                           "host_gap", "steps", "throughput", "rss_mb", "peak_rss_mb"]
+                        csv.DictWriter(f, self.fieldnames).writeheader()
+                    csv.DictWriter(f, self.fieldnames, extrasaction="ignore").writerows(self.records)
+                else:
+                    f.writelines(json.dumps(record) + "\n" for record in self.records)
+            self.records.clear()
+
+        def _trace(self, name: str, start: float, duration: float) -> None:
+            if self.parent.chrome_trace:
+                self.trace_events.append({"name": name, "ph": "X", "pid": os.getpid(), "tid": 0,
+                                          "ts": (start - self.train_start) * 1e6, "dur": duration * 1e6})
+
+        def _wrap_train_step(self) -> None:
+            model = self.model
+            if self.train_step is not None or getattr(model, "_jit_compile", False):
+                return
+            if not hasattr(self, "data_ready"):
+                with model.distribute_strategy.scope():
+                    # time (seconds since the epoch) at which the last step got its batch
+                    self.data_ready = tf.Variable(0.0, dtype=tf.float64, trainable=False,
+                                                  synchronization=tf.VariableSynchronization.ON_WRITE,
+                                                  aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
+            train_step = self.train_step = model.train_step
+            data_ready = self.data_ready
+
+            def timed_train_step(data):
+                with tf.control_dependencies(tf.nest.flatten(data)):
+                    data_ready.assign(tf.timestamp())
+                return train_step(data)
+            model.train_step = timed_train_step
+            # fit built its train function with the original step before on_train_begin
+            train_function = model.make_train_function(force=True)
+
+            def guarded_train_function(iterator):
+                # on_train_end is not called when fit fails, restore the model here
+                try:
+                    return train_function(iterator)
+                except BaseException:
+                    self._restore_train_step()
+                    raise
+            model.train_function = guarded_train_function
+
+        def _restore_train_step(self) -> None:
+            if self.train_step is not None:
+                self.model.train_step = self.train_step
+                self.model.train_function = None
+                self.train_step = None
+
+        def _input_wait(self) -> Optional[float]:
+            """Time between the start of the step and its batch being available."""
+            steps_per_execution = getattr(self.model, "_steps_per_execution", None)
+            if self.train_step is None or (steps_per_execution is not None and int(steps_per_execution.numpy()) > 1):
+                return None
+            return max(float(self.data_ready.numpy()) - self.step_start_time, 0.0)
+
+        def on_train_begin(self, logs=None):
+            if self.parent.format not in ("jsonl", "csv"):
+                raise ValueError(f"Unknown profiling log format '{self.parent.format}', expected 'jsonl' or 'csv'")
+            Path(self.parent.log_dir).mkdir(parents=True, exist_ok=True)
+            self._log_path().unlink(missing_ok=True)
+            self.fieldnames = None
+            self.train_start = self.last_step_end = time.perf_counter()
+            self._wrap_train_step()
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self.epoch = epoch
+            self.epoch_start = time.perf_counter()
+            self.epoch_steps = 0
+            self.epoch_step_time = self.epoch_input_wait = 0.0
+            self.epoch_input_timed = True
+
+        def on_train_batch_begin(self, batch, logs=None):
+            self.step_start = time.perf_counter()
+            # wall clock, comparable with tf.timestamp()
+            self.step_start_time = time.time()
+
+        def on_train_batch_end(self, batch, logs=None):
+            end = time.perf_counter()
+            step_time = end - self.step_start
+            previous_step_end = self.last_step_end
+            host_gap = self.step_start - previous_step_end
+            self.last_step_end = end
+            input_wait = self._input_wait()
+            self.epoch_steps += 1
+            self.epoch_step_time += step_time
+            self.epoch_input_wait += input_wait or 0.0
+            self.epoch_input_timed &= input_wait is not None
+            self._trace("step", self.step_start, step_time)
+            if input_wait:
+                self._trace("input", self.step_start, input_wait)
+            if host_gap > 0:
+                self._trace("host", previous_step_end, host_gap)
+            if not self.parent.log_steps:
+                return
+            self.records.append({
+                "type": "step",
+                "epoch": self.epoch,
+                "step": batch,
+                "wall": end - self.train_start,
+                "step_time": step_time,
+                "input_wait": input_wait,
+                "compute_time": step_time - (input_wait or 0.0),
+                "host_gap": host_gap,
+                "throughput": (self.parent.batch_size or 1) / step_time,
+                "rss_mb": current_rss() / 2 ** 20,
+            })
+            if len(self.records) >= self.parent.flush_every:
+                self._flush()
+
+        def on_epoch_end(self, epoch, logs=None):
+            wall = time.perf_counter() - self.epoch_start
+            self.records.append({
+                "type": "epoch",
+                "epoch": epoch,
+                "wall": wall,
+                "steps": self.epoch_steps,
+                "step_time": self.epoch_step_time,
+                "input_wait": self.epoch_input_wait if self.epoch_input_timed else None,
+                "compute_time": self.epoch_step_time - self.epoch_input_wait,
+                "host_gap": wall - self.epoch_step_time,
+                "throughput": self.epoch_steps * (self.parent.batch_size or 1) / wall,
+                "rss_mb": current_rss() / 2 ** 20,
+                "peak_rss_mb": peak_rss() / 2 ** 20,
+            })
+            self._flush()
+
+        def on_train_end(self, logs=None):
+            self._restore_train_step()
+            self._flush()
+            if self.parent.chrome_trace:
+                with open(Path(self.parent.log_dir) / "trace.json", "w") as f:
+                    json.dump({"traceEvents": self.trace_events, "displayTimeUnit": "ms"}, f)
+
+plugins.append(ProfilingCallback)
+
+
+for plugin in plugins:
+    register_plugin(plugin)
@@ -0,0 +1,3 @@
+from neurosegmenter.config.paths import get_cache_dir
+from neurosegmenter.config.hashing import config_hash, plugin_hash, plugin_parameter_values, source_hash
+from neurosegmenter.config.engine import ConfigEngine, ConfigError, ValidationResult, load_config, flatten_config
\ No newline at end of file
@@ -0,0 +1,176 @@
+"""Resolution of configurations against the PluginParameter paths.
+
+The ConfigEngine compiles the parameter paths of the registered plugins into
+a lookup index once, then validates configurations (with type coercion from
+PluginParameter.type) in a single pass over their keys and binds them to
+plugin instances. Validation results are cached by configuration hash, so
+repeated or identical sweep configurations are validated only once.
+"""
+import json
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional, Union
+
+from neurosegmenter.config.hashing import config_hash
+from neurosegmenter.plugins import PluginParameter, discover_plugins, registered_plugins
+
+_TRUE_STRINGS = {"true", "yes", "on", "1"}
+_FALSE_STRINGS = {"false", "no", "off", "0"}
+
+
+class ConfigError(ValueError):
+    """Raised when a configuration does not match the plugin parameters."""
+
+
+@dataclass
+class ValidationResult:
+    """Outcome of a configuration validation.
+
+    values maps the name of every plugin referenced by the configuration to
+    its parameter values (defaults overridden by the configuration).
+    """
+    valid: bool
+    values: dict[str, dict[str, Any]] = field(default_factory=dict)
+    errors: list[str] = field(default_factory=list)
+    unknown_paths: list[str] = field(default_factory=list)
+
+
+def load_config(path: Union[str, Path]) -> dict:
+    """Load a YAML or JSON configuration file."""
+    path = Path(path)
+    with open(path) as f:
+        if path.suffix in (".yaml", ".yml"):
+            import yaml
+            return yaml.safe_load(f) or {}
+        if path.suffix == ".json":
+            return json.load(f)
+    raise ConfigError(f"Unsupported configuration format: {path}, expected .yaml, .yml or .json")
+
+
+def flatten_config(config: dict, prefix: str = "") -> dict[str, Any]:
+    """Flatten a nested configuration to dotted paths, e.g. {"a": {"b": 1}} -> {"a.b": 1}.
+
+    Dotted keys are accepted as well, so both layouts can be mixed.
+    """
+    flat = {}
+    for key, value in config.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict) and value:
+            flat.update(flatten_config(value, f"{path}."))
+        else:
+            flat[path] = value
+    return flat
+
+
+def coerce(value: Any, parameter: PluginParameter) -> Any:
+    """Convert a configuration value to the type of a plugin parameter, raises ValueError."""
+    expected = parameter.type
+    if value is None or isinstance(value, expected) and not (expected is int and isinstance(value, bool)):
+        return value
+    if expected is bool:
+        if isinstance(value, str) and value.lower() in _TRUE_STRINGS | _FALSE_STRINGS:
+            return value.lower() in _TRUE_STRINGS
+        if isinstance(value, int) and value in (0, 1):
+            return bool(value)
+    elif expected is int:
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if isinstance(value, str):
+            return int(value)
+    elif expected is float:
+        if isinstance(value, (int, str)) and not isinstance(value, bool):
+            return float(value)
+    elif expected in (list, tuple):
+        if isinstance(value, (list, tuple)):
+            return expected(value)
+    elif expected is str:
+        if isinstance(value, (int, float)):
+            return str(value)
+    raise ValueError(f"expected {expected.__name__}, got {type(value).__name__} ({value!r})")
+
+
+class ConfigEngine:
+    """Validates configurations and binds them to plugin instances.
+
+    plugins: registry to resolve against, defaults to the registered plugins
+        at construction time, after discovering the builtin ones (lazily, no
+        plugin module is imported). The index is not updated by later
+        registrations, call compile() again if needed.
+    strict: configuration paths that match no plugin parameter are errors.
+    """
+
+    def __init__(self, plugins: Optional[dict[str, Any]] = None, strict: bool = True, cache_size: int = 65536) -> None:
+        self.strict = strict
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, ValidationResult] = OrderedDict()
+        if plugins is None:
+            discover_plugins()
+            plugins = registered_plugins
+        self.compile(plugins)
+
+    def compile(self, plugins: dict[str, Any]) -> None:
+        """Build the parameter path index, several plugins can share a path."""
+        self.plugins = dict(plugins)
+        self.index: dict[str, list[tuple[str, PluginParameter]]] = {}
+        self.defaults: dict[str, dict[str, Any]] = {}
+        for plugin_name, plugin in self.plugins.items():
+            self.defaults[plugin_name] = {}
+            for parameter in plugin.parameters:
+                self.index.setdefault(parameter.path, []).append((plugin_name, parameter))
+                self.defaults[plugin_name][parameter.name] = parameter.default
+        self._cache.clear()
+
+    def validate(self, config: dict) -> ValidationResult:
+        """Validate a (nested or dotted) configuration, results are cached by configuration hash."""
+        key = config_hash(config)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        result = self._validate(flatten_config(config))
+        self._cache[key] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def _validate(self, flat_config: dict[str, Any]) -> ValidationResult:
+        result = ValidationResult(valid=True)
+        for path, value in flat_config.items():
+            targets = self.index.get(path)
+            if targets is None:
+                result.unknown_paths.append(path)
+                if self.strict:
+                    result.errors.append(f"{path}: no plugin parameter with this path")
+                continue
+            for plugin_name, parameter in targets:
+                try:
+                    coerced = coerce(value, parameter)
+                except ValueError as e:
+                    result.errors.append(f"{path}: {e}")
+                    continue
+                if plugin_name not in result.values:
+                    result.values[plugin_name] = dict(self.defaults[plugin_name])
+                result.values[plugin_name][parameter.name] = coerced
+        result.valid = not result.errors
+        return result
+
+    def bind(self, config: dict, plugins: Optional[list[str]] = None) -> dict[str, Any]:
+        """Instantiate the plugins referenced by a configuration with its values.
+
+        plugins: names of the plugins to instantiate, by default every plugin
+            with at least one parameter in the configuration. Plugins not in
+            the configuration get their default values.
+        """
+        result = self.validate(config)
+        if not result.valid:
+            raise ConfigError("Invalid configuration:\n" + "\n".join(result.errors))
+        names = list(result.values) if plugins is None else plugins
+        instances = {}
+        for name in names:
+            if name not in self.plugins:
+                raise ConfigError(f"Unknown plugin: {name}")
+            instance = self.plugins[name]()
+            for parameter_name, value in result.values.get(name, self.defaults[name]).items():
+                setattr(instance, parameter_name, value)
+            instances[name] = instance
+        return instances
@@ -0,0 +1,38 @@
+"""Stable hashes of configurations and plugin parameter values."""
+import hashlib
+import inspect
+import json
+from typing import Any
+
+def config_hash(config: Any) -> str:
+    """Hash of a json-like configuration, independent of the key order."""
+    canonical = json.dumps(config, sort_keys=True, separators=(",", ":"), default=repr)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def plugin_parameter_values(plugin: Any) -> dict[str, Any]:
+    """Current values of the parameters of a plugin instance."""
+    return {parameter.name: getattr(plugin, parameter.name, parameter.default) for parameter in plugin.parameters}
+
+def plugin_hash(plugin: Any) -> str:
+    """Hash of a plugin instance: its class and its parameter values."""
+    plugin_class = type(plugin)
+    return config_hash({"plugin": f"{plugin_class.__module__}.{plugin_class.__qualname__}",
+                        "parameters": plugin_parameter_values(plugin)})
+
+def source_hash(obj: Any) -> str:
+    """Hash of the source of the module defining an object (module, class, function or instance).
+
+    Falls back to the source of the object itself, then to its qualified
+    name, when the module source is not available (e.g. interactive code).
+    """
+    if not (inspect.ismodule(obj) or inspect.isclass(obj) or inspect.isroutine(obj)):
+        # instances (plugins, callable objects) by their class
+        obj = type(obj)
+    try:
+        source = inspect.getsource(inspect.getmodule(obj))
+    except (TypeError, OSError):
+        try:
+            source = inspect.getsource(obj)
+        except (TypeError, OSError):
+            source = f"{getattr(obj, '__module__', '')}.{getattr(obj, '__qualname__', obj.__name__)}"
+    return hashlib.sha256(source.encode()).hexdigest()
@@ -0,0 +1,17 @@
+"""Filesystem locations shared by the framework."""
+import os
+from pathlib import Path
+
+CACHE_DIR_ENV = "NEUROSEGMENTER_CACHE_DIR"
+
+def get_cache_dir(subdir: str = "") -> Path:
+    """Return (and create) the neurosegmenter cache directory.
+    
+    The location defaults to ~/.cache/neurosegmenter and can be overridden
+    with the NEUROSEGMENTER_CACHE_DIR environment variable.
+    """
+    cache_dir = Path(os.environ.get(CACHE_DIR_ENV, Path.home() / ".cache" / "neurosegmenter"))
+    if subdir:
+        cache_dir = cache_dir / subdir
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
@@ -0,0 +1 @@
+from neurosegmenter.datagens.datagen import DataGenerator
\ No newline at end of file
@@ -0,0 +1,6 @@
+from typing import Protocol
+import tensorflow as tf
+
+class DataGenerator(Protocol):
+    def get_dataset(self) -> tf.data.Dataset:
+        ...
@@ -0,0 +1,325 @@
+import copy
+from pathlib import Path
+from typing import Any, Optional, Sequence
+
+import numpy as np
+import tensorflow as tf
+
+from neurosegmenter.augmentations import Augmentation, augment_dataset
+from neurosegmenter.datagens import DataGenerator
+from neurosegmenter.datagens.patch_cache import PatchCache, patch_cache_key
+from neurosegmenter.datagens.sampling import ForegroundIndex
+from neurosegmenter.datagens.weight_maps import get_weight_map
+from neurosegmenter.config import plugin_parameter_values
+from neurosegmenter.plugins import Plugin, PluginType, PluginParameter
+from neurosegmenter.plugins import register_plugin, get_plugin
+from neurosegmenter.volumes import open_volume, patch_grid, read_patch, volume_signature
+
+plugins = []
+
+# parameters that don't change the cached patches
+UNCACHED_PARAMETERS = ("batch_size", "num_workers", "prefetch", "shuffle_buffer", "cache", "cache_shard_size", "cache_memory_shards",
+                       "augmentations")
+
+# description, type and default of the parameters shared by the patch data generators
+SHARED_PARAMETERS: dict[str, tuple[str, type, Any]] = {
+    "data_path": ("Path of the input volume (.npy or .zarr).", str, None),
+    "patch_shape": ("Spatial shape of the patches, 2 or 3 values.", list, [64, 64, 64]),
+    "batch_size": ("Number of patches per batch.", int, 4),
+    "num_workers": ("Number of parallel patch reads.", int, 4),
+    "prefetch": ("Number of batches prepared ahead of the training step.", int, 2),
+    "seed": ("Random seed for patch sampling.", int, None),
+    "cache": ("Whether to write the preprocessed patches once in a sharded on-disk cache and read them back in later epochs and runs.", bool, False),
+    "cache_shard_size": ("Number of patches per cache shard.", int, 256),
+    "cache_memory_shards": ("Number of cache shards kept in memory.", int, 8),
+    "augmentations": ("Augmentation plugins (names, or configured instances) applied in order to every batch.", list, None),
+    "weight_maps": ("Whether to yield boundary weight maps (precomputed once per label volume) as sample weights with the patches.", bool, False),
+    "weight_w0": ("Weight of the boundary term of the weight maps.", float, 10.0),
+    "weight_sigma": ("Width (in voxels) of the boundary term of the weight maps.", float, 5.0),
+    "weight_foreground": ("Weight of the foreground voxels in the weight maps, the background has weight 1.", float, 1.0),
+}
+PIPELINE_PARAMETERS = ("batch_size", "num_workers", "prefetch", "seed", "cache", "cache_shard_size", "cache_memory_shards",
+                       "augmentations", "weight_maps", "weight_w0", "weight_sigma", "weight_foreground")
+
+def shared_parameters(path: str, names: Sequence[str], **descriptions: str) -> list[PluginParameter]:
+    """Shared parameters of a data generator plugin at path, descriptions can be overridden by name."""
+    return [PluginParameter(name=name,
+                            description=descriptions.get(name, SHARED_PARAMETERS[name][0]),
+                            type=SHARED_PARAMETERS[name][1],
+                            default=copy.copy(SHARED_PARAMETERS[name][2]),
+                            path=f"{path}.{name}")
+            for name in names]
+
+class MemmapPatchDataGenerator(Plugin, DataGenerator):
+    """Streams 2D/3D patches from on-disk volumes into a tf.data pipeline.
+
+    Volumes are memory mapped (.npy) or opened as chunked stores (.zarr),
+    only the patches being read are ever loaded. Volumes have the spatial axes
+    first and an optional trailing channel axis.
+    Peak memory is independent of the volume size, it is bounded by about
+    2 * num_workers patches being read and preprocessed, plus
+    (prefetch + 1) * batch_size patches of batches (num_workers more
+    batches being augmented with augmentations), plus shuffle_buffer
+    patches with cache enabled. Without cache, shuffle_buffer only holds
+    patch corners (grid sampling) or is unused (random sampling).
+    With cache enabled the preprocessed patches are drawn once and written
+    to sharded on-disk files, later epochs and runs replay them (plus up to
+    cache_memory_shards decompressed shards in memory).
+    """
+    name: str = "Memmap Patch Data Generator"
+    description: str = "Streams random or gridded patches from memory mapped volumes"
+    type: PluginType = PluginType.DATAGEN
+    path: str = "datagens.memmap_patch_data_generator"
+    parameters: list[PluginParameter] = [
+        *shared_parameters(path, ["data_path"]),
+        PluginParameter(name="label_path",
+                        description="Path of the label volume (.npy or .zarr), if None only inputs are yielded.",
+                        type=str,
+                        default=None,
+                        path="datagens.memmap_patch_data_generator.label_path"),
+        *shared_parameters(path, ["patch_shape"]),
+        PluginParameter(name="stride",
+                        description="Stride of the patch grid when sampling is 'grid', defaults to patch_shape.",
+                        type=list,
+                        default=None,
+                        path="datagens.memmap_patch_data_generator.stride"),
+        PluginParameter(name="sampling",
+                        description="Patch sampling strategy, 'random' or 'grid'.",
+                        type=str,
+                        default="random",
+                        path="datagens.memmap_patch_data_generator.sampling"),
+        PluginParameter(name="samples_per_epoch",
+                        description="Number of patches per epoch when sampling is 'random'.",
+                        type=int,
+                        default=1024,
+                        path="datagens.memmap_patch_data_generator.samples_per_epoch"),
+        PluginParameter(name="shuffle_buffer",
+                        description="Size of the shuffle buffer, 0 disables shuffling. Shuffles the patch corners "
+                                    "when sampling is 'grid' and the cached patches with cache enabled.",
+                        type=int,
+                        default=64,
+                        path="datagens.memmap_patch_data_generator.shuffle_buffer"),
+        *shared_parameters(path, PIPELINE_PARAMETERS, seed="Random seed for patch sampling and shuffling."),
+    ]
+
+    data_path: str
+    label_path: Optional[str]
+    patch_shape: list
+    stride: Optional[list]
+    sampling: str
+    samples_per_epoch: int
+    batch_size: int
+    num_workers: int
+    prefetch: int
+    shuffle_buffer: int
+    seed: Optional[int]
+    cache: bool
+    cache_shard_size: int
+    cache_memory_shards: int
+    augmentations: Optional[list]
+    weight_maps: bool
+    weight_w0: float
+    weight_sigma: float
+    weight_foreground: float
+
+    # set by distributed training, every worker reads only its shard of the patches
+    num_shards: int = 1
+    shard_index: int = 0
+
+    def open_volumes(self) -> list[Any]:
+        """Open the input (and label) volumes."""
+        if self.data_path is None:
+            raise ValueError(f"{self.name}: data_path is not set")
+        volumes = [open_volume(self.data_path)]
+        if self.label_path is not None:
+            labels = open_volume(self.label_path)
+            if labels.shape[:len(self.patch_shape)] != volumes[0].shape[:len(self.patch_shape)]:
+                raise ValueError(f"{self.name}: data and labels have different spatial shapes, "
+                                 f"{volumes[0].shape} and {labels.shape}")
+            volumes.append(labels)
+            if self.weight_maps:
+                volumes.append(self.get_weight_map())
+        return volumes
+
+    def get_weight_map(self) -> np.ndarray:
+        """The boundary weight map of the labels, computed if missing or stale."""
+        if self.label_path is None:
+            raise ValueError(f"{self.name}: weight maps need a label_path")
+        return get_weight_map(self.label_path, len(self.patch_shape),
+                              w0=self.weight_w0,
+                              sigma=self.weight_sigma,
+                              foreground_weight=self.weight_foreground,
+                              num_workers=self.num_workers)
+
+    def get_corners(self, spatial_shape: tuple) -> tf.data.Dataset:
+        """Dataset of patch corners, the only part of the pipeline proportional to the volume size."""
+        patch_shape = np.array(self.patch_shape, dtype=np.int64)
+        if self.sampling == "grid":
+            corners = tf.data.Dataset.from_tensor_slices(patch_grid(spatial_shape, self.patch_shape, self.stride))
+            if self.shuffle_buffer:
+                corners = corners.shuffle(self.shuffle_buffer, seed=self.seed, reshuffle_each_iteration=True)
+            return corners
+        if self.sampling == "random":
+            max_corner = np.maximum(np.array(spatial_shape, dtype=np.int64) - patch_shape, 0) + 1
+            # created once, so successive epochs continue the random stream
+            rng = np.random.default_rng(self.seed)
+
+            def random_corners():
+                for _ in range(self.samples_per_epoch):
+                    yield rng.integers(0, max_corner)
+            return tf.data.Dataset.from_generator(random_corners,
+                                                  output_signature=tf.TensorSpec([len(patch_shape)], tf.int64))
+        raise ValueError(f"{self.name}: unknown sampling '{self.sampling}', expected 'random' or 'grid'")
+
+    def _patch_reader(self, volumes: list[Any]):
+        """tf.data map function reading the patches of all the volumes at a given corner."""
+        patch_shape = tuple(self.patch_shape)
+        dtypes = [tf.as_dtype(volume.dtype) for volume in volumes]
+        # add a channel axis to volumes without one
+        shapes = [patch_shape + (tuple(volume.shape[len(patch_shape):]) or (1,)) for volume in volumes]
+
+        def read(corner: np.ndarray) -> list[np.ndarray]:
+            return [read_patch(volume, corner, patch_shape).reshape(shape) for volume, shape in zip(volumes, shapes)]
+
+        def read_fn(corner: tf.Tensor) -> tuple:
+            patches = tf.numpy_function(read, [corner], dtypes, stateful=False)
+            patches = tuple(tf.ensure_shape(patch, shape) for patch, shape in zip(patches, shapes))
+            return patches if len(patches) > 1 else patches[0]
+        return read_fn
+
+    def preprocess(self, *patches: tf.Tensor) -> Any:
+        """Preprocessing of the read patches (e.g. normalization), the identity by default.
+        
+        With cache enabled, the output of this stage is what gets cached.
+        """
+        return patches if len(patches) > 1 else patches[0]
+
+    def get_patches(self) -> tf.data.Dataset:
+        """Unbatched dataset of the preprocessed patches."""
+        volumes = self.open_volumes()
+        spatial_shape = tuple(volumes[0].shape[:len(self.patch_shape)])
+        dataset = self.get_corners(spatial_shape)
+        if self.num_shards > 1:
+            dataset = dataset.shard(self.num_shards, self.shard_index)
+        dataset = dataset.map(self._patch_reader(volumes),
+                              num_parallel_calls=self.num_workers,
+                              deterministic=self.seed is not None)
+        return dataset.map(self.preprocess,
+                           num_parallel_calls=self.num_workers,
+                           deterministic=self.seed is not None)
+
+    def cache_key(self) -> str:
+        """Hash of the source volumes and of the parameters the patches depend on."""
+        sources = {name: {"path": str(Path(path).resolve()), **volume_signature(path)}
+                   for name, path in (("data", self.data_path), ("labels", self.label_path)) if path is not None}
+        plugin_class = type(self)
+        preprocessing = {name: value for name, value in plugin_parameter_values(self).items() if name not in UNCACHED_PARAMETERS}
+        return patch_cache_key(sources, {"plugin": f"{plugin_class.__module__}.{plugin_class.__qualname__}",
+                                         "parameters": preprocessing,
+                                         "shard": [self.num_shards, self.shard_index]})
+
+    def get_augmentations(self) -> list[Augmentation]:
+        """Augmentation plugin instances, plugins given by name use their default parameters."""
+        return [get_plugin(augmentation)() if isinstance(augmentation, str) else augmentation
+                for augmentation in self.augmentations or []]
+
+    def _batch(self, dataset: tf.data.Dataset) -> tf.data.Dataset:
+        # augmentations run on whole batches, in parallel with the training step
+        dataset = augment_dataset(dataset.batch(self.batch_size), self.get_augmentations(), num_parallel_calls=self.num_workers)
+        return dataset.prefetch(self.prefetch)
+
+    def get_dataset(self) -> tf.data.Dataset:
+        if not self.cache:
+            return self._batch(self.get_patches())
+        # the patches are drawn once, later epochs and runs replay the cached ones
+        patch_cache = PatchCache(shard_size=self.cache_shard_size, max_memory_shards=self.cache_memory_shards)
+        dataset = patch_cache.get_or_create(self.cache_key(), self.get_patches,
+                                            num_parallel_reads=self.num_workers, seed=self.seed)
+        if self.shuffle_buffer:
+            dataset = dataset.shuffle(self.shuffle_buffer, seed=self.seed, reshuffle_each_iteration=True)
+        return self._batch(dataset)
+
+plugins.append(MemmapPatchDataGenerator)
+
+class ForegroundPatchDataGenerator(MemmapPatchDataGenerator):
+    """Streams patches centered on foreground voxels with class-balanced sampling.
+
+    With probability foreground_probability a class is drawn uniformly among
+    the indexed ones and the patch is centered on a random voxel of that
+    class, otherwise a uniformly random patch is drawn. The foreground voxels
+    come from a per-class index built once per label volume and stored next
+    to it, it is rebuilt when the label file changes.
+    """
+    name: str = "Foreground Patch Data Generator"
+    description: str = "Streams class-balanced foreground-centered patches from memory mapped volumes"
+    type: PluginType = PluginType.DATAGEN
+    path: str = "datagens.foreground_patch_data_generator"
+    parameters: list[PluginParameter] = [
+        *shared_parameters(path, ["data_path"]),
+        PluginParameter(name="label_path",
+                        description="Path of the label volume (.npy or .zarr), the foreground index is stored next to it.",
+                        type=str,
+                        default=None,
+                        path="datagens.foreground_patch_data_generator.label_path"),
+        *shared_parameters(path, ["patch_shape"]),
+        PluginParameter(name="samples_per_epoch",
+                        description="Number of patches per epoch.",
+                        type=int,
+                        default=1024,
+                        path="datagens.foreground_patch_data_generator.samples_per_epoch"),
+        PluginParameter(name="foreground_probability",
+                        description="Probability of centering a patch on a foreground voxel, otherwise the patch is uniformly random.",
+                        type=float,
+                        default=0.5,
+                        path="datagens.foreground_patch_data_generator.foreground_probability"),
+        PluginParameter(name="classes",
+                        description="Classes sampled for foreground patches, if None all the classes found in the labels.",
+                        type=list,
+                        default=None,
+                        path="datagens.foreground_patch_data_generator.classes"),
+        PluginParameter(name="background",
+                        description="Label value (or one-hot channel) of the background, not indexed.",
+                        type=int,
+                        default=0,
+                        path="datagens.foreground_patch_data_generator.background"),
+        *shared_parameters(path, PIPELINE_PARAMETERS,
+                           num_workers="Number of parallel patch reads (and index building threads)."),
+    ]
+
+    label_path: str
+    foreground_probability: float
+    classes: Optional[list]
+    background: int
+
+    # patches are drawn at random, see get_corners()
+    sampling: str = "random"
+    shuffle_buffer: int = 0
+
+    def get_index(self) -> ForegroundIndex:
+        """The foreground index of the labels, built if missing or stale."""
+        if self.label_path is None:
+            raise ValueError(f"{self.name}: label_path is not set")
+        return ForegroundIndex.get(self.label_path, len(self.patch_shape), background=self.background, num_workers=self.num_workers)
+
+    def get_corners(self, spatial_shape: tuple) -> tf.data.Dataset:
+        index = self.get_index()
+        patch_shape = np.array(self.patch_shape, dtype=np.int64)
+        max_corner = np.maximum(np.array(spatial_shape, dtype=np.int64) - patch_shape, 0)
+        # created once, so successive epochs continue the random stream
+        rng = np.random.default_rng(self.seed)
+
+        def foreground_corners():
+            for _ in range(self.samples_per_epoch):
+                center = index.sample_center(rng, self.classes) if rng.random() < self.foreground_probability else None
+                if center is None:
+                    yield rng.integers(0, max_corner + 1)
+                else:
+                    yield np.clip(center - patch_shape // 2, 0, max_corner)
+        return tf.data.Dataset.from_generator(foreground_corners,
+                                              output_signature=tf.TensorSpec([len(patch_shape)], tf.int64))
+
+plugins.append(ForegroundPatchDataGenerator)
+
+
+for plugin in plugins:
+    register_plugin(plugin)
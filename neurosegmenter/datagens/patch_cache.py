@@ -0,0 +1,147 @@
+"""Sharded on-disk cache of preprocessed patches.
+
+Patches are written once into compressed .npz shards, in a directory named
+after the hash of the dataset (input and label files) and of the
+preprocessing configuration. Later epochs and runs read the shards with
+parallel interleaved reads, and a bounded LRU keeps the most recently read
+shards in memory.
+"""
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+
+import numpy as np
+import tensorflow as tf
+
+from neurosegmenter.config import config_hash, get_cache_dir
+
+MANIFEST = "manifest.json"
+
+
+class PatchCache:
+    """Sharded patch store.
+
+    shard_size: number of patches per shard.
+    max_memory_shards: number of decompressed shards kept in memory.
+    """
+
+    def __init__(self,
+                 cache_dir: Optional[Union[str, Path]] = None,
+                 shard_size: int = 256,
+                 max_memory_shards: int = 8) -> None:
+        self.cache_dir = Path(cache_dir) if cache_dir else get_cache_dir("patches")
+        self.shard_size = shard_size
+        self.max_memory_shards = max_memory_shards
+        self._shards: OrderedDict[str, tuple[np.ndarray, ...]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / key
+
+    def exists(self, key: str) -> bool:
+        return (self.path(key) / MANIFEST).exists()
+
+    def manifest(self, key: str) -> dict[str, Any]:
+        with open(self.path(key) / MANIFEST) as f:
+            return json.load(f)
+
+    def write(self, key: str, dataset: tf.data.Dataset) -> None:
+        """Write the (unbatched) elements of a dataset into the shards of a key."""
+        path = self.path(key)
+        tmp_path = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        specs = tf.nest.flatten(dataset.element_spec)
+        buffers: list[list[np.ndarray]] = [[] for _ in specs]
+        shards = []
+        count = 0
+
+        def flush() -> None:
+            name = f"shard-{len(shards):06d}.npz"
+            np.savez_compressed(tmp_path / name, *[np.stack(buffer) for buffer in buffers])
+            shards.append(name)
+            for buffer in buffers:
+                buffer.clear()
+
+        for element in dataset.as_numpy_iterator():
+            for buffer, array in zip(buffers, tf.nest.flatten(element)):
+                buffer.append(array)
+            count += 1
+            if len(buffers[0]) == self.shard_size:
+                flush()
+        if buffers[0]:
+            flush()
+        manifest = {
+            "shards": shards,
+            "count": count,
+            "structure": "tuple" if isinstance(dataset.element_spec, tuple) else "single",
+            "specs": [{"shape": spec.shape.as_list(), "dtype": spec.dtype.name} for spec in specs],
+        }
+        # the manifest marks a complete cache entry
+        with open(tmp_path / MANIFEST, "w") as f:
+            json.dump(manifest, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    def load_shard(self, shard_path: str) -> tuple[np.ndarray, ...]:
+        """Arrays of a shard, from the in-memory LRU if it was read recently."""
+        with self._lock:
+            if shard_path in self._shards:
+                self._shards.move_to_end(shard_path)
+                return self._shards[shard_path]
+        with np.load(shard_path) as shard:
+            arrays = tuple(shard[f"arr_{i}"] for i in range(len(shard.files)))
+        with self._lock:
+            self._shards[shard_path] = arrays
+            while len(self._shards) > self.max_memory_shards:
+                self._shards.popitem(last=False)
+        return arrays
+
+    def read(self,
+             key: str,
+             num_parallel_reads: int = 4,
+             shuffle_shards: bool = True,
+             seed: Optional[int] = None) -> tf.data.Dataset:
+        """Dataset of the cached (unbatched) elements of a key."""
+        path = self.path(key)
+        manifest = self.manifest(key)
+        specs = [tf.TensorSpec(spec["shape"], tf.as_dtype(spec["dtype"])) for spec in manifest["specs"]]
+        shards = tf.data.Dataset.from_tensor_slices([str(path / name) for name in manifest["shards"]])
+        if shuffle_shards:
+            shards = shards.shuffle(len(manifest["shards"]), seed=seed, reshuffle_each_iteration=True)
+
+        def read_shard(shard_path: tf.Tensor) -> tf.data.Dataset:
+            arrays = tf.numpy_function(lambda p: self.load_shard(p.decode()), [shard_path],
+                                       [spec.dtype for spec in specs], stateful=False)
+            arrays = tuple(tf.ensure_shape(array, [None] + spec.shape.as_list()) for array, spec in zip(arrays, specs))
+            return tf.data.Dataset.from_tensor_slices(arrays if manifest["structure"] == "tuple" else arrays[0])
+
+        return shards.interleave(read_shard,
+                                 cycle_length=num_parallel_reads,
+                                 num_parallel_calls=num_parallel_reads,
+                                 deterministic=seed is not None)
+
+    def get_or_create(self,
+                      key: str,
+                      build: Callable[[], tf.data.Dataset],
+                      num_parallel_reads: int = 4,
+                      shuffle_shards: bool = True,
+                      seed: Optional[int] = None) -> tf.data.Dataset:
+        """Read the elements of a key, writing them from build() on the first use."""
+        if not self.exists(key):
+            self.write(key, build())
+        return self.read(key, num_parallel_reads=num_parallel_reads, shuffle_shards=shuffle_shards, seed=seed)
+
+    def clear(self, key: Optional[str] = None) -> None:
+        with self._lock:
+            self._shards.clear()
+        shutil.rmtree(self.path(key) if key else self.cache_dir, ignore_errors=True)
+
+
+def patch_cache_key(dataset: dict[str, Any], preprocessing: dict[str, Any]) -> str:
+    """Key of a cache entry, the dataset holds the signatures of the source volumes."""
+    return config_hash({"dataset": dataset, "preprocessing": preprocessing})
@@ -0,0 +1,149 @@
+"""Foreground-aware patch sampling.
+
+Label volumes are scanned once, block by block, and the flat indices of the
+voxels of every class are stored on disk next to the labels. Patch centers
+are then drawn class-balanced from the index in O(1) per sample, the index is
+memory mapped so only the drawn entries are read.
+The index is rebuilt when the label volume changes (modification time or size).
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional, Sequence, Union
+
+import numpy as np
+
+from neurosegmenter.config import config_hash, get_cache_dir
+from neurosegmenter.volumes import block_grid, open_volume, volume_signature
+
+INDEX_VERSION = 1
+
+
+def index_dir(label_path: Union[str, Path]) -> Path:
+    """Location of the index of a label volume, next to it or in the cache if that is not writable."""
+    label_path = Path(label_path).resolve()
+    path = label_path.with_name(label_path.name + ".fgindex")
+    if os.access(label_path.parent, os.W_OK):
+        return path
+    return get_cache_dir("foreground_index") / config_hash(str(label_path))
+
+
+def _block_coordinates(labels: Any, block: tuple[slice, ...], spatial_shape: tuple, background: int) -> dict[int, np.ndarray]:
+    """Flat indices of the voxels of every class in a block."""
+    values = np.asarray(labels[block])
+    ndim = len(spatial_shape)
+    if values.ndim > ndim and values.shape[ndim] > 1:
+        # one-hot labels, the classes are the channels
+        masks = {c: values[..., c] > 0.5 for c in range(values.shape[ndim]) if c != background}
+    else:
+        values = values.reshape(values.shape[:ndim])
+        masks = {int(c): values == c for c in np.unique(values) if c != background}
+    offset = np.array([s.start for s in block])
+    coordinates = {}
+    for label, mask in masks.items():
+        local = np.nonzero(mask)
+        if len(local[0]):
+            coordinates[label] = np.ravel_multi_index(tuple(l + o for l, o in zip(local, offset)), spatial_shape)
+    return coordinates
+
+
+class ForegroundIndex:
+    """On-disk index of the foreground voxels of a label volume, per class.
+
+    labels may have a trailing channel axis: single channel labels hold class
+    values, multi-channel labels are one-hot and the channel is the class.
+    The background class (value or channel) is not indexed.
+    """
+
+    def __init__(self, classes: np.ndarray, offsets: np.ndarray, coordinates: np.ndarray, spatial_shape: tuple) -> None:
+        self.classes = classes
+        self.offsets = offsets
+        self.coordinates = coordinates
+        self.spatial_shape = spatial_shape
+
+    @classmethod
+    def build(cls,
+              label_path: Union[str, Path],
+              spatial_ndim: int,
+              background: int = 0,
+              block_shape: Optional[Sequence[int]] = None,
+              num_workers: int = 4) -> "ForegroundIndex":
+        """Scan the labels and write the index, returns the memory mapped index."""
+        labels = open_volume(label_path)
+        spatial_shape = tuple(labels.shape[:spatial_ndim])
+        block_shape = block_shape or getattr(labels, "chunks", None) or (64,) * spatial_ndim
+        per_class: dict[int, list[np.ndarray]] = {}
+        with ThreadPoolExecutor(num_workers) as pool:
+            for block_coordinates in pool.map(lambda block: _block_coordinates(labels, block, spatial_shape, background),
+                                              block_grid(spatial_shape, block_shape[:spatial_ndim])):
+                for label, coordinates in block_coordinates.items():
+                    per_class.setdefault(label, []).append(coordinates)
+        classes = sorted(per_class)
+        counts = [sum(len(c) for c in per_class[label]) for label in classes]
+        dtype = np.uint32 if np.prod(spatial_shape) < 2 ** 32 else np.uint64
+        path = index_dir(label_path)
+        path.mkdir(parents=True, exist_ok=True)
+        coordinates = np.lib.format.open_memmap(path / "coordinates.npy", mode="w+", dtype=dtype, shape=(sum(counts),))
+        start = 0
+        for label in classes:
+            for block_coordinates in per_class[label]:
+                coordinates[start:start + len(block_coordinates)] = block_coordinates
+                start += len(block_coordinates)
+        coordinates.flush()
+        del coordinates
+        metadata = {
+            "version": INDEX_VERSION,
+            "source": volume_signature(label_path),
+            "spatial_shape": list(spatial_shape),
+            "background": background,
+            "classes": classes,
+            "offsets": np.cumsum([0] + counts).tolist(),
+        }
+        # written last, an interrupted build is not mistaken for a valid index
+        with open(path / "index.json", "w") as f:
+            json.dump(metadata, f)
+        return cls.load(label_path)
+
+    @classmethod
+    def load(cls, label_path: Union[str, Path]) -> "ForegroundIndex":
+        path = index_dir(label_path)
+        with open(path / "index.json") as f:
+            metadata = json.load(f)
+        return cls(classes=np.array(metadata["classes"], dtype=np.int64),
+                   offsets=np.array(metadata["offsets"], dtype=np.int64),
+                   coordinates=np.load(path / "coordinates.npy", mmap_mode="r"),
+                   spatial_shape=tuple(metadata["spatial_shape"]))
+
+    @classmethod
+    def is_valid(cls, label_path: Union[str, Path], spatial_ndim: int, background: int = 0) -> bool:
+        """Whether a stored index exists and was built from the current labels."""
+        try:
+            with open(index_dir(label_path) / "index.json") as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return (metadata.get("version") == INDEX_VERSION
+                and metadata["source"] == volume_signature(label_path)
+                and len(metadata["spatial_shape"]) == spatial_ndim
+                and metadata["background"] == background)
+
+    @classmethod
+    def get(cls, label_path: Union[str, Path], spatial_ndim: int, background: int = 0, num_workers: int = 4) -> "ForegroundIndex":
+        """Load the index of a label volume, building it if missing or stale."""
+        if cls.is_valid(label_path, spatial_ndim, background):
+            return cls.load(label_path)
+        return cls.build(label_path, spatial_ndim, background=background, num_workers=num_workers)
+
+    def counts(self) -> dict[int, int]:
+        return {int(label): int(count) for label, count in zip(self.classes, np.diff(self.offsets))}
+
+    def sample_center(self, rng: np.random.Generator, classes: Optional[Sequence[int]] = None) -> Optional[np.ndarray]:
+        """A random voxel of a class drawn uniformly among the indexed classes (or the given ones)."""
+        candidates = [i for i, label in enumerate(self.classes)
+                      if (classes is None or label in classes) and self.offsets[i + 1] > self.offsets[i]]
+        if not candidates:
+            return None
+        i = candidates[rng.integers(len(candidates))]
+        flat = self.coordinates[rng.integers(self.offsets[i], self.offsets[i + 1])]
+        return np.array(np.unravel_index(int(flat), self.spatial_shape), dtype=np.int64)
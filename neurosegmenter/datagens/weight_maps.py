@@ -0,0 +1,151 @@
+"""Precomputed boundary weight maps.
+
+U-Net style per-voxel weights, computed once per label volume:
+
+    w(x) = w_c(x) + w0 * exp(-(d1(x) + d2(x)) ** 2 / (2 * sigma ** 2))
+
+w_c is 1 on the background and foreground_weight on the foreground, d1 and
+d2 the distances to the nearest and second nearest object, so the weights
+peak in the thin background gaps between touching objects.
+Semantic labels are first split into objects by chunked connected
+components over the whole volume, so an object crossing several blocks
+keeps a single id. The volume is then processed in parallel blocks, each
+extended by a halo of 3 * sigma voxels (beyond which the boundary term
+vanishes), and the map is stored as a memory mapped .npy next to the labels,
+rebuilt when the labels change.
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Optional, Sequence, Union
+
+import numpy as np
+from scipy import ndimage
+
+from neurosegmenter.config import config_hash, get_cache_dir
+from neurosegmenter.postprocessing.components import connected_components
+from neurosegmenter.volumes import block_grid, open_volume, volume_signature
+
+WEIGHT_MAP_VERSION = 2
+
+
+def weight_map_path(label_path: Union[str, Path], parameters: dict[str, Any]) -> Path:
+    """Location of a weight map, next to the labels or in the cache if that is not writable."""
+    label_path = Path(label_path).resolve()
+    name = f"{label_path.name}.weights-{config_hash(parameters)[:12]}.npy"
+    if os.access(label_path.parent, os.W_OK):
+        return label_path.with_name(name)
+    return get_cache_dir("weight_maps") / f"{config_hash(str(label_path))}-{name}"
+
+
+def _objects(labels: np.ndarray, instance_labels: bool) -> np.ndarray:
+    """Object ids of a label block, 0 is the background."""
+    if instance_labels:
+        return labels.astype(np.int64, copy=False)
+    objects, _ = ndimage.label(labels > 0)
+    return objects
+
+
+def boundary_weights(labels: np.ndarray,
+                     w0: float = 10.0,
+                     sigma: float = 5.0,
+                     foreground_weight: float = 1.0,
+                     instance_labels: bool = False) -> np.ndarray:
+    """Weight map of a label array (spatial axes only), see the module docstring."""
+    objects = _objects(labels, instance_labels)
+    reach = int(np.ceil(3 * sigma))
+    nearest = np.full(objects.shape, np.inf, dtype=np.float32)
+    second = np.full(objects.shape, np.inf, dtype=np.float32)
+    for index, bounding_box in enumerate(ndimage.find_objects(objects), start=1):
+        if bounding_box is None:
+            continue
+        # distances are only needed up to the reach of the boundary term
+        region = tuple(slice(max(s.start - reach, 0), min(s.stop + reach, size)) for s, size in zip(bounding_box, objects.shape))
+        distance = ndimage.distance_transform_edt(objects[region] != index).astype(np.float32)
+        region_nearest, region_second = nearest[region], second[region]
+        closer = distance < region_nearest
+        region_second[...] = np.where(closer, region_nearest, np.minimum(region_second, distance))
+        region_nearest[...] = np.where(closer, distance, region_nearest)
+    weights = np.where(objects > 0, np.float32(foreground_weight), np.float32(1.0))
+    # the boundary term is only defined between two objects, on the background
+    gaps = np.isfinite(second) & (objects == 0)
+    weights[gaps] += w0 * np.exp(-(nearest[gaps] + second[gaps]) ** 2 / (2 * sigma ** 2))
+    return weights.astype(np.float32)
+
+
+def _weight_block(label_path: str, output_path: str, block: tuple[slice, ...], parameters: dict[str, Any]) -> None:
+    labels = open_volume(label_path)
+    output = np.load(output_path, mmap_mode="r+")
+    spatial_shape = output.shape
+    halo = int(np.ceil(3 * parameters["sigma"]))
+    extended = tuple(slice(max(s.start - halo, 0), min(s.stop + halo, size)) for s, size in zip(block, spatial_shape))
+    values = np.asarray(labels[extended])
+    ndim = len(spatial_shape)
+    if values.ndim > ndim and values.shape[ndim] > 1:
+        # one-hot labels, any channel but the first (background) is foreground
+        values = (values[..., 1:] > 0.5).any(axis=-1)
+    else:
+        values = values.reshape(values.shape[:ndim])
+    weights = boundary_weights(values, **parameters)
+    crop = tuple(slice(s.start - e.start, s.stop - e.start) for s, e in zip(block, extended))
+    output[block] = weights[crop]
+    output.flush()
+
+
+def compute_weight_map(label_path: Union[str, Path],
+                       spatial_ndim: int,
+                       w0: float = 10.0,
+                       sigma: float = 5.0,
+                       foreground_weight: float = 1.0,
+                       instance_labels: bool = False,
+                       block_shape: Optional[Sequence[int]] = None,
+                       num_workers: int = 4) -> np.ndarray:
+    """Compute (in parallel blocks with halos) and store the weight map of a label volume."""
+    parameters = {"w0": w0, "sigma": sigma, "foreground_weight": foreground_weight, "instance_labels": instance_labels}
+    labels = open_volume(label_path)
+    spatial_shape = tuple(labels.shape[:spatial_ndim])
+    block_shape = tuple(block_shape or (128,) * spatial_ndim)
+    path = weight_map_path(label_path, parameters)
+    tmp_path = path.with_name(path.name[:-len(".npy")] + f".{os.getpid()}.tmp.npy")
+    objects_path = path.with_name(path.name[:-len(".npy")] + f".{os.getpid()}.objects.npy")
+    output = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=spatial_shape)
+    del output
+    try:
+        block_source, block_parameters = label_path, parameters
+        if not instance_labels:
+            # global object ids, labeling every block on its own would split objects leaving and re-entering it
+            connected_components(label_path, objects_path, block_shape, threshold=0.5, channel=None, num_workers=num_workers)
+            block_source, block_parameters = objects_path, {**parameters, "instance_labels": True}
+        with ProcessPoolExecutor(num_workers) as pool:
+            futures = [pool.submit(_weight_block, str(block_source), str(tmp_path), block, block_parameters)
+                       for block in block_grid(spatial_shape, block_shape)]
+            for future in futures:
+                future.result()
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+        objects_path.unlink(missing_ok=True)
+    with open(path.with_suffix(".json"), "w") as f:
+        json.dump({"version": WEIGHT_MAP_VERSION, "source": volume_signature(label_path), "parameters": parameters}, f)
+    return np.load(path, mmap_mode="r")
+
+
+def get_weight_map(label_path: Union[str, Path],
+                   spatial_ndim: int,
+                   w0: float = 10.0,
+                   sigma: float = 5.0,
+                   foreground_weight: float = 1.0,
+                   instance_labels: bool = False,
+                   num_workers: int = 4) -> np.ndarray:
+    """Memory mapped weight map of a label volume, computed if missing or stale."""
+    parameters = {"w0": w0, "sigma": sigma, "foreground_weight": foreground_weight, "instance_labels": instance_labels}
+    path = weight_map_path(label_path, parameters)
+    try:
+        with open(path.with_suffix(".json")) as f:
+            metadata = json.load(f)
+        if metadata["version"] == WEIGHT_MAP_VERSION and metadata["source"] == volume_signature(label_path) and path.exists():
+            return np.load(path, mmap_mode="r")
+    except (OSError, ValueError, KeyError):
+        pass
+    return compute_weight_map(label_path, spatial_ndim, num_workers=num_workers, **parameters)
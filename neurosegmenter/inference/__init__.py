@@ -0,0 +1,5 @@
+from neurosegmenter.inference.blending import blending_weights
+from neurosegmenter.inference.engine import TiledInferenceEngine
+from neurosegmenter.inference.service import InferenceService, InferenceClient
+from neurosegmenter.inference.export import ExportedModel, export_saved_model, export_tflite, compare_exported
+from neurosegmenter.inference.coarse_to_fine import CoarseToFineInferenceEngine, block_statistics
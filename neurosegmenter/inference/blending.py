@@ -0,0 +1,35 @@
+"""Blending weights for overlapping tiles."""
+from typing import Sequence
+
+import numpy as np
+
+BLENDING_MODES = ("gaussian", "linear", "constant")
+
+def _gaussian_1d(size: int, sigma_scale: float) -> np.ndarray:
+    center = (size - 1) / 2
+    sigma = max(size * sigma_scale, 1e-3)
+    return np.exp(-0.5 * ((np.arange(size) - center) / sigma) ** 2)
+
+def _linear_1d(size: int) -> np.ndarray:
+    # distance from the nearest border, 1 at the borders
+    ramp = np.minimum(np.arange(size), np.arange(size)[::-1]) + 1
+    return ramp / ramp.max()
+
+def blending_weights(tile_shape: Sequence[int], mode: str = "gaussian", sigma_scale: float = 0.125) -> np.ndarray:
+    """Per-voxel weights of a tile, highest in the center and decaying towards the borders.
+    
+    The weights are strictly positive so that every voxel of a tile counts,
+    which matters for voxels covered by a single tile.
+    """
+    if mode not in BLENDING_MODES:
+        raise ValueError(f"Unknown blending mode '{mode}', expected one of {BLENDING_MODES}")
+    weights = np.ones(tuple(tile_shape), dtype=np.float32)
+    if mode == "constant":
+        return weights
+    for axis, size in enumerate(tile_shape):
+        profile = _gaussian_1d(size, sigma_scale) if mode == "gaussian" else _linear_1d(size)
+        shape = [1] * len(tile_shape)
+        shape[axis] = size
+        weights = weights * profile.reshape(shape)
+    weights = weights / weights.max()
+    return np.maximum(weights, 1e-4).astype(np.float32)
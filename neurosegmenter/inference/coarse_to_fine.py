@@ -0,0 +1,192 @@
+"""Coarse-to-fine tiled inference, skipping the background.
+
+The volume is first reduced to a low-resolution map by averaging blocks of
+factor ** ndim voxels (one read of the volume). Blocks that may hold
+foreground are flagged either by an intensity/variance heuristic on the
+block statistics or by a cheap model pass on the low-resolution volume,
+then the full model only predicts the tiles overlapping a flagged block.
+Skipped tiles are filled with a background vector in the output (zero for
+a single channel, one-hot on channel 0 for softmax/one-hot outputs).
+"""
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional, Sequence, Union
+
+import numpy as np
+
+from neurosegmenter.inference.engine import TiledInferenceEngine
+from neurosegmenter.metrics import mask_dice
+from neurosegmenter.volumes import block_grid, open_volume
+
+SELECTION_MODES = ("heuristic", "coarse_model")
+
+
+def block_statistics(volume: Any, spatial_ndim: int, factor: int, num_workers: int = 4,
+                     keep_channels: bool = False) -> tuple[np.ndarray, np.ndarray]:
+    """Mean and standard deviation of the blocks of factor ** spatial_ndim voxels of a volume.
+
+    The channels are averaged, unless keep_channels is True, in which case
+    the statistics are per channel with a trailing channel axis (of size 1
+    for volumes without channel axis).
+    """
+    spatial_shape = tuple(volume.shape[:spatial_ndim])
+    low_shape = tuple(-(-size // factor) for size in spatial_shape)
+    channels = (int(np.prod(volume.shape[spatial_ndim:])),) if keep_channels else ()
+    means = np.zeros(low_shape + channels, dtype=np.float32)
+    stds = np.zeros(low_shape + channels, dtype=np.float32)
+
+    def reduce(region: tuple[slice, ...]) -> None:
+        values = np.asarray(volume[region], dtype=np.float32)
+        values = values.reshape(values.shape[:spatial_ndim] + (-1,))
+        if not keep_channels:
+            values = values.mean(axis=-1, keepdims=True)
+        # border blocks are completed by repeating the last voxels
+        values = np.pad(values, [(0, -size % factor) for size in values.shape[:spatial_ndim]] + [(0, 0)], mode="edge")
+        blocks = values.reshape([n for size in values.shape[:spatial_ndim] for n in (size // factor, factor)] + [-1])
+        axes = tuple(range(1, 2 * spatial_ndim, 2))
+        low_region = tuple(slice(s.start // factor, -(-s.stop // factor)) for s in region)
+        means[low_region] = blocks.mean(axis=axes).reshape(means[low_region].shape)
+        stds[low_region] = blocks.std(axis=axes).reshape(stds[low_region].shape)
+
+    # slabs of whole blocks, read in parallel
+    slab_shape = tuple(factor * max(1, 64 // factor) for _ in spatial_shape)
+    with ThreadPoolExecutor(num_workers) as pool:
+        list(pool.map(reduce, block_grid(spatial_shape, slab_shape)))
+    return means, stds
+
+
+def _robust_threshold(values: np.ndarray, sensitivity: float) -> float:
+    """Median plus sensitivity robust standard deviations (from the median absolute deviation)."""
+    median = float(np.median(values))
+    return median + sensitivity * 1.4826 * float(np.median(np.abs(values - median)))
+
+
+class CoarseToFineInferenceEngine(TiledInferenceEngine):
+    """Tiled inference predicting only the tiles that may hold foreground.
+
+    selection: 'heuristic' flags the low-resolution blocks whose mean is
+        above intensity_threshold or whose standard deviation is above
+        variance_threshold (thresholds default to the median plus
+        sensitivity robust standard deviations of the block statistics, the
+        background dominating the volume). 'coarse_model' predicts the
+        low-resolution volume (block means of every input channel) with
+        coarse_model (by default the model itself) and flags the blocks
+        with a foreground probability above coarse_threshold (channel
+        coarse_channel, by default the only channel or the maximum of the
+        non-background channels).
+    factor: downsampling factor of the low-resolution map.
+    margin: flagged blocks are dilated by margin blocks before selecting
+        the tiles, a safety margin for objects at the edge of a block.
+    background: output vector of the voxels of skipped tiles, one value per
+        output channel. If None, zero for a single output channel, else
+        one-hot on channel 0 (the background class of softmax outputs).
+    The other arguments are those of TiledInferenceEngine.
+    """
+
+    def __init__(self,
+                 model: Any,
+                 tile_shape: Sequence[int],
+                 selection: str = "heuristic",
+                 factor: int = 4,
+                 margin: int = 1,
+                 intensity_threshold: Optional[float] = None,
+                 variance_threshold: Optional[float] = None,
+                 sensitivity: float = 5.0,
+                 coarse_model: Optional[Any] = None,
+                 coarse_threshold: float = 0.1,
+                 coarse_channel: Optional[int] = None,
+                 background: Optional[Sequence[float]] = None,
+                 **engine_kwargs: Any) -> None:
+        super().__init__(model, tile_shape, **engine_kwargs)
+        if selection not in SELECTION_MODES:
+            raise ValueError(f"Unknown selection '{selection}', expected one of {SELECTION_MODES}")
+        self.selection = selection
+        self.factor = factor
+        self.margin = margin
+        self.intensity_threshold = intensity_threshold
+        self.variance_threshold = variance_threshold
+        self.sensitivity = sensitivity
+        self.coarse_model = coarse_model if coarse_model is not None else self.model
+        self.coarse_threshold = coarse_threshold
+        self.coarse_channel = coarse_channel
+        self.background = background
+        self.engine_kwargs = engine_kwargs
+
+    def background_vector(self, out_channels: int) -> np.ndarray:
+        if self.background is None:
+            return super().background_vector(out_channels) if out_channels == 1 else np.eye(out_channels, dtype=np.float32)[0]
+        background = np.asarray(self.background, dtype=np.float32)
+        if background.shape != (out_channels,):
+            raise ValueError(f"background has {background.size} values, the model has {out_channels} output channels")
+        return background
+
+    def foreground_probability(self, probabilities: np.ndarray) -> np.ndarray:
+        """Foreground probability of model outputs: channel coarse_channel, the only channel or the maximum of the non-background channels."""
+        if self.coarse_channel is not None:
+            return probabilities[..., self.coarse_channel]
+        if probabilities.shape[-1] > 1:
+            return probabilities[..., 1:].max(axis=-1)
+        return probabilities[..., 0]
+
+    def foreground_blocks(self, volume: Any) -> np.ndarray:
+        """Boolean low-resolution map of the blocks that may hold foreground."""
+        if self.selection == "heuristic":
+            means, stds = block_statistics(volume, len(self.tile_shape), self.factor, self.num_workers)
+            intensity_threshold = self.intensity_threshold if self.intensity_threshold is not None else _robust_threshold(means, self.sensitivity)
+            variance_threshold = self.variance_threshold if self.variance_threshold is not None else _robust_threshold(stds, self.sensitivity)
+            return (means > intensity_threshold) | (stds > variance_threshold)
+        means, _ = block_statistics(volume, len(self.tile_shape), self.factor, self.num_workers, keep_channels=True)
+        engine = TiledInferenceEngine(self.coarse_model, self.tile_shape, **self.engine_kwargs)
+        with tempfile.TemporaryDirectory(prefix="neurosegmenter_", dir=self.scratch_dir) as tmp_dir:
+            probabilities = np.asarray(engine.predict(means, Path(tmp_dir) / "coarse.npy"))
+        return self.foreground_probability(probabilities) > self.coarse_threshold
+
+    def select_tiles(self, volume: Any, corners: np.ndarray) -> np.ndarray:
+        start = time.perf_counter()
+        flagged = self.foreground_blocks(volume)
+        keep = np.zeros(len(corners), dtype=bool)
+        for i, corner in enumerate(corners):
+            region = tuple(slice(max(int(c) // self.factor - self.margin, 0), -(-(int(c) + size) // self.factor) + self.margin)
+                           for c, size in zip(corner, self.tile_shape))
+            keep[i] = flagged[region].any()
+        self._selection_stats = {"flagged_blocks_fraction": float(flagged.mean()) if flagged.size else 0.0,
+                                 "selection_seconds": time.perf_counter() - start}
+        return corners[keep]
+
+    def predict(self, volume: Any, output: Union[str, Path, Any], dtype: Any = np.float32, output_options: Optional[dict[str, Any]] = None) -> Any:
+        output = super().predict(volume, output, dtype, output_options)
+        self.stats.update(self._selection_stats)
+        self.stats["skipped_fraction"] = 1 - self.stats["predicted_tiles"] / max(self.stats["tiles"], 1)
+        return output
+
+    def validate(self, volume: Any, region: Optional[Sequence[Sequence[int]]] = None, threshold: float = 0.5) -> dict[str, float]:
+        """Compare coarse-to-fine with full inference on a validation crop.
+
+        region: [start, stop] per spatial axis of the crop, the whole volume
+            if None.
+        Reports the time of both, the speedup, the fraction of skipped tiles,
+        the recall of the foreground of the full inference (voxels whose
+        foreground_probability is above threshold) and the Dice agreement of
+        the two.
+        """
+        if isinstance(volume, (str, Path)):
+            volume = open_volume(volume)
+        if region is not None:
+            volume = np.asarray(volume[tuple(slice(start, stop) for start, stop in region)])
+        full_engine = TiledInferenceEngine(self.model, self.tile_shape, **self.engine_kwargs)
+        report: dict[str, float] = {}
+        foreground = {}
+        with tempfile.TemporaryDirectory(prefix="neurosegmenter_", dir=self.scratch_dir) as tmp_dir:
+            for name, engine in (("full", full_engine), ("coarse_to_fine", self)):
+                output = engine.predict(volume, Path(tmp_dir) / f"{name}.npy")
+                report[f"{name}_seconds"] = engine.stats["seconds"]
+                foreground[name] = self.foreground_probability(np.asarray(output)) > threshold
+                del output
+        report["speedup"] = report["full_seconds"] / report["coarse_to_fine_seconds"]
+        report["skipped_fraction"] = self.stats["skipped_fraction"]
+        positives = foreground["full"].sum()
+        report["recall"] = float(np.logical_and(foreground["full"], foreground["coarse_to_fine"]).sum() / positives) if positives else 1.0
+        report["agreement_dice"] = mask_dice(foreground["full"], foreground["coarse_to_fine"])
+        return report
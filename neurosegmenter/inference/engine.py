@@ -0,0 +1,226 @@
+"""Sliding-window tiled inference on volumes larger than memory."""
+import queue
+import shutil
+import tempfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional, Sequence, Union
+
+import numpy as np
+
+from neurosegmenter.inference.blending import blending_weights
+from neurosegmenter.volumes import block_grid, create_volume, open_volume, patch_grid, read_patch
+
+_DONE = object()
+
+
+class TiledInferenceEngine:
+    """Predicts arbitrarily large 2D/3D volumes tile by tile.
+
+    The volume is cut into overlapping tiles that are predicted in batches,
+    overlaps are blended with gaussian/linear weights and the result is written
+    to an on-disk output array. Reading, prediction and writing run in
+    separate threads connected by bounded queues, so memory stays proportional
+    to batch_size * tile_shape * (2 * prefetch + 1).
+
+    model can be a keras model, a TrainableModel plugin or any callable
+    mapping a [batch, *tile_shape, channels] array to a
+    [batch, *tile_shape, out_channels] array.
+    """
+
+    def __init__(self,
+                 model: Any,
+                 tile_shape: Sequence[int],
+                 overlap: float = 0.25,
+                 batch_size: int = 8,
+                 blending: str = "gaussian",
+                 num_workers: int = 4,
+                 prefetch: int = 2,
+                 scratch_dir: Optional[Union[str, Path]] = None) -> None:
+        if hasattr(model, "get_model"):
+            model = model.get_model()
+        self.model = model
+        self.predict_fn: Callable[[np.ndarray], Any] = getattr(model, "predict_on_batch", model)
+        self.tile_shape = tuple(tile_shape)
+        self.stride = tuple(max(int(round(size * (1 - overlap))), 1) for size in self.tile_shape)
+        self.batch_size = batch_size
+        self.weights = blending_weights(self.tile_shape, blending)
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.scratch_dir = scratch_dir
+        self.stats: dict[str, float] = {}
+
+    def tile_corners(self, volume: Any) -> np.ndarray:
+        return patch_grid(volume.shape[:len(self.tile_shape)], self.tile_shape, self.stride)
+
+    def select_tiles(self, volume: Any, corners: np.ndarray) -> np.ndarray:
+        """Tiles that need to be predicted, tiles left out are filled with background_vector()."""
+        return corners
+
+    def background_vector(self, out_channels: int) -> np.ndarray:
+        """Output of the voxels not covered by any predicted tile."""
+        return np.zeros(out_channels, dtype=np.float32)
+
+    def read_tile(self, volume: Any, corner: np.ndarray) -> np.ndarray:
+        tile = read_patch(volume, corner, self.tile_shape)
+        if tile.ndim == len(self.tile_shape):
+            tile = tile[..., np.newaxis]
+        return tile
+
+    def _batches(self, corners: np.ndarray) -> Iterator[np.ndarray]:
+        for start in range(0, len(corners), self.batch_size):
+            yield corners[start:start + self.batch_size]
+
+    @staticmethod
+    def _put(q: queue.Queue, item: Any, consumer: Future) -> None:
+        # never block forever on a queue whose consumer died
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if consumer.done():
+                    consumer.result()
+                    raise RuntimeError("Queue consumer stopped before the end of the stream")
+
+    @staticmethod
+    def _get(q: queue.Queue, producer: Future) -> Any:
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if producer.done() and q.empty():
+                    producer.result()
+                    raise RuntimeError("Queue producer stopped before the end of the stream")
+
+    def _accumulate(self, accumulator: Any, weight_sum: Any, corner: np.ndarray, prediction: np.ndarray) -> None:
+        spatial_shape = weight_sum.shape
+        region = tuple(slice(int(start), min(int(start) + size, limit))
+                       for start, size, limit in zip(corner, self.tile_shape, spatial_shape))
+        crop = tuple(slice(0, r.stop - r.start) for r in region)
+        weights = self.weights[crop]
+        accumulator[region] += prediction[crop] * weights[..., np.newaxis]
+        weight_sum[region] += weights
+
+    def _normalize(self, accumulator: Any, weight_sum: Any, output: Any) -> None:
+        """Divide the blended predictions by the weights, block by block.
+
+        Blocks are aligned to the output chunks (if any) and written in
+        parallel, each chunk by a single thread.
+        """
+        spatial_shape = weight_sum.shape
+        chunks = getattr(output, "chunks", None)
+        block_shape = tuple(chunks[:len(spatial_shape)]) if chunks else self.tile_shape
+        background = self.background_vector(accumulator.shape[-1])
+
+        def normalize(region: tuple[slice, ...]) -> None:
+            weights = np.asarray(weight_sum[region])[..., np.newaxis]
+            block = np.where(weights > 0, np.asarray(accumulator[region]) / np.maximum(weights, 1e-8), background)
+            output[region] = block.astype(output.dtype, copy=False)
+
+        with ThreadPoolExecutor(self.num_workers) as pool:
+            list(pool.map(normalize, block_grid(spatial_shape, block_shape)))
+
+    @staticmethod
+    def _create_accumulator(output: Any, shape: tuple[int, ...], dtype: Any, scratch: Path) -> tuple[Any, bool]:
+        """float32 blending accumulator, and whether it is the output itself (no scratch copy)."""
+        if isinstance(output, (str, Path)) and Path(output).suffix == ".npy" and np.dtype(dtype) == np.float32:
+            return create_volume(output, shape, np.float32), True
+        if isinstance(output, np.ndarray) and output.dtype == np.float32 and output.shape == shape:
+            output[...] = 0
+            return output, True
+        return create_volume(scratch / "accumulator.npy", shape, np.float32), False
+
+    def predict(self, volume: Any, output: Union[str, Path, Any], dtype: Any = np.float32, output_options: Optional[dict[str, Any]] = None) -> Any:
+        """Predict a whole volume.
+
+        volume: array-like or path of a .npy/.zarr volume, spatial axes first
+            and an optional trailing channel axis.
+        output: array-like or path of the output volume, created with the
+            spatial shape of the volume, the model output channels and dtype
+            if it does not exist.
+        output_options: options of the created output volume, e.g. the
+            chunks, compression, quantization and pyramid levels of a .chunks
+            volume, see create_volume(). chunks can be given for the spatial
+            axes only, the channel axis is then appended whole.
+
+        Blending needs a float32 weight volume of the spatial shape (4 bytes
+        per voxel) in scratch_dir. float32 .npy and numpy array outputs
+        accumulate the predictions in place, other outputs (other dtypes,
+        .zarr, .chunks) also need a float32 scratch accumulator (4 bytes per
+        voxel and channel) that is copied into the output at the end.
+        """
+        if isinstance(volume, (str, Path)):
+            volume = open_volume(volume)
+        spatial_shape = tuple(volume.shape[:len(self.tile_shape)])
+        start_time = time.perf_counter()
+        all_corners = self.tile_corners(volume)
+        corners = self.select_tiles(volume, all_corners)
+
+        scratch = Path(tempfile.mkdtemp(prefix="neurosegmenter_", dir=self.scratch_dir))
+        try:
+            weight_sum = create_volume(scratch / "weights.npy", spatial_shape, np.float32)
+            accumulator: Optional[Any] = None
+            read_queue: queue.Queue = queue.Queue(maxsize=self.prefetch)
+            write_queue: queue.Queue = queue.Queue(maxsize=self.prefetch)
+
+            with ThreadPoolExecutor(self.num_workers) as read_pool, ThreadPoolExecutor(2) as stages:
+                def read() -> None:
+                    for batch_corners in self._batches(corners):
+                        tiles = list(read_pool.map(lambda corner: self.read_tile(volume, corner), batch_corners))
+                        self._put(read_queue, (batch_corners, np.stack(tiles)), predictor)
+                    self._put(read_queue, _DONE, predictor)
+
+                def write() -> None:
+                    # the accumulator exists before the first prediction is queued
+                    while (item := self._get(write_queue, predictor)) is not _DONE:
+                        for corner, prediction in zip(*item):
+                            self._accumulate(accumulator, weight_sum, corner, prediction)
+
+                # the main thread is the predictor, the futures only signal its state to the other stages
+                predictor: Future = Future()
+                predictor.set_running_or_notify_cancel()
+                reader = stages.submit(read)
+                writer = stages.submit(write)
+                try:
+                    while (item := self._get(read_queue, reader)) is not _DONE:
+                        batch_corners, tiles = item
+                        predictions = np.asarray(self.predict_fn(tiles), dtype=np.float32)
+                        if predictions.shape[1:-1] != self.tile_shape:
+                            raise ValueError(f"Model output shape {predictions.shape} does not match the tile shape {self.tile_shape}")
+                        if accumulator is None:
+                            accumulator, in_place = self._create_accumulator(output, spatial_shape + predictions.shape[-1:], dtype, scratch)
+                        self._put(write_queue, (batch_corners, predictions), writer)
+                    self._put(write_queue, _DONE, writer)
+                    predictor.set_result(None)
+                except BaseException as e:
+                    predictor.set_exception(e)
+                    raise
+                reader.result()
+                writer.result()
+
+            if accumulator is None:
+                # no tile was predicted, the output channels come from a single dummy prediction
+                dummy = self.read_tile(volume, all_corners[0])[np.newaxis]
+                out_channels = np.asarray(self.predict_fn(dummy)).shape[-1]
+                accumulator, in_place = self._create_accumulator(output, spatial_shape + (out_channels,), dtype, scratch)
+            if in_place:
+                output = accumulator
+            elif isinstance(output, (str, Path)):
+                options = dict(output_options or {})
+                if options.get("chunks") is not None and len(options["chunks"]) == len(spatial_shape):
+                    # spatial chunks, every chunk holds all the channels
+                    options["chunks"] = tuple(options["chunks"]) + accumulator.shape[len(spatial_shape):]
+                output = create_volume(output, accumulator.shape, dtype, **options)
+            self._normalize(accumulator, weight_sum, output)
+            del accumulator, weight_sum
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        self.stats = {
+            "tiles": len(all_corners),
+            "predicted_tiles": len(corners),
+            "seconds": time.perf_counter() - start_time,
+        }
+        return output
@@ -0,0 +1,167 @@
+"""Export of trained models for CPU inference.
+
+Models are exported as SavedModels with a single concrete serving signature
+(a frozen graph, optimized by grappler when loaded) and as TFLite flatbuffers,
+optionally float16 or int8 quantized. int8 quantization is calibrated on
+batches of a datagen plugin, ops without an int8 kernel stay in float32 and
+the inputs and outputs of the model stay float32.
+"""
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Iterator, Optional, Sequence, Union
+
+import numpy as np
+import tensorflow as tf
+
+from neurosegmenter.inference.engine import TiledInferenceEngine
+from neurosegmenter.metrics import mask_dice
+from neurosegmenter.volumes import open_volume
+
+QUANTIZATIONS = ("none", "float16", "int8")
+SIGNATURE_KEY = "serving_default"
+
+
+def _trained_model(model: Any, weights_path: Optional[Union[str, Path]] = None) -> Any:
+    """Trained keras model of a keras model, or of a model plugin and the weights to load in it.
+
+    weights_path: checkpoint prefix (save_weights), or a SavedModel
+        directory (e.g. the save_path of DistributedTrainer). .h5 weights
+        only load into models built by the plugin with their inputs
+        (functional models).
+    """
+    if hasattr(model, "get_model"):
+        if weights_path is None:
+            raise ValueError(f"{model.name}: a model plugin builds an untrained network, "
+                             "pass a trained keras.Model or the plugin with a weights_path")
+        model = model.get_model()
+    if weights_path is not None:
+        weights_path = Path(weights_path)
+        if (weights_path / "variables").is_dir():
+            weights_path = weights_path / "variables" / "variables"
+        status = model.load_weights(str(weights_path))
+        if status is not None:
+            # optimizer slots of training checkpoints are not needed
+            status.expect_partial()
+    return model
+
+
+def export_saved_model(model: Any,
+                       path: Union[str, Path],
+                       input_shape: Sequence[Optional[int]],
+                       dtype: tf.DType = tf.float32,
+                       weights_path: Optional[Union[str, Path]] = None) -> Path:
+    """Export a trained model as a SavedModel with a concrete serving signature.
+
+    model: trained keras model, or model plugin with the weights_path of its
+        trained weights (see _trained_model).
+    input_shape: shape of the model input batches, None for the dimensions
+        left dynamic (typically the batch axis).
+    """
+    model = _trained_model(model, weights_path)
+    serve = tf.function(lambda inputs: {"outputs": model(inputs, training=False)},
+                        input_signature=[tf.TensorSpec(input_shape, dtype, name="inputs")])
+    module = tf.Module()
+    module.model = model
+    module.serve = serve
+    tf.saved_model.save(module, str(path), signatures={SIGNATURE_KEY: serve.get_concrete_function()})
+    return Path(path)
+
+
+def representative_batches(datagen: Any, num_batches: int = 16) -> Iterator[list[np.ndarray]]:
+    """Calibration inputs for int8 quantization, from the batches of a datagen plugin."""
+    for element in datagen.get_dataset().take(num_batches):
+        inputs = element[0] if isinstance(element, tuple) else element
+        yield [np.asarray(inputs, dtype=np.float32)]
+
+
+def export_tflite(saved_model_path: Union[str, Path],
+                  path: Union[str, Path],
+                  quantization: str = "none",
+                  datagen: Optional[Any] = None,
+                  calibration_batches: int = 16) -> Path:
+    """Convert an exported SavedModel to TFLite, quantized to float16 or int8 (calibrated on datagen batches)."""
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATIONS}")
+    converter = tf.lite.TFLiteConverter.from_saved_model(str(saved_model_path), signature_keys=[SIGNATURE_KEY])
+    if quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        if datagen is None:
+            raise ValueError("int8 quantization needs a datagen to calibrate the activation ranges")
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: representative_batches(datagen, calibration_batches)
+    path = Path(path)
+    path.write_bytes(converter.convert())
+    return path
+
+
+class ExportedModel:
+    """Callable running an exported SavedModel directory or .tflite file on batches."""
+
+    def __init__(self, path: Union[str, Path], num_threads: Optional[int] = None) -> None:
+        self.path = Path(path)
+        if self.path.suffix == ".tflite":
+            self.interpreter = tf.lite.Interpreter(model_path=str(self.path), num_threads=num_threads or os.cpu_count())
+            self._input = self.interpreter.get_input_details()[0]
+            self._output = self.interpreter.get_output_details()[0]
+            self._input_shape: Optional[tuple] = None
+        else:
+            self.saved_model = tf.saved_model.load(str(self.path))
+            self.signature = self.saved_model.signatures[SIGNATURE_KEY]
+
+    def _run_tflite(self, inputs: np.ndarray) -> np.ndarray:
+        if inputs.shape != self._input_shape:
+            # the interpreter is resized only when the batch shape changes (e.g. the last batch)
+            self.interpreter.resize_tensor_input(self._input["index"], inputs.shape)
+            self.interpreter.allocate_tensors()
+            self._input_shape = inputs.shape
+        self.interpreter.set_tensor(self._input["index"], inputs.astype(self._input["dtype"], copy=False))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output["index"])
+
+    def __call__(self, inputs: np.ndarray) -> np.ndarray:
+        if self.path.suffix == ".tflite":
+            return self._run_tflite(np.asarray(inputs))
+        return self.signature(inputs=tf.convert_to_tensor(inputs, tf.float32))["outputs"].numpy()
+
+
+def compare_exported(model: Any,
+                     exported: Union[ExportedModel, str, Path],
+                     volume: Any,
+                     tile_shape: Sequence[int],
+                     labels: Optional[np.ndarray] = None,
+                     threshold: float = 0.5,
+                     weights_path: Optional[Union[str, Path]] = None,
+                     **engine_kwargs: Any) -> dict[str, float]:
+    """Tiled inference of a volume with the original (trained, as in export_saved_model) and the exported model.
+
+    Reports the inference times, the speedup, the Dice agreement of the two
+    binarized predictions and, with labels, the Dice of each against the
+    labels and their difference (dice_drift).
+    """
+    model = _trained_model(model, weights_path)
+    if not isinstance(exported, ExportedModel):
+        exported = ExportedModel(exported)
+    if isinstance(volume, (str, Path)):
+        volume = open_volume(volume)
+    report: dict[str, float] = {}
+    predictions = {}
+    with tempfile.TemporaryDirectory(prefix="neurosegmenter_") as tmp_dir:
+        for name, candidate in (("original", model), ("exported", exported)):
+            engine = TiledInferenceEngine(candidate, tile_shape, **engine_kwargs)
+            # untimed warmup, tracing and interpreter allocation
+            engine.predict_fn(np.stack([engine.read_tile(volume, np.zeros(len(tile_shape), dtype=np.int64))] * engine.batch_size))
+            output = engine.predict(volume, Path(tmp_dir) / f"{name}.npy")
+            report[f"{name}_seconds"] = engine.stats["seconds"]
+            predictions[name] = np.asarray(output) > threshold
+            del output
+    report["speedup"] = report["original_seconds"] / report["exported_seconds"]
+    report["agreement_dice"] = mask_dice(predictions["original"], predictions["exported"])
+    if labels is not None:
+        labels = np.asarray(labels).reshape(predictions["original"].shape) > threshold
+        report["original_dice"] = mask_dice(predictions["original"], labels)
+        report["exported_dice"] = mask_dice(predictions["exported"], labels)
+        report["dice_drift"] = report["original_dice"] - report["exported_dice"]
+    return report
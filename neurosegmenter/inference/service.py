@@ -0,0 +1,199 @@
+"""Local dynamic-batching inference service.
+
+Requests are queued on an asyncio event loop and grouped into batches of up
+to max_batch_size requests, waiting at most max_wait_ms after the first
+request of a batch. The model runs in a worker thread, so new requests keep
+being queued while a batch is predicted.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+from neurosegmenter.plugins import PluginType, get_plugin
+
+
+class InferenceService:
+    """Serves a model plugin with dynamic batching.
+
+    model: name of a registered model plugin, a model plugin instance, a keras
+        model or a callable mapping a batch to a batch of outputs.
+    max_batch_size / max_wait_ms: a batch is run when it is full or when its
+        first request waited max_wait_ms.
+    max_queue_size: bound of the request queue (0 for unbounded), callers
+        wait when it is full.
+    Requests whose inputs have different shapes or dtypes are batched separately.
+    """
+
+    def __init__(self,
+                 model: Any,
+                 max_batch_size: int = 8,
+                 max_wait_ms: float = 5.0,
+                 max_queue_size: int = 0,
+                 stats_window: int = 10000) -> None:
+        if isinstance(model, str):
+            plugin = get_plugin(model)
+            if plugin.type != PluginType.MODEL:
+                raise ValueError(f"Plugin '{model}' is not a model plugin")
+            model = plugin()
+        if hasattr(model, "get_model"):
+            model = model.get_model()
+        self.model = model
+        self.predict_fn: Callable[[np.ndarray], Any] = getattr(model, "predict_on_batch", model)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue_size = max_queue_size
+        self._latencies: deque[float] = deque(maxlen=stats_window)
+        self._fill_ratios: deque[float] = deque(maxlen=stats_window)
+        self._requests = 0
+        self._batches = 0
+        self._max_queue_depth = 0
+        self._queue: Optional[asyncio.Queue] = None
+        # requests taken from the queue and not answered yet
+        self._current: list[tuple[np.ndarray, asyncio.Future, float]] = []
+        self._batcher: Optional[asyncio.Task] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def start(self) -> None:
+        if self._batcher is not None:
+            return
+        self._queue = asyncio.Queue(self.max_queue_size)
+        # a single model thread, batches are predicted one at a time
+        self._executor = ThreadPoolExecutor(1)
+        self._batcher = asyncio.get_running_loop().create_task(self._batch_loop())
+
+    async def stop(self) -> None:
+        if self._batcher is None:
+            return
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown(wait=True)
+        # fail the requests still waiting
+        while not self._queue.empty():
+            self._current.append(self._queue.get_nowait())
+        self._fail_current()
+        self._batcher = None
+
+    def _fail_current(self) -> None:
+        """Fail the requests taken from the queue (e.g. the batch being predicted when stopped)."""
+        for _, future, _ in self._current:
+            if not future.done():
+                future.set_exception(RuntimeError("Inference service stopped"))
+        self._current = []
+
+    async def __aenter__(self) -> "InferenceService":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.stop()
+
+    async def predict(self, inputs: np.ndarray) -> np.ndarray:
+        """Prediction of a single sample (without the batch axis)."""
+        if self._batcher is None:
+            raise RuntimeError("Inference service is not running, call start() first")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((np.asarray(inputs), future, time.perf_counter()))
+        self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+        return await future
+
+    async def _next_batch(self) -> list[tuple[np.ndarray, asyncio.Future, float]]:
+        # the batch is held on the service, so the requests are failed if the batcher is cancelled
+        batch = self._current = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _predict_batch(self, inputs: np.ndarray) -> np.ndarray:
+        return np.asarray(self.predict_fn(inputs))
+
+    async def _batch_loop(self) -> None:
+        try:
+            await self._run_batches()
+        except asyncio.CancelledError:
+            self._fail_current()
+            raise
+
+    async def _run_batches(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            groups: dict[tuple, list[tuple[np.ndarray, asyncio.Future, float]]] = {}
+            for request in batch:
+                groups.setdefault((request[0].shape, request[0].dtype.str), []).append(request)
+            for requests in groups.values():
+                try:
+                    outputs = await loop.run_in_executor(self._executor, self._predict_batch,
+                                                         np.stack([inputs for inputs, _, _ in requests]))
+                except Exception as e:
+                    for _, future, _ in requests:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                end = time.perf_counter()
+                self._batches += 1
+                self._requests += len(requests)
+                self._fill_ratios.append(len(requests) / self.max_batch_size)
+                for (_, future, start), output in zip(requests, outputs):
+                    self._latencies.append(end - start)
+                    if not future.done():
+                        future.set_result(output)
+            self._current = []
+
+    def stats(self) -> dict[str, float]:
+        """Queue depth, batch fill ratio and request latency percentiles (ms) over the recent requests."""
+        latencies = np.array(self._latencies) * 1000 if self._latencies else np.zeros(1)
+        return {
+            "requests": self._requests,
+            "batches": self._batches,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue_depth": self._max_queue_depth,
+            "batch_fill_ratio": float(np.mean(self._fill_ratios)) if self._fill_ratios else 0.0,
+            "latency_p50_ms": float(np.percentile(latencies, 50)),
+            "latency_p90_ms": float(np.percentile(latencies, 90)),
+            "latency_p99_ms": float(np.percentile(latencies, 99)),
+        }
+
+
+class InferenceClient:
+    """In-process synchronous client, runs the service on an event loop in a background thread."""
+
+    def __init__(self, service: InferenceService) -> None:
+        self.service = service
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(service.start(), self.loop).result()
+
+    def predict(self, inputs: np.ndarray, timeout: Optional[float] = None) -> np.ndarray:
+        """Blocking prediction of a single sample, can be called concurrently from many threads."""
+        return asyncio.run_coroutine_threadsafe(self.service.predict(inputs), self.loop).result(timeout)
+
+    def stats(self) -> dict[str, float]:
+        return self.service.stats()
+
+    def close(self) -> None:
+        asyncio.run_coroutine_threadsafe(self.service.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    def __enter__(self) -> "InferenceClient":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
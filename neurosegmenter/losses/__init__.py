@@ -1 +1 @@
-from neurosegmenter.losses.loss import Loss
\ No newline at end of file
+from neurosegmenter.losses.loss import Loss, cast_to_float32
\ No newline at end of file
@@ -5,4 +5,7 @@ import numpy as np
 class Loss(Protocol):
     def __call__(self, y_true: Union[np.ndarray, tf.Tensor] , y_pred: Union[np.ndarray, tf.Tensor]) -> Union[tf.Tensor, np.ndarray]:
         ...
-        
\ No newline at end of file
+
+def cast_to_float32(*tensors: Union[np.ndarray, tf.Tensor]) -> tuple[tf.Tensor, ...]:
+    """Cast inputs to float32, losses and metrics are computed in float32 under mixed precision policies."""
+    return tuple(tf.cast(tensor, tf.float32) for tensor in tensors)
@@ -1,4 +1,4 @@
-from neurosegmenter.losses import Loss
+from neurosegmenter.losses import Loss, cast_to_float32
 from neurosegmenter.plugins import Plugin, PluginType, PluginParameter
 from neurosegmenter.plugins import register_plugin
 from tensorflow import keras
@@ -6,6 +6,7 @@ from keras import metrics
 from keras import losses
 import numpy as np
 import tensorflow as tf
+from typing import Optional
 
 plugins = []
 
@@ -37,10 +38,52 @@ class BinaryCrossEntropyLoss(Plugin, Loss):
     axis: int
 
     def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
         return metrics.binary_crossentropy(y_true, y_pred, from_logits=self.from_logits, label_smoothing=self.label_smoothing, axis=self.axis)
 
 plugins.append(BinaryCrossEntropyLoss)
 
+class WeightedBinaryCrossEntropyLoss(Plugin, Loss):
+    """Per-voxel binary cross entropy, weighted by per-voxel sample weights (e.g. boundary weight maps).
+
+    The loss is not reduced over the voxels: trained with DistributedTrainer,
+    the sample weights of (x, y, w) dataset elements are applied voxel by
+    voxel by keras, called directly the sample_weight argument is.
+    Like the other loss plugins it cannot be given to model.compile() as is,
+    keras uses its name as a name scope: compile the function wrapper of the
+    trainer (training.distributed._keras_function) instead.
+    """
+    name: str = "Weighted Binary Cross Entropy Loss"
+    description: str = "Binary Cross Entropy Loss weighted voxel by voxel by sample weights"
+    type: PluginType = PluginType.LOSS
+    path: str = "losses.weighted_binary_cross_entropy_loss"
+    parameters: list[PluginParameter] = [
+        PluginParameter(name="from_logits",
+                        description="Whether y_pred are logits, otherwise probabilities.",
+                        type=bool,
+                        default=False,
+                        path="losses.weighted_binary_cross_entropy_loss.from_logits"),
+        PluginParameter(name="label_smoothing",
+                        description="Float in [0, 1]. If > 0 then smooth the labels.",
+                        type=float,
+                        default=0.0,
+                        path="losses.weighted_binary_cross_entropy_loss.label_smoothing"),
+    ]
+
+    from_logits: bool
+    label_smoothing: float
+
+    def __call__(self, y_true: np.ndarray, y_pred: np.ndarray, sample_weight: Optional[np.ndarray] = None) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
+        loss = metrics.binary_crossentropy(y_true, y_pred, from_logits=self.from_logits, label_smoothing=self.label_smoothing, axis=-1)
+        if sample_weight is None:
+            return loss
+        # weight maps have a single channel, the loss none
+        sample_weight = tf.cast(sample_weight, loss.dtype)
+        return loss * tf.reshape(sample_weight, tf.shape(loss))
+
+plugins.append(WeightedBinaryCrossEntropyLoss)
+
 class MeanSquaredErrorLoss(Plugin, Loss):
     name: str = "Mean Squared Error Loss"
     description: str = "Mean Squared Error Loss"
@@ -50,9 +93,12 @@ class MeanSquaredErrorLoss(Plugin, Loss):
     
     def __init__(self):
         super().__init__()
-        self.mse = losses.MeanSquaredError()
+        # unreduced like the other loss plugins, keras reduces the losses
+        # (AUTO reduction fails inside a tf.distribute strategy)
+        self.mse = losses.MeanSquaredError(reduction=losses.Reduction.NONE)
         
     def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
         return self.mse(y_true, y_pred)
     
 plugins.append(MeanSquaredErrorLoss)
@@ -67,9 +113,10 @@ class MeanAbsoluteErrorLoss(Plugin, Loss):
     
     def __init__(self):
         super().__init__()
-        self.mae = losses.MeanAbsoluteError()
+        self.mae = losses.MeanAbsoluteError(reduction=losses.Reduction.NONE)
         
     def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
         return self.mae(y_true, y_pred)    
     
 plugins.append(MeanAbsoluteErrorLoss)
@@ -84,9 +131,10 @@ class MeanAbsolutePercentageErrorLoss(Plugin, Loss):
     
     def __init__(self):
         super().__init__()
-        self.mape = losses.MeanAbsolutePercentageError()
+        self.mape = losses.MeanAbsolutePercentageError(reduction=losses.Reduction.NONE)
         
     def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
         return self.mape(y_true, y_pred)
     
 plugins.append(MeanAbsolutePercentageErrorLoss)
@@ -100,9 +148,10 @@ class MeanSquaredLogarithmicErrorLoss(Plugin, Loss):
     
     def __init__(self):
         super().__init__()
-        self.msle = losses.MeanSquaredLogarithmicError()
+        self.msle = losses.MeanSquaredLogarithmicError(reduction=losses.Reduction.NONE)
         
     def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
         return self.msle(y_true, y_pred)
     
 plugins.append(MeanSquaredLogarithmicErrorLoss)
@@ -124,6 +173,7 @@ class CosineSimilarityLoss(Plugin, Loss):
     axis: int
 
     def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
         return losses.cosine_similarity(y_true, y_pred, axis=self.axis)
     
     
@@ -138,11 +188,123 @@ class HingeLoss(Plugin, Loss):
     parameters: list[PluginParameter] = []
     
     def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
         return losses.hinge(y_true, y_pred)
     
     
 plugins.append(HingeLoss)
 
 
+class CompoundSegmentationLoss(Plugin, Loss):
+    """Weighted binary cross entropy plus soft Dice/Tversky loss, computed in one fused reduction.
+    
+    The per-voxel terms (cross entropy, y_true * y_pred, y_true, y_pred) are
+    reduced over the batch and the spatial axes from the same inputs, under
+    XLA in one fused pass without intermediate full-size tensors.
+    The Dice/Tversky term is computed over the whole batch for every class
+    (the last axis), both terms are averaged over the classes with
+    class_weights.
+    """
+    name: str = "Compound Segmentation Loss"
+    description: str = "Fused weighted binary cross entropy and soft Dice/Tversky loss"
+    type: PluginType = PluginType.LOSS
+    path: str = "losses.compound_segmentation_loss"
+    parameters: list[PluginParameter] = [
+        PluginParameter(name="from_logits",
+                        description="Whether y_pred are logits, otherwise probabilities.",
+                        type=bool,
+                        default=False,
+                        path="losses.compound_segmentation_loss.from_logits"),
+        PluginParameter(name="bce_weight",
+                        description="Weight of the binary cross entropy term.",
+                        type=float,
+                        default=1.0,
+                        path="losses.compound_segmentation_loss.bce_weight"),
+        PluginParameter(name="dice_weight",
+                        description="Weight of the soft Dice/Tversky term.",
+                        type=float,
+                        default=1.0,
+                        path="losses.compound_segmentation_loss.dice_weight"),
+        PluginParameter(name="alpha",
+                        description="Tversky weight of the false positives, alpha = beta = 0.5 is the soft Dice loss.",
+                        type=float,
+                        default=0.5,
+                        path="losses.compound_segmentation_loss.alpha"),
+        PluginParameter(name="beta",
+                        description="Tversky weight of the false negatives.",
+                        type=float,
+                        default=0.5,
+                        path="losses.compound_segmentation_loss.beta"),
+        PluginParameter(name="class_weights",
+                        description="Weight of every class (last axis), if None all the classes weigh the same.",
+                        type=list,
+                        default=None,
+                        path="losses.compound_segmentation_loss.class_weights"),
+        PluginParameter(name="smooth",
+                        description="Smoothing term of the Dice/Tversky ratio.",
+                        type=float,
+                        default=1e-5,
+                        path="losses.compound_segmentation_loss.smooth"),
+        PluginParameter(name="jit_compile",
+                        description="Compile the loss with XLA.",
+                        type=bool,
+                        default=True,
+                        path="losses.compound_segmentation_loss.jit_compile"),
+    ]
+    
+    from_logits: bool
+    bce_weight: float
+    dice_weight: float
+    alpha: float
+    beta: float
+    class_weights: Optional[list]
+    smooth: float
+    jit_compile: bool
+    
+    def __init__(self):
+        super().__init__()
+        self._kernel = None
+        self._kernel_key = None
+    
+    def _compute(self, y_true: tf.Tensor, y_pred: tf.Tensor) -> tf.Tensor:
+        n_classes = y_pred.shape[-1]
+        # voxels x classes views of the inputs (no copy), reduced over the voxels
+        y_true = tf.reshape(y_true, [-1, n_classes])
+        y_pred = tf.reshape(y_pred, [-1, n_classes])
+        if self.from_logits:
+            probabilities = tf.sigmoid(y_pred)
+            # numerically stable cross entropy from logits
+            bce = tf.maximum(y_pred, 0.) - y_pred * y_true + tf.math.log1p(tf.exp(-tf.abs(y_pred)))
+        else:
+            epsilon = keras.backend.epsilon()
+            probabilities = tf.clip_by_value(y_pred, epsilon, 1. - epsilon)
+            bce = -(y_true * tf.math.log(probabilities) + (1. - y_true) * tf.math.log(1. - probabilities))
+        # reductions of the same elementwise producers, fused by XLA in a single pass
+        bce_mean = tf.reduce_mean(bce, axis=0)
+        true_positives = tf.reduce_sum(y_true * probabilities, axis=0)
+        false_positives = tf.reduce_sum(probabilities, axis=0) - true_positives
+        false_negatives = tf.reduce_sum(y_true, axis=0) - true_positives
+        tversky = (true_positives + self.smooth) / (true_positives + self.alpha * false_positives + self.beta * false_negatives + self.smooth)
+        per_class = self.bce_weight * bce_mean + self.dice_weight * (1. - tversky)
+        class_weights = tf.ones([n_classes]) if self.class_weights is None else tf.constant(self.class_weights, tf.float32)
+        return tf.reduce_sum(per_class * class_weights) / tf.reduce_sum(class_weights)
+    
+    def _get_kernel(self):
+        # the kernel is traced with the parameter values, retraced if they change
+        key = (self.from_logits, self.bce_weight, self.dice_weight, self.alpha, self.beta,
+               tuple(self.class_weights or ()), self.smooth, self.jit_compile)
+        if self._kernel is None or self._kernel_key != key:
+            self._kernel = tf.function(self._compute, jit_compile=self.jit_compile)
+            self._kernel_key = key
+        return self._kernel
+    
+    def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
+        return self._get_kernel()(y_true, y_pred)
+    
+    
+plugins.append(CompoundSegmentationLoss)
+
+
 for plugin in plugins:
     register_plugin(plugin)
\ No newline at end of file
@@ -1 +1,2 @@
-from neurosegmenter.metrics.metric import Metric, Loss
\ No newline at end of file
+from neurosegmenter.metrics.metric import Metric
+from neurosegmenter.metrics.streaming import ConfusionCounts, StreamingKerasMetric, StreamingMetric, mask_dice, volume_confusion_counts
\ No newline at end of file
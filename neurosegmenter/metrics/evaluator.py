@@ -0,0 +1,157 @@
+"""Single pass evaluation of several metric plugins.
+
+Every metric plugin re-reads and re-thresholds the same tensors when called
+on its own. The FusedMetricEvaluator instead traces the supported metrics
+into one (XLA compiled) function where thresholded predictions and sums are
+computed once and shared between the metrics.
+Metrics without a fused kernel are called as usual after the fused pass.
+"""
+from typing import Any, Callable, Union
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from keras import backend as K
+from keras import metrics
+
+from neurosegmenter.metrics.streaming import ConfusionCounts, StreamingMetric
+from neurosegmenter.metrics import metrics as metric_plugins
+from neurosegmenter.plugins import LazyPlugin
+
+Tensor = Union[tf.Tensor, np.ndarray]
+
+class SharedTerms:
+    """Terms shared between metrics, computed once per traced batch."""
+
+    def __init__(self, y_true: tf.Tensor, y_pred: tf.Tensor) -> None:
+        self.y_true = y_true
+        self.y_pred = y_pred
+        self._cache: dict[Any, tf.Tensor] = {}
+
+    def memoize(self, key: Any, fn: Callable[[], tf.Tensor]) -> tf.Tensor:
+        if key not in self._cache:
+            self._cache[key] = fn()
+        return self._cache[key]
+
+    def binarized(self, threshold: float) -> tf.Tensor:
+        """y_pred > threshold, as float."""
+        return self.memoize(("binarized", threshold),
+                            lambda: tf.cast(self.y_pred > threshold, self.y_pred.dtype))
+
+    def soft_sums(self) -> tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+        """sum(y_true * y_pred), sum(y_true), sum(y_pred) over the whole batch."""
+        return self.memoize("soft_sums", lambda: (K.sum(self.y_true * self.y_pred), K.sum(self.y_true), K.sum(self.y_pred)))
+
+    def per_class_overlap(self, threshold: float) -> tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+        """Per-class intersection, sum(y_true) and sum(y_pred), each [batch, classes]."""
+        return self.memoize(("per_class_overlap", threshold),
+                            lambda: metric_plugins.per_class_overlap(self.y_true, self.y_pred, threshold))
+
+    def counts(self, threshold: float) -> tf.Tensor:
+        """[tp, fp, fn, tn] of y_true > 0.5 against y_pred > threshold."""
+        def count() -> tf.Tensor:
+            true = self.y_true > 0.5
+            pred = self.y_pred > threshold
+            tp = tf.math.count_nonzero(true & pred)
+            n_true = tf.math.count_nonzero(true)
+            n_pred = tf.math.count_nonzero(pred)
+            size = tf.size(true, out_type=tf.int64)
+            return tf.stack([tp, n_pred - tp, n_true - tp, size - n_true - n_pred + tp])
+        return self.memoize(("counts", threshold), count)
+
+FusedKernel = Callable[[SharedTerms], tf.Tensor]
+
+# plugin class -> factory building the fused kernel of a plugin instance
+fused_kernels: dict[type, Callable[[Any], FusedKernel]] = {}
+
+def register_fused_kernel(plugin_class: type) -> Callable:
+    """Decorator registering the fused kernel factory of a metric plugin class."""
+    def decorator(factory: Callable[[Any], FusedKernel]) -> Callable[[Any], FusedKernel]:
+        fused_kernels[plugin_class] = factory
+        return factory
+    return decorator
+
+@register_fused_kernel(metric_plugins.BinaryAccuracy)
+def _binary_accuracy(plugin: Any) -> FusedKernel:
+    return lambda terms: K.mean(tf.cast(tf.equal(terms.y_true, terms.binarized(plugin.threshold)), terms.y_pred.dtype), axis=-1)
+
+@register_fused_kernel(metric_plugins.CategoricalAccuracy)
+def _categorical_accuracy(plugin: Any) -> FusedKernel:
+    return lambda terms: metrics.categorical_accuracy(terms.y_true, terms.y_pred)
+
+@register_fused_kernel(metric_plugins.JaccardIndex)
+def _jaccard_index(plugin: Any) -> FusedKernel:
+    def kernel(terms: SharedTerms) -> tf.Tensor:
+        intersection, sum_true, sum_pred = terms.soft_sums()
+        return intersection / (sum_true + sum_pred - intersection + K.epsilon())
+    return kernel
+
+@register_fused_kernel(metric_plugins.DiceCoefficient)
+def _dice_coefficient(plugin: Any) -> FusedKernel:
+    def kernel(terms: SharedTerms) -> tf.Tensor:
+        intersection, sum_true, sum_pred = terms.soft_sums()
+        return (2. * intersection) / (sum_true + sum_pred + K.epsilon())
+    return kernel
+
+@register_fused_kernel(metric_plugins.BinaryCrossEntropy)
+def _binary_cross_entropy(plugin: Any) -> FusedKernel:
+    return lambda terms: metrics.binary_crossentropy(terms.y_true, terms.y_pred,
+                                                     from_logits=plugin.from_logits,
+                                                     label_smoothing=plugin.label_smoothing,
+                                                     axis=plugin.axis)
+
+@register_fused_kernel(metric_plugins.PerClassDiceCoefficient)
+def _per_class_dice_coefficient(plugin: Any) -> FusedKernel:
+    def kernel(terms: SharedTerms) -> tf.Tensor:
+        intersection, sum_true, sum_pred = terms.per_class_overlap(plugin.threshold)
+        return metric_plugins.average_per_class(2. * intersection, sum_true + sum_pred, plugin.average, plugin.ignore_index, plugin.smooth)
+    return kernel
+
+@register_fused_kernel(metric_plugins.PerClassJaccardIndex)
+def _per_class_jaccard_index(plugin: Any) -> FusedKernel:
+    def kernel(terms: SharedTerms) -> tf.Tensor:
+        intersection, sum_true, sum_pred = terms.per_class_overlap(plugin.threshold)
+        return metric_plugins.average_per_class(intersection, sum_true + sum_pred - intersection, plugin.average, plugin.ignore_index, plugin.smooth)
+    return kernel
+
+@register_fused_kernel(metric_plugins.StreamingJaccardIndex)
+@register_fused_kernel(metric_plugins.StreamingDiceCoefficient)
+def _streaming_counts(plugin: Any) -> FusedKernel:
+    # the counters are merged into the plugin after the fused pass
+    return lambda terms: terms.counts(plugin.threshold)
+
+class FusedMetricEvaluator:
+    """Computes a set of metric plugins in one fused pass per batch.
+
+    metrics: metric plugin instances (or registry entries / classes, which
+        are instantiated with their default parameters).
+    Returns a dict keyed by plugin name. Streaming metrics are updated with the
+    batch counters and report their running result.
+    """
+
+    def __init__(self, metrics: list[Any], jit_compile: bool = True) -> None:
+        self.metrics = [metric() if isinstance(metric, (type, LazyPlugin)) else metric for metric in metrics]
+        self.kernels: dict[str, FusedKernel] = {}
+        self.fallback: dict[str, Any] = {}
+        for metric in self.metrics:
+            factory = fused_kernels.get(type(metric))
+            if factory is None:
+                self.fallback[metric.name] = metric
+            else:
+                self.kernels[metric.name] = factory(metric)
+        self._fused = tf.function(self._fused_pass, jit_compile=jit_compile)
+
+    def _fused_pass(self, y_true: tf.Tensor, y_pred: tf.Tensor) -> dict[str, tf.Tensor]:
+        y_pred = tf.cast(y_pred, tf.float32)
+        terms = SharedTerms(tf.cast(y_true, y_pred.dtype), y_pred)
+        return {name: kernel(terms) for name, kernel in self.kernels.items()}
+
+    def __call__(self, y_true: Tensor, y_pred: Tensor) -> dict[str, Any]:
+        results: dict[str, Any] = self._fused(y_true, y_pred) if self.kernels else {}
+        for metric in self.metrics:
+            if isinstance(metric, StreamingMetric) and metric.name in self.kernels:
+                metric.merge(ConfusionCounts(*(int(count) for count in results[metric.name].numpy())))
+                results[metric.name] = metric.result()
+        for name, metric in self.fallback.items():
+            results[name] = metric(y_true, y_pred)
+        return {metric.name: results[metric.name] for metric in self.metrics}
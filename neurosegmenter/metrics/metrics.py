@@ -1,10 +1,13 @@
 from neurosegmenter.metrics import Metric
+from neurosegmenter.losses import cast_to_float32
+from neurosegmenter.metrics.streaming import StreamingMetric, ConfusionCounts
 from neurosegmenter.plugins import Plugin, PluginType, PluginParameter
 from neurosegmenter.plugins import register_plugin
 from tensorflow import keras
 from keras import backend as K
 from keras import metrics
 import numpy as np
+import tensorflow as tf
 
 plugins = []
 
@@ -24,6 +27,7 @@ class BinaryAccuracy(Plugin, Metric):
     threshold: float
     
     def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
         return metrics.binary_accuracy(y_true, y_pred, threshold=self.threshold)
 
 plugins.append(BinaryAccuracy)
@@ -37,6 +41,7 @@ class CategoricalAccuracy(Plugin, Metric):
     parameters: list[PluginParameter] = []
     
     def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
         return metrics.categorical_accuracy(y_true, y_pred)
 
 plugins.append(CategoricalAccuracy)
@@ -49,11 +54,11 @@ class JaccardIndex(Plugin, Metric):
     parameters: list[PluginParameter] = []
     
     def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
-        y_true_flat = K.flatten(y_true)
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
         y_pred_flat = K.flatten(y_pred)
+        y_true_flat = K.cast(K.flatten(y_true), y_pred_flat.dtype)
         
-        dot_product = K.dot(y_true_flat, y_pred_flat)
-        intersection = K.sum(dot_product)
+        intersection = K.sum(y_true_flat * y_pred_flat)
         union = K.sum(y_true_flat) + K.sum(y_pred_flat) - intersection
         
         iou = intersection / (union + K.epsilon()) # add epsilon to avoid division by zero
@@ -69,11 +74,11 @@ class DiceCoefficient(Plugin, Metric):
     parameters: list[PluginParameter] = []
     
     def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
-        y_true_flat = K.flatten(y_true)
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
         y_pred_flat = K.flatten(y_pred)
+        y_true_flat = K.cast(K.flatten(y_true), y_pred_flat.dtype)
         
-        dot_product = K.dot(y_true_flat, y_pred_flat)
-        intersection = K.sum(dot_product)
+        intersection = K.sum(y_true_flat * y_pred_flat)
         union = K.sum(y_true_flat) + K.sum(y_pred_flat)
         
         dice = (2. * intersection) / (union + K.epsilon()) # add epsilon to avoid division by zero
@@ -110,10 +115,201 @@ class BinaryCrossEntropy(Plugin, Metric):
     axis: int
 
     def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
         return metrics.binary_crossentropy(y_true, y_pred, from_logits=self.from_logits, label_smoothing=self.label_smoothing, axis=self.axis)
 
 plugins.append(BinaryCrossEntropy)
 
 
+class StreamingJaccardIndex(StreamingMetric, Plugin, Metric):
+    """Jaccard index accumulated over batches through TP/FP/FN counters.
+    
+    Unlike JaccardIndex, averaging over batches is exact and whole volumes
+    can be evaluated in constant memory with update_volume().
+    """
+    name: str = "Streaming Jaccard Index"
+    description: str = "Jaccard Index accumulated over batches"
+    type: PluginType = PluginType.METRIC
+    path: str = "metrics.streaming_jaccard_index"
+    parameters: list[PluginParameter] = [
+        PluginParameter(name ="threshold",
+                        description = "Float representing the threshold used to binarize the predictions.",
+                        type = float,
+                        default = 0.5,
+                        path = "metrics.streaming_jaccard_index.threshold"),
+    ]
+    
+    threshold: float
+    
+    def __init__(self):
+        super().__init__()
+        self.reset()
+    
+    def score(self, counts: ConfusionCounts) -> float:
+        return counts.tp / (counts.tp + counts.fp + counts.fn + K.epsilon())
+
+plugins.append(StreamingJaccardIndex)
+
+
+class StreamingDiceCoefficient(StreamingMetric, Plugin, Metric):
+    """Dice coefficient accumulated over batches through TP/FP/FN counters.
+    
+    Unlike DiceCoefficient, averaging over batches is exact and whole volumes
+    can be evaluated in constant memory with update_volume().
+    """
+    name: str = "Streaming Dice Coefficient"
+    description: str = "Dice Coefficient accumulated over batches"
+    type: PluginType = PluginType.METRIC
+    path: str = "metrics.streaming_dice_coefficient"
+    parameters: list[PluginParameter] = [
+        PluginParameter(name ="threshold",
+                        description = "Float representing the threshold used to binarize the predictions.",
+                        type = float,
+                        default = 0.5,
+                        path = "metrics.streaming_dice_coefficient.threshold"),
+    ]
+    
+    threshold: float
+    
+    def __init__(self):
+        super().__init__()
+        self.reset()
+    
+    def score(self, counts: ConfusionCounts) -> float:
+        return 2. * counts.tp / (2. * counts.tp + counts.fp + counts.fn + K.epsilon())
+
+plugins.append(StreamingDiceCoefficient)
+
+
+
+def per_class_overlap(y_true: np.ndarray, y_pred: np.ndarray, threshold: float = None) -> tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+    """Intersection, sum of y_true and sum of y_pred of [batch, ..., classes] tensors.
+    
+    Reduces over the spatial axes only, each output is [batch, classes].
+    If threshold is None the soft (probability) overlap is computed.
+    """
+    y_pred = tf.convert_to_tensor(y_pred)
+    if not y_pred.dtype.is_floating:
+        y_pred = tf.cast(y_pred, tf.float32)
+    y_true = tf.cast(y_true, y_pred.dtype)
+    if threshold is not None:
+        y_pred = tf.cast(y_pred > threshold, y_pred.dtype)
+    spatial_axes = list(range(1, len(y_pred.shape) - 1))
+    intersection = tf.reduce_sum(y_true * y_pred, axis=spatial_axes)
+    return intersection, tf.reduce_sum(y_true, axis=spatial_axes), tf.reduce_sum(y_pred, axis=spatial_axes)
+
+def average_per_class(numerator: tf.Tensor, denominator: tf.Tensor, average: str, ignore_index: int = None, smooth: float = 1e-5) -> tf.Tensor:
+    """Per-class ratio of [batch, classes] terms, averaged according to average.
+    
+    "none" returns [batch, classes] scores, "macro" the mean of the per-class
+    scores and "micro" the ratio of the terms summed over the classes, both
+    [batch]. The ignore_index class is left out.
+    """
+    if ignore_index is not None:
+        n_classes = numerator.shape[-1]
+        keep = [c for c in range(n_classes) if c != ignore_index % n_classes]
+        numerator = tf.gather(numerator, keep, axis=-1)
+        denominator = tf.gather(denominator, keep, axis=-1)
+    if average == "micro":
+        return (tf.reduce_sum(numerator, axis=-1) + smooth) / (tf.reduce_sum(denominator, axis=-1) + smooth)
+    scores = (numerator + smooth) / (denominator + smooth)
+    if average == "macro":
+        return tf.reduce_mean(scores, axis=-1)
+    if average == "none":
+        return scores
+    raise ValueError(f"Unknown average '{average}', expected 'macro', 'micro' or 'none'")
+
+
+class PerClassDiceCoefficient(Plugin, Metric):
+    """Dice coefficient of [batch, ..., classes] tensors, per sample and per class.
+    
+    All classes are reduced in a single vectorized op over the spatial axes.
+    """
+    name: str = "Per Class Dice Coefficient"
+    description: str = "Per-class and multi-label Dice Coefficient"
+    type: PluginType = PluginType.METRIC
+    path: str = "metrics.per_class_dice_coefficient"
+    parameters: list[PluginParameter] = [
+        PluginParameter(name ="average",
+                        description = "'macro' (mean of the class scores), 'micro' (score of the summed counts) or 'none' (per-class scores).",
+                        type = str,
+                        default = "macro",
+                        path = "metrics.per_class_dice_coefficient.average"),
+        PluginParameter(name ="ignore_index",
+                        description = "Index of a class (e.g. background) left out of the scores, None keeps all the classes.",
+                        type = int,
+                        default = None,
+                        path = "metrics.per_class_dice_coefficient.ignore_index"),
+        PluginParameter(name ="threshold",
+                        description = "Threshold used to binarize the predictions, None computes the soft Dice.",
+                        type = float,
+                        default = None,
+                        path = "metrics.per_class_dice_coefficient.threshold"),
+        PluginParameter(name ="smooth",
+                        description = "Smoothing term added to numerator and denominator, empty classes score 1.",
+                        type = float,
+                        default = 1e-5,
+                        path = "metrics.per_class_dice_coefficient.smooth"),
+    ]
+    
+    average: str
+    ignore_index: int
+    threshold: float
+    smooth: float
+    
+    def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
+        intersection, sum_true, sum_pred = per_class_overlap(y_true, y_pred, self.threshold)
+        return average_per_class(2. * intersection, sum_true + sum_pred, self.average, self.ignore_index, self.smooth)
+
+plugins.append(PerClassDiceCoefficient)
+
+
+class PerClassJaccardIndex(Plugin, Metric):
+    """Jaccard index of [batch, ..., classes] tensors, per sample and per class.
+    
+    All classes are reduced in a single vectorized op over the spatial axes.
+    """
+    name: str = "Per Class Jaccard Index"
+    description: str = "Per-class and multi-label Jaccard Index"
+    type: PluginType = PluginType.METRIC
+    path: str = "metrics.per_class_jaccard_index"
+    parameters: list[PluginParameter] = [
+        PluginParameter(name ="average",
+                        description = "'macro' (mean of the class scores), 'micro' (score of the summed counts) or 'none' (per-class scores).",
+                        type = str,
+                        default = "macro",
+                        path = "metrics.per_class_jaccard_index.average"),
+        PluginParameter(name ="ignore_index",
+                        description = "Index of a class (e.g. background) left out of the scores, None keeps all the classes.",
+                        type = int,
+                        default = None,
+                        path = "metrics.per_class_jaccard_index.ignore_index"),
+        PluginParameter(name ="threshold",
+                        description = "Threshold used to binarize the predictions, None computes the soft Jaccard index.",
+                        type = float,
+                        default = None,
+                        path = "metrics.per_class_jaccard_index.threshold"),
+        PluginParameter(name ="smooth",
+                        description = "Smoothing term added to numerator and denominator, empty classes score 1.",
+                        type = float,
+                        default = 1e-5,
+                        path = "metrics.per_class_jaccard_index.smooth"),
+    ]
+    
+    average: str
+    ignore_index: int
+    threshold: float
+    smooth: float
+    
+    def __call__(self, y_true: np.ndarray, y_pred: np.ndarray) -> np.ndarray:
+        y_true, y_pred = cast_to_float32(y_true, y_pred)
+        intersection, sum_true, sum_pred = per_class_overlap(y_true, y_pred, self.threshold)
+        return average_per_class(intersection, sum_true + sum_pred - intersection, self.average, self.ignore_index, self.smooth)
+
+plugins.append(PerClassJaccardIndex)
+
+
+
 for plugin in plugins:
     register_plugin(plugin)
\ No newline at end of file
@@ -0,0 +1,149 @@
+"""Confusion counters for metrics accumulated over batches, tiles and processes."""
+from __future__ import annotations
+
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Any, Optional, Sequence, Union
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from neurosegmenter.volumes import open_volume, block_grid
+
+@dataclass
+class ConfusionCounts:
+    """Binary confusion matrix counters, mergeable with +."""
+    tp: int = 0
+    fp: int = 0
+    fn: int = 0
+    tn: int = 0
+
+    def __add__(self, other: ConfusionCounts) -> ConfusionCounts:
+        return ConfusionCounts(self.tp + other.tp, self.fp + other.fp, self.fn + other.fn, self.tn + other.tn)
+
+    @property
+    def total(self) -> int:
+        return self.tp + self.fp + self.fn + self.tn
+
+    def to_dict(self) -> dict[str, int]:
+        return asdict(self)
+
+    @classmethod
+    def from_arrays(cls, y_true: Any, y_pred: Any, threshold: float = 0.5) -> ConfusionCounts:
+        """Count a batch, the positives are y_true > 0.5 and y_pred > threshold."""
+        true = np.asarray(y_true) > 0.5
+        pred = np.asarray(y_pred) > threshold
+        tp = int(np.count_nonzero(true & pred))
+        n_true = int(np.count_nonzero(true))
+        n_pred = int(np.count_nonzero(pred))
+        fp = n_pred - tp
+        fn = n_true - tp
+        return cls(tp=tp, fp=fp, fn=fn, tn=true.size - tp - fp - fn)
+
+def mask_dice(a: Any, b: Any) -> float:
+    """Dice coefficient of two boolean masks, 1 if both are empty."""
+    a, b = np.asarray(a, dtype=bool), np.asarray(b, dtype=bool)
+    denominator = int(np.count_nonzero(a)) + int(np.count_nonzero(b))
+    return 2 * int(np.count_nonzero(a & b)) / denominator if denominator else 1.0
+
+def _block_counts(y_true: Any, y_pred: Any, region: tuple[slice, ...], threshold: float) -> ConfusionCounts:
+    if isinstance(y_true, (str, Path)):
+        y_true, y_pred = open_volume(y_true), open_volume(y_pred)
+    return ConfusionCounts.from_arrays(y_true[region], y_pred[region], threshold)
+
+def volume_confusion_counts(y_true: Union[str, Path, Any],
+                            y_pred: Union[str, Path, Any],
+                            threshold: float = 0.5,
+                            block_shape: Optional[Sequence[int]] = None,
+                            num_workers: Optional[int] = None) -> ConfusionCounts:
+    """Confusion counts of two whole volumes, computed block by block in parallel.
+
+    Volumes given as paths are counted in a process pool (each worker memory
+    maps them), in-memory array-likes in a thread pool.
+    Memory is bounded by num_workers blocks.
+    """
+    use_processes = isinstance(y_true, (str, Path)) and isinstance(y_pred, (str, Path))
+    shape = (open_volume(y_true) if use_processes else y_true).shape
+    if block_shape is None:
+        # slabs along the first axis
+        block_shape = (max(1, 2 ** 24 // max(int(np.prod(shape[1:])), 1)),) + tuple(shape[1:])
+    num_workers = num_workers or os.cpu_count() or 1
+    pool: Executor = ProcessPoolExecutor(num_workers) if use_processes else ThreadPoolExecutor(num_workers)
+    counts = ConfusionCounts()
+    with pool:
+        futures = [pool.submit(_block_counts, y_true, y_pred, region, threshold)
+                   for region in block_grid(shape[:len(block_shape)], block_shape)]
+        for future in futures:
+            counts += future.result()
+    return counts
+
+class StreamingMetric:
+    """Mixin for metrics keeping confusion counters across update() calls.
+
+    update() accumulates a batch, result() computes the metric over everything
+    seen since the last reset(), merge() adds the counters of another instance
+    (e.g. from a different worker process).
+    The counters are python integers updated from numpy arrays, so update(),
+    result() and __call__ are eager only. In graphs (tf.function, keras
+    compile, the trainer) use keras_metric(), which keeps the counters in
+    tf.Variables.
+    """
+    threshold: float
+    counts: ConfusionCounts
+
+    def reset(self) -> None:
+        self.counts = ConfusionCounts()
+
+    def update(self, y_true: Any, y_pred: Any) -> None:
+        self.counts += ConfusionCounts.from_arrays(y_true, y_pred, self.threshold)
+
+    def update_volume(self, y_true: Any, y_pred: Any, block_shape: Optional[Sequence[int]] = None, num_workers: Optional[int] = None) -> None:
+        self.counts += volume_confusion_counts(y_true, y_pred, self.threshold, block_shape, num_workers)
+
+    def merge(self, other: Union[StreamingMetric, ConfusionCounts]) -> None:
+        self.counts += other.counts if isinstance(other, StreamingMetric) else other
+
+    def score(self, counts: ConfusionCounts) -> float:
+        raise NotImplementedError
+
+    def result(self) -> float:
+        return self.score(self.counts)
+
+    def keras_metric(self, name: Optional[str] = None) -> StreamingKerasMetric:
+        return StreamingKerasMetric(self, name)
+
+    def __call__(self, y_true: Any, y_pred: Any) -> float:
+        self.update(y_true, y_pred)
+        return self.result()
+
+
+class StreamingKerasMetric(keras.metrics.Metric):
+    """keras metric of a StreamingMetric plugin, the counters are tf.Variables.
+
+    Works in graphs and under distribution strategies (the counters are
+    summed over the replicas), keras resets them at every epoch. result()
+    is the score() of the plugin over the counters.
+    """
+
+    def __init__(self, plugin: StreamingMetric, name: Optional[str] = None, **kwargs: Any) -> None:
+        super().__init__(name=name or getattr(plugin, "name", None), **kwargs)
+        self.plugin = plugin
+        # float64 counts voxels exactly up to 2 ** 53
+        self.counters = [self.add_weight(name=counter, initializer="zeros", dtype=tf.float64)
+                         for counter in ("tp", "fp", "fn", "tn")]
+
+    def update_state(self, y_true: Any, y_pred: Any, sample_weight: Any = None) -> None:
+        true = tf.cast(y_true, tf.float32) > 0.5
+        pred = tf.cast(y_pred, tf.float32) > self.plugin.threshold
+        tp = tf.math.count_nonzero(true & pred, dtype=tf.float64)
+        n_true = tf.math.count_nonzero(true, dtype=tf.float64)
+        n_pred = tf.math.count_nonzero(pred, dtype=tf.float64)
+        size = tf.cast(tf.size(true), tf.float64)
+        for counter, count in zip(self.counters, (tp, n_pred - tp, n_true - tp, size - n_true - n_pred + tp)):
+            counter.assign_add(count)
+
+    def result(self) -> tf.Tensor:
+        return tf.cast(self.plugin.score(ConfusionCounts(*self.counters)), tf.float32)
@@ -1,2 +1,4 @@
 from neurosegmenter.models.model import TrainableModel
-from neurosegmenter.models.simple_model import SimpleModelFromKerasFunctional, SimpleModelFromKerasModelClass
\ No newline at end of file
+from neurosegmenter.models.simple_model import SimpleModelFromKerasFunctional, SimpleModelFromKerasModelClass
+from neurosegmenter.models.cache import ModelCache
+from neurosegmenter.models.precision import PRECISION_POLICIES, precision_policy, loss_scale_optimizer, compare_precision
\ No newline at end of file
@@ -0,0 +1,146 @@
+"""Content-addressed cache of built models.
+
+Models are keyed by the plugin class, the hash of its parameter values and
+the hash of the source of the plugin module (plus the optional version
+attribute of the plugin), so editing the architecture invalidates the cache.
+An in-process LRU keeps the built keras models (and their traced functions),
+an on-disk store keeps them as SavedModels. Inference functions are stored
+as serving SavedModels with a fixed input signature and restored with
+tf.saved_model.load, so a fresh worker runs the traced graph instead of
+rebuilding the model from python and tracing it again.
+"""
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional, Sequence, Union
+
+import tensorflow as tf
+from tensorflow import keras
+from keras import Model
+
+from neurosegmenter.config import config_hash, get_cache_dir, plugin_hash, source_hash
+
+class ModelCache:
+    """LRU of built models with an optional on-disk SavedModel store.
+
+    The same model object is returned for equal plugin parameters, don't use
+    cached models for independent training runs. The disk store holds the
+    model as it was when put (freshly built by get_model, or trained and
+    stored with put). Models loaded from the disk store by get_model are
+    rebuilt by keras from their config, get_inference_function loads the
+    traced graph only.
+    """
+
+    def __init__(self, max_models: int = 8, cache_dir: Optional[Union[str, Path]] = None, use_disk: bool = True) -> None:
+        self.max_models = max_models
+        self.cache_dir = Path(cache_dir) if cache_dir else get_cache_dir("models")
+        self.use_disk = use_disk
+        self._models: OrderedDict[str, Model] = OrderedDict()
+        self._functions: dict[tuple[str, str], Any] = {}
+        self._lock = threading.RLock()
+
+    def key(self, plugin: Any) -> str:
+        return config_hash({"plugin": plugin_hash(plugin),
+                            "source": source_hash(plugin),
+                            "version": getattr(plugin, "version", None)})
+
+    def _disk_path(self, key: str) -> Path:
+        return self.cache_dir / key
+
+    def _serving_path(self, function_key: tuple[str, str]) -> Path:
+        key, signature = function_key
+        return self.cache_dir / f"{key}.serving-{signature[:16]}"
+
+    def _forget_functions(self, key: str) -> None:
+        self._functions = {k: f for k, f in self._functions.items() if k[0] != key}
+
+    def _remember(self, key: str, model: Model) -> None:
+        self._models[key] = model
+        self._models.move_to_end(key)
+        while len(self._models) > self.max_models:
+            evicted, _ = self._models.popitem(last=False)
+            self._forget_functions(evicted)
+
+    def _write(self, path: Path, save: Any) -> None:
+        """Write a SavedModel with save(tmp_path), replacing path atomically."""
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            save(tmp_path)
+            if path.exists():
+                shutil.rmtree(path)
+            os.replace(tmp_path, path)
+        except (ValueError, NotImplementedError, OSError):
+            # models that cannot be serialized (e.g. never called subclassed models) stay in memory only
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _save(self, key: str, model: Model) -> None:
+        # serving SavedModels of an earlier model of the key are stale
+        for path in self.cache_dir.glob(f"{key}.serving-*"):
+            shutil.rmtree(path, ignore_errors=True)
+        self._write(self._disk_path(key), lambda path: model.save(path, save_format="tf", include_optimizer=False))
+
+    def get_model(self, plugin: Any) -> Model:
+        """Model of a TrainableModel plugin instance, built only on a cache miss."""
+        key = self.key(plugin)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            path = self._disk_path(key)
+            if self.use_disk and path.exists():
+                model = keras.models.load_model(path, compile=False)
+            else:
+                model = plugin.get_model()
+                if self.use_disk:
+                    self._save(key, model)
+            self._remember(key, model)
+            return model
+
+    def put(self, plugin: Any, model: Model) -> None:
+        """Store a model (e.g. after training) under the key of a plugin instance."""
+        key = self.key(plugin)
+        with self._lock:
+            self._forget_functions(key)
+            self._remember(key, model)
+            if self.use_disk:
+                self._save(key, model)
+
+    def get_inference_function(self, plugin: Any, input_shape: Sequence[Optional[int]], dtype: tf.DType = tf.float32) -> Any:
+        """Inference function of the model for a given input shape, traced once per cache entry.
+
+        With the disk store the traced function is saved as a serving
+        SavedModel with the input signature, later processes load it with
+        tf.saved_model.load without building the model or tracing again.
+        """
+        key = self.key(plugin)
+        spec = tf.TensorSpec(input_shape, dtype)
+        function_key = (key, config_hash([list(input_shape), dtype.name]))
+        with self._lock:
+            if function_key in self._functions:
+                return self._functions[function_key]
+            path = self._serving_path(function_key)
+            if self.use_disk and path.exists():
+                serving = tf.saved_model.load(str(path))
+            else:
+                model = self.get_model(plugin)
+                serving = tf.Module()
+                serving.model = model
+                serving.infer = tf.function(lambda inputs: model(inputs, training=False), input_signature=[spec])
+                if self.use_disk:
+                    self._write(path, lambda tmp_path: tf.saved_model.save(serving, str(tmp_path),
+                                                                           signatures=serving.infer.get_concrete_function()))
+            self._functions[function_key] = serving.infer.get_concrete_function(spec)
+            return self._functions[function_key]
+
+    def clear(self, disk: bool = False) -> None:
+        with self._lock:
+            self._models.clear()
+            self._functions.clear()
+            if disk:
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._models)
@@ -0,0 +1,80 @@
+"""Reduced precision execution policies for model plugins.
+
+Policies are given to the layers (dtype=precision_policy(name)) when the
+model is built, the global keras policy is never changed, so models of
+different precisions can be built concurrently.
+"""
+import time
+from typing import Any, Optional, Sequence
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from keras import mixed_precision
+
+PRECISION_POLICIES = ("float32", "mixed_bfloat16", "mixed_float16")
+
+def precision_policy(name: str) -> mixed_precision.Policy:
+    """keras dtype policy of a precision name, to be passed as the dtype of the layers."""
+    if name not in PRECISION_POLICIES:
+        raise ValueError(f"Unknown precision policy '{name}', expected one of {PRECISION_POLICIES}")
+    return mixed_precision.Policy(name)
+
+def uses_float16(model: keras.Model) -> bool:
+    """Whether any layer of the model computes in float16."""
+    return any(layer.dtype_policy.compute_dtype == "float16"
+               for layer in [model] + list(model.submodules) if isinstance(layer, keras.layers.Layer))
+
+def loss_scale_optimizer(optimizer: Any, model: keras.Model) -> Any:
+    """The optimizer wrapped in a LossScaleOptimizer if the model computes in float16.
+
+    keras only adds loss scaling in compile() under a mixed_float16 global
+    policy, models built with per-layer policies (and custom training loops)
+    need the wrapper explicitly, or small float16 gradients underflow to zero.
+    """
+    if isinstance(optimizer, mixed_precision.LossScaleOptimizer) or not uses_float16(model):
+        return optimizer
+    return mixed_precision.LossScaleOptimizer(optimizer)
+
+def compare_precision(plugin: Any,
+                      batch: Any,
+                      policies: Sequence[str] = PRECISION_POLICIES,
+                      repeats: int = 10) -> dict[str, dict[str, float]]:
+    """Throughput and output drift of a model plugin under each policy, compared to float32.
+
+    The models of every policy share the float32 weights, so the drift only
+    comes from the reduced precision compute.
+    """
+    batch = tf.convert_to_tensor(batch)
+    original_precision = plugin.precision
+    reference: Optional[np.ndarray] = None
+    reference_weights = None
+    report = {}
+    try:
+        for policy in ("float32",) + tuple(p for p in policies if p != "float32"):
+            plugin.precision = policy
+            model = plugin.get_model()
+            predict = tf.function(lambda inputs: model(inputs, training=False))
+            # the first call builds the model (and traces the function)
+            predict(batch)
+            if reference_weights is None:
+                reference_weights = model.get_weights()
+            else:
+                model.set_weights(reference_weights)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                outputs = np.asarray(tf.cast(predict(batch), tf.float32))
+            seconds = (time.perf_counter() - start) / repeats
+            if reference is None:
+                reference = outputs
+            drift = np.abs(outputs - reference)
+            throughput = batch.shape[0] / seconds
+            report[policy] = {
+                "throughput": throughput,
+                "speedup": throughput / report["float32"]["throughput"] if report else 1.0,
+                "max_abs_drift": float(drift.max()),
+                "mean_abs_drift": float(drift.mean()),
+            }
+    finally:
+        plugin.precision = original_precision
+    return {policy: report[policy] for policy in policies if policy in report}
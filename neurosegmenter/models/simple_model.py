@@ -1,5 +1,6 @@
 import tensorflow as tf
 from neurosegmenter.models import TrainableModel
+from neurosegmenter.models.precision import precision_policy
 from neurosegmenter.plugins import Plugin
 from neurosegmenter.plugins import PluginType, PluginParameter
 
@@ -26,10 +27,16 @@ class SimpleModelFromKerasModelClass(TrainableModel, Plugin):
                         description="Activation function",
                         type=str,
                         default="relu",
-                        path="simple_model_from_keras_model.activation")
+                        path="simple_model_from_keras_model.activation"),
+        PluginParameter(name="precision",
+                        description="Compute precision policy: float32, mixed_bfloat16 or mixed_float16",
+                        type=str,
+                        default="float32",
+                        path="simple_model_from_keras_model.precision")
     ]
     
     activation: str
+    precision: str
     
     def createKerasModel(self):
         return SimpleModelFromKerasModelClass.SimpleKerasModel(self)
@@ -38,11 +45,13 @@ class SimpleModelFromKerasModelClass(TrainableModel, Plugin):
         """good ol' keras model class, but with a parent attribute in the constructor"""
         def __init__(self, parent): 
             self.parent = parent 
-            super().__init__()
-            self.conv1 = layers.Conv2D(32, 3, activation=self.parent.activation)
-            self.flatten = layers.Flatten()
-            self.d1 = layers.Dense(128, activation=self.parent.activation)
-            self.d2 = layers.Dense(10, activation='softmax')
+            policy = precision_policy(self.parent.precision)
+            super().__init__(dtype=policy)
+            self.conv1 = layers.Conv2D(32, 3, activation=self.parent.activation, dtype=policy)
+            self.flatten = layers.Flatten(dtype=policy)
+            self.d1 = layers.Dense(128, activation=self.parent.activation, dtype=policy)
+            # outputs are kept in float32 for numerical stability
+            self.d2 = layers.Dense(10, activation='softmax', dtype="float32")
         
         def call(self, x):
             x = self.conv1(x)
@@ -63,19 +72,27 @@ class SimpleModelFromKerasFunctional(TrainableModel, Plugin):
                         description="Activation function",
                         type=str,
                         default="relu",
-                        path="simple_model_from_keras_model.activation")
+                        path="simple_model_from_keras_model.activation"),
+        PluginParameter(name="precision",
+                        description="Compute precision policy: float32, mixed_bfloat16 or mixed_float16",
+                        type=str,
+                        default="float32",
+                        path="simple_model_from_keras_functional.precision")
     ]
     type: PluginType = PluginType.MODEL
     
     activation: str
+    precision: str
             
     def get_model(self) -> Model:
         """just a simple model with a single conv layer and a dense layer"""
+        policy = precision_policy(self.precision)
         inputs = layers.Input(shape=(None, None, 1))
-        processed = layers.RandomCrop(width=32, height=32)(inputs)
-        conv = layers.Conv2D(filters=2, kernel_size=3, activation=self.activation)(processed)
-        pooling = layers.GlobalAveragePooling2D()(conv)
-        feature = layers.Dense(10, activation=self.activation)(pooling)
+        processed = layers.RandomCrop(width=32, height=32, dtype=policy)(inputs)
+        conv = layers.Conv2D(filters=2, kernel_size=3, activation=self.activation, dtype=policy)(processed)
+        pooling = layers.GlobalAveragePooling2D(dtype=policy)(conv)
+        # outputs are kept in float32 for numerical stability
+        feature = layers.Dense(10, activation=self.activation, dtype="float32")(pooling)
         return Model(inputs, feature)
     
 
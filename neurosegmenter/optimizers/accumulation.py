@@ -0,0 +1,94 @@
+"""In-graph gradient accumulation for keras optimizers."""
+from typing import Any
+
+import tensorflow as tf
+from tensorflow import keras
+from keras import optimizers as keras_optimizers
+
+
+class GradientAccumulator(keras_optimizers.Optimizer):
+    """Wraps a keras optimizer, applying the mean of the gradients of accumulation_steps micro-batches.
+
+    Every apply_gradients() call adds the (clipped) micro-batch gradients to
+    accumulators with the shape of the variables, every accumulation_steps
+    calls the wrapped optimizer updates the variables with their mean and the
+    accumulators are reset. Everything happens in the train step graph, peak
+    memory is that of one micro-batch plus one copy of the trainable weights.
+    The gradient clipping settings of the wrapped optimizer are applied to
+    every micro-batch, its weight decay and learning rate schedule to every
+    accumulated update.
+    """
+
+    def __init__(self, optimizer: keras_optimizers.Optimizer, accumulation_steps: int = 4, name: str = "GradientAccumulator", **kwargs: Any) -> None:
+        if accumulation_steps < 1:
+            raise ValueError(f"accumulation_steps must be at least 1, got {accumulation_steps}")
+        super().__init__(name=name,
+                         clipnorm=optimizer.clipnorm,
+                         clipvalue=optimizer.clipvalue,
+                         global_clipnorm=optimizer.global_clipnorm,
+                         jit_compile=False,
+                         **kwargs)
+        self.optimizer = optimizer
+        self.accumulation_steps = accumulation_steps
+
+    @property
+    def learning_rate(self) -> Any:
+        return self.optimizer.learning_rate
+
+    @learning_rate.setter
+    def learning_rate(self, learning_rate: Any) -> None:
+        self.optimizer.learning_rate = learning_rate
+
+    def _compute_current_learning_rate(self) -> None:
+        # the learning rate is the one of the wrapped optimizer, updated when the accumulated gradients are applied
+        pass
+
+    def build(self, var_list: list[tf.Variable]) -> None:
+        super().build(var_list)
+        if hasattr(self, "_built") and self._built:
+            return
+        self.optimizer.build(var_list)
+        self._accumulators = [self.add_variable_from_reference(variable, "accumulator") for variable in var_list]
+        self._built = True
+
+    def _accumulator(self, variable: tf.Variable) -> tf.Variable:
+        return self._accumulators[self._index_dict[self._var_key(variable)]]
+
+    def _distributed_apply_gradients_fn(self, distribution: tf.distribute.Strategy, grads_and_vars: Any, **kwargs: Any) -> Any:
+        grads_and_vars = list(grads_and_vars)
+        for gradient, variable in grads_and_vars:
+            distribution.extended.update(self._accumulator(variable), lambda accumulator, g: accumulator.assign_add(g),
+                                         args=(gradient,), group=False)
+
+        def apply_accumulated() -> None:
+            optimizer = self.optimizer
+            optimizer._compute_current_learning_rate()
+            if optimizer.weight_decay is not None:
+                for _, variable in grads_and_vars:
+                    if optimizer._use_weight_decay(variable):
+                        distribution.extended.update(variable, lambda v: v.assign_sub(
+                            v * tf.cast(optimizer.weight_decay, v.dtype) * tf.cast(optimizer.learning_rate, v.dtype)), group=False)
+            mean_gradients = [(self._accumulator(variable) / self.accumulation_steps, variable) for _, variable in grads_and_vars]
+            optimizer._distributed_apply_gradients_fn(distribution, mean_gradients)
+            for _, variable in grads_and_vars:
+                distribution.extended.update(self._accumulator(variable), lambda accumulator: accumulator.assign(tf.zeros_like(accumulator)),
+                                             group=False)
+
+        tf.cond(tf.equal((self.iterations + 1) % self.accumulation_steps, 0), apply_accumulated, lambda: None)
+        return self.iterations.assign_add(1)
+
+    def update_step(self, gradient: tf.Tensor, variable: tf.Variable) -> None:
+        raise NotImplementedError("GradientAccumulator updates the variables through the wrapped optimizer")
+
+    def get_config(self) -> dict[str, Any]:
+        config = super().get_config()
+        config.update({"optimizer": keras_optimizers.serialize(self.optimizer), "accumulation_steps": self.accumulation_steps})
+        return config
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any], custom_objects: Any = None) -> "GradientAccumulator":
+        config = dict(config)
+        optimizer = keras_optimizers.deserialize(config.pop("optimizer"), custom_objects=custom_objects)
+        for key in ("clipnorm", "clipvalue", "global_clipnorm", "jit_compile"):
+            config.pop(key, None)
+        return cls(optimizer, **config)
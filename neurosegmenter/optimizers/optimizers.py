@@ -4,6 +4,8 @@ from neurosegmenter.plugins import Plugin, PluginType, PluginParameter
 from neurosegmenter.plugins import register_plugin
 from neurosegmenter.optimizers import Optimizer
 from keras.optimizers import Adam
+from neurosegmenter.optimizers.accumulation import GradientAccumulator
+from neurosegmenter.plugins import get_plugin
 
 plugins = []
 
@@ -269,5 +271,42 @@ class AdamOptimizer(Plugin, Optimizer):
     
 plugins.append(AdamOptimizer)
 
+class GradientAccumulationOptimizer(Plugin, Optimizer):
+    """Wraps another optimizer plugin, accumulating the gradients of several micro-batches in-graph.
+    
+    The effective batch size is accumulation_steps times the datagen batch
+    size, while memory stays that of a single micro-batch.
+    """
+    name: str = "Gradient Accumulation Optimizer"
+    description: str = "Gradient accumulation over micro-batches around another optimizer"
+    type: PluginType = PluginType.OPTIMIZER
+    parameters: list[PluginParameter] = [
+        PluginParameter(
+            name="optimizer",
+            description="Wrapped optimizer plugin, a registered name (default parameters) or a configured instance.",
+            type=str,
+            default="Adam Optimizer",
+            path="optimizers.gradient_accumulation_optimizer.optimizer",
+        ),
+        PluginParameter(
+            name="accumulation_steps",
+            description="Number of micro-batches whose gradients are averaged before each update.",
+            type=int,
+            default=4,
+            path="optimizers.gradient_accumulation_optimizer.accumulation_steps",
+        ),
+    ]
+    optimizer: str
+    accumulation_steps: int
+    
+    def get_optimizer(self) -> keras_optimizers.Optimizer:
+        wrapped = get_plugin(self.optimizer)() if isinstance(self.optimizer, str) else self.optimizer
+        if wrapped.type != PluginType.OPTIMIZER:
+            raise ValueError(f"{self.name}: '{wrapped.name}' is not an optimizer plugin")
+        return GradientAccumulator(wrapped.get_optimizer(), accumulation_steps=self.accumulation_steps)
+    
+
+plugins.append(GradientAccumulationOptimizer)
+
 for plugin in plugins:
     register_plugin(plugin)
\ No newline at end of file
@@ -5,4 +5,9 @@ from neurosegmenter.plugins.plugin import unregister_plugin
 from neurosegmenter.plugins.plugin import PluginType
 from neurosegmenter.plugins.plugin import PluginInterface
 from neurosegmenter.plugins.plugin import PluginParameter
-from neurosegmenter.plugins.plugin import Plugin
\ No newline at end of file
+from neurosegmenter.plugins.plugin import Plugin
+from neurosegmenter.plugins.registry import discover_plugins
+from neurosegmenter.plugins.registry import resolve_plugin_class
+from neurosegmenter.plugins.registry import get_plugin
+from neurosegmenter.plugins.registry import LazyPlugin
+from neurosegmenter.plugins.registry import BUILTIN_PLUGIN_MODULES
\ No newline at end of file
@@ -7,8 +7,6 @@ from dataclasses import dataclass
 from typing import Protocol
 from typing import runtime_checkable
 
-from tensorflow import keras
-from keras import Model
 class PluginType(Enum):
     MODEL = 1
     DATAGEN = 2
@@ -16,6 +14,8 @@ class PluginType(Enum):
     METRIC = 4
     OPTIMIZER = 5
     CALLBACK = 6
+    AUGMENTATION = 7
+    POSTPROCESSING = 8
 
 class PluginInterface:
     """Plugin interface, used in the plugin loader."""
@@ -38,7 +38,7 @@ class PluginParameter:
 class Plugin(Protocol):
     """Protocol for plugins."""
     name: str # plugin name
-    type: PluginType # plugin type, e.g. model, datagen, loss, metric, optimizer, callback
+    type: PluginType # plugin type, e.g. model, datagen, loss, metric, optimizer, callback, augmentation, postprocessing
     description: str # plugin description
     parameters: list[PluginParameter] # plugin parameters
     
@@ -54,8 +54,17 @@ def import_plugin_module(plugin_name: str) -> PluginInterface:
     plugin = importlib.import_module(f"neurosegmenter.plugins.{plugin_name}")
     return plugin # type: ignore
 
-def load_plugins(plugins: list[str]) -> None:
-    """Load model plugins."""
+def load_plugins(plugins: list[str], lazy: bool = True) -> None:
+    """Load model plugins.
+    
+    With lazy=True the plugins are registered from the cached manifest and
+    their modules are only imported when a plugin is instantiated.
+    """
+    if lazy:
+        # local import, the registry module depends on this one
+        from neurosegmenter.plugins.registry import discover_plugins
+        discover_plugins([f"neurosegmenter.plugins.{plugin_name}" for plugin_name in plugins])
+        return
     for plugin_name in plugins:
         plugin_interface = import_plugin_module(plugin_name)
         plugin_interface.initialize()
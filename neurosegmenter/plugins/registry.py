@@ -0,0 +1,286 @@
+"""Lazy, manifest based plugin registry.
+
+Plugin modules are parsed statically (no import, hence no tensorflow) to
+extract the plugin metadata, which is cached in a json manifest next to the
+other neurosegmenter caches. The registry holds LazyPlugin entries that
+import the real module only when the plugin is instantiated.
+The manifest entry of a module is rebuilt whenever the module file changes.
+"""
+import ast
+import json
+import os
+import importlib
+import importlib.util
+from pathlib import Path
+from typing import Any, Optional
+
+from neurosegmenter.plugins.plugin import PluginType, PluginParameter
+from neurosegmenter.plugins.plugin import registered_plugins
+
+BUILTIN_PLUGIN_MODULES: list[str] = [
+    "neurosegmenter.models.simple_model",
+    "neurosegmenter.losses.losses",
+    "neurosegmenter.metrics.metrics",
+    "neurosegmenter.optimizers.optimizers",
+    "neurosegmenter.datagens.datagens",
+    "neurosegmenter.callbacks.callbacks",
+    "neurosegmenter.augmentations.augmentations",
+    "neurosegmenter.postprocessing.postprocessors",
+]
+
+MANIFEST_VERSION = 1
+MANIFEST_FILENAME = "plugin_manifest.json"
+
+# parameter types that can be recovered from the source without importing it
+_PARAMETER_TYPES: dict[str, type] = {t.__name__: t for t in (str, int, float, bool, list, tuple, dict)}
+_PARAMETER_FIELDS = ["name", "description", "type", "default", "path"]
+
+
+class LazyPlugin:
+    """Registry entry standing in for a plugin class that has not been imported yet.
+
+    Exposes the plugin metadata (name, type, description, parameters) from the
+    manifest; calling it imports the plugin module and instantiates the class.
+    """
+
+    def __init__(self,
+                 module: str,
+                 class_name: str,
+                 name: str,
+                 type: PluginType,
+                 description: str,
+                 parameters: Optional[list[PluginParameter]]) -> None:
+        self.module = module
+        self.class_name = class_name
+        self.name = name
+        self.type = type
+        self.description = description
+        self._parameters = parameters
+        self._plugin_class: Optional[type] = None
+
+    @property
+    def parameters(self) -> list[PluginParameter]:
+        # parameters that could not be parsed statically need the real class
+        if self._parameters is None:
+            return self.load().parameters
+        return self._parameters
+
+    @property
+    def loaded(self) -> bool:
+        return self._plugin_class is not None
+
+    def load(self) -> type:
+        """Import the plugin module and return the plugin class."""
+        if self._plugin_class is None:
+            module = importlib.import_module(self.module)
+            self._plugin_class = getattr(module, self.class_name)
+        return self._plugin_class
+
+    def __call__(self, *args, **kwargs) -> Any:
+        return self.load()(*args, **kwargs)
+
+    def __getattr__(self, item: str) -> Any:
+        # any other class attribute (e.g. path) requires the real class
+        if item.startswith("_"):
+            raise AttributeError(item)
+        return getattr(self.load(), item)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.loaded else "not loaded"
+        return f"NeuroSegmenter Plugin: {self.name} ({self.type}) [{state}]"
+
+
+def resolve_plugin_class(plugin: Any) -> type:
+    """Return the actual plugin class for a registry entry."""
+    if isinstance(plugin, LazyPlugin):
+        return plugin.load()
+    return plugin
+
+
+def module_source_path(module_name: str) -> Path:
+    """Locate the source file of a module without importing its parent packages."""
+    top_level, *submodules = module_name.split(".")
+    spec = importlib.util.find_spec(top_level)
+    if spec is None or spec.origin is None:
+        raise ModuleNotFoundError(f"No module named '{module_name}'")
+    if not submodules:
+        return Path(spec.origin)
+    base = Path(spec.origin).parent.joinpath(*submodules)
+    for candidate in (base.with_suffix(".py"), base / "__init__.py"):
+        if candidate.exists():
+            return candidate
+    raise ModuleNotFoundError(f"No module named '{module_name}'")
+
+
+def _parse_parameter(call: ast.AST) -> dict:
+    """Extract the PluginParameter fields from a PluginParameter(...) call."""
+    if not isinstance(call, ast.Call):
+        raise ValueError("not a PluginParameter call")
+    arguments = list(zip(_PARAMETER_FIELDS, call.args)) + [(kw.arg, kw.value) for kw in call.keywords]
+    fields = {}
+    for field, node in arguments:
+        if field == "type":
+            if not (isinstance(node, ast.Name) and node.id in _PARAMETER_TYPES):
+                raise ValueError("parameter type is not a builtin")
+            fields[field] = node.id
+        else:
+            fields[field] = ast.literal_eval(node)
+    if set(fields) != set(_PARAMETER_FIELDS):
+        raise ValueError("incomplete PluginParameter")
+    return fields
+
+
+def _class_attributes(node: ast.ClassDef) -> dict[str, ast.AST]:
+    attributes = {}
+    for stmt in node.body:
+        if isinstance(stmt, ast.AnnAssign) and isinstance(stmt.target, ast.Name) and stmt.value is not None:
+            attributes[stmt.target.id] = stmt.value
+        elif isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name):
+            attributes[stmt.targets[0].id] = stmt.value
+    return attributes
+
+
+def _registered_names(tree: ast.Module) -> set[str]:
+    """Names passed to register_plugin(...) or plugins.append(...) in a module."""
+    names = set()
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and len(node.args) == 1 and isinstance(node.args[0], ast.Name)):
+            continue
+        func = node.func
+        if (isinstance(func, ast.Name) and func.id == "register_plugin") or \
+           (isinstance(func, ast.Attribute) and func.attr == "append" and isinstance(func.value, ast.Name) and func.value.id == "plugins"):
+            names.add(node.args[0].id)
+    return names
+
+
+def parse_plugin_module(source: str) -> list[dict]:
+    """Statically extract the metadata of the plugins defined in a module source."""
+    tree = ast.parse(source)
+    registered = _registered_names(tree)
+
+    class_attributes: dict[str, dict[str, ast.AST]] = {}
+    entries = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        # attributes inherited from plugin classes defined in the same module
+        attributes = {}
+        for base in node.bases:
+            if isinstance(base, ast.Name) and base.id in class_attributes:
+                attributes.update(class_attributes[base.id])
+        attributes.update(_class_attributes(node))
+        class_attributes[node.name] = attributes
+
+        if registered and node.name not in registered:
+            continue
+        plugin_type = attributes.get("type")
+        if not (isinstance(plugin_type, ast.Attribute)
+                and isinstance(plugin_type.value, ast.Name)
+                and plugin_type.value.id == "PluginType"
+                and "name" in attributes):
+            continue
+        try:
+            name = ast.literal_eval(attributes["name"])
+            description = ast.literal_eval(attributes["description"]) if "description" in attributes else ""
+        except ValueError:
+            continue
+        try:
+            parameters: Optional[list[dict]] = [_parse_parameter(call) for call in attributes["parameters"].elts] # type: ignore
+        except (AttributeError, KeyError, ValueError):
+            parameters = None
+        entries.append({
+            "class": node.name,
+            "name": name,
+            "type": plugin_type.attr,
+            "description": description,
+            "parameters": parameters,
+        })
+    return entries
+
+
+def manifest_path() -> Path:
+    # local import, keeps the plugins package importable on its own
+    from neurosegmenter.config import get_cache_dir
+    return get_cache_dir() / MANIFEST_FILENAME
+
+
+def _read_manifest(path: Path) -> dict:
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {"version": MANIFEST_VERSION, "modules": {}}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {"version": MANIFEST_VERSION, "modules": {}}
+    return manifest
+
+
+def _write_manifest(path: Path, manifest: dict) -> None:
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        # a read-only cache only costs a re-parse on the next start
+        pass
+
+
+def build_manifest(modules: list[str], path: Optional[Path] = None) -> dict:
+    """Return the manifest for the given modules, re-parsing only the modules that changed."""
+    path = path or manifest_path()
+    manifest = _read_manifest(path)
+    changed = False
+    for module_name in modules:
+        source_path = module_source_path(module_name)
+        stat = source_path.stat()
+        record = manifest["modules"].get(module_name)
+        if record is not None and record["path"] == str(source_path) \
+           and record["mtime_ns"] == stat.st_mtime_ns and record["size"] == stat.st_size:
+            continue
+        manifest["modules"][module_name] = {
+            "path": str(source_path),
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "plugins": parse_plugin_module(source_path.read_text()),
+        }
+        changed = True
+    if changed:
+        _write_manifest(path, manifest)
+    return manifest
+
+
+def _lazy_plugin(module_name: str, entry: dict) -> LazyPlugin:
+    parameters = None
+    if entry["parameters"] is not None:
+        parameters = [PluginParameter(**{**parameter, "type": _PARAMETER_TYPES[parameter["type"]]})
+                      for parameter in entry["parameters"]]
+    return LazyPlugin(module=module_name,
+                      class_name=entry["class"],
+                      name=entry["name"],
+                      type=PluginType[entry["type"]],
+                      description=entry["description"],
+                      parameters=parameters)
+
+
+def discover_plugins(modules: Optional[list[str]] = None) -> None:
+    """Register lazy entries for the plugins defined in the given modules (default: the builtin ones).
+
+    Plugins whose module has already been imported keep their real class.
+    """
+    modules = BUILTIN_PLUGIN_MODULES if modules is None else modules
+    manifest = build_manifest(modules)
+    for module_name in modules:
+        for entry in manifest["modules"][module_name]["plugins"]:
+            if isinstance(registered_plugins.get(entry["name"], None), LazyPlugin) or entry["name"] not in registered_plugins:
+                registered_plugins[entry["name"]] = _lazy_plugin(module_name, entry) # type: ignore
+
+
+def get_plugin(name: str) -> Any:
+    """Registered plugin (class or lazy entry) by name, discovering the builtin plugins if it is not registered yet."""
+    if name not in registered_plugins:
+        discover_plugins()
+    try:
+        return registered_plugins[name]
+    except KeyError:
+        raise KeyError(f"Unknown plugin '{name}', registered plugins: {sorted(registered_plugins)}") from None
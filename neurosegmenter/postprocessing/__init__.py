@@ -0,0 +1,2 @@
+from neurosegmenter.postprocessing.postprocessor import PostProcessor
+from neurosegmenter.postprocessing.components import UnionFind, connected_components, write_instance_table
@@ -0,0 +1,219 @@
+"""Chunked connected components of on-disk volumes.
+
+The thresholded volume is labeled in three passes over disjoint chunks, run
+in a process pool (each worker opens the volumes by path):
+1. every chunk is labeled on its own and the local labels are written to
+   the output, with the size, centroid and bounding box of every label;
+2. the voxels on both sides of the chunk seams are compared, labels of
+   neighbouring chunks that touch are merged with a union-find;
+3. every chunk is relabeled with the consecutive ids of the merged components.
+Memory is bounded by num_workers chunks plus a few integers per local label.
+"""
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Optional, Sequence, Union
+
+import numpy as np
+from scipy import ndimage
+
+from neurosegmenter.volumes import block_grid, create_volume, open_volume
+
+
+class UnionFind:
+    """Disjoint sets of the integers 0..size-1."""
+
+    def __init__(self, size: int) -> None:
+        self.parent = np.arange(size, dtype=np.int64)
+
+    def find(self, i: int) -> int:
+        parent = self.parent
+        while parent[i] != i:
+            # path halving
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return int(i)
+
+    def union(self, i: int, j: int) -> None:
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            # the smallest id is the root, so roots are stable
+            self.parent[max(i, j)] = min(i, j)
+
+    def roots(self) -> np.ndarray:
+        """Root of every element, resolved for all of them at once."""
+        parent = self.parent.copy()
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                return parent
+            parent = grandparent
+
+
+def _foreground(volume: Any, region: tuple[slice, ...], spatial_ndim: int, channel: Optional[int], threshold: float) -> np.ndarray:
+    values = np.asarray(volume[region])
+    if values.ndim > spatial_ndim:
+        if channel is None and values.shape[-1] > 1:
+            # any channel but the first (background), e.g. one-hot labels
+            return (values[..., 1:] > threshold).any(axis=-1)
+        values = values[..., channel or 0]
+    return values > threshold
+
+
+def _label_chunk(input_path: str, output_path: str, chunk: tuple[slice, ...], channel: Optional[int], threshold: float,
+                 structure: np.ndarray) -> dict[str, np.ndarray]:
+    """Label a chunk, write the local labels and return their statistics."""
+    mask = _foreground(open_volume(input_path), chunk, len(chunk), channel, threshold)
+    labels, count = ndimage.label(mask, structure)
+    output = open_volume(output_path, mode="r+")
+    output[chunk] = labels.astype(output.dtype, copy=False)
+    start = np.array([s.start for s in chunk], dtype=np.int64)
+    if not count:
+        empty = np.zeros((0, len(chunk)), dtype=np.int64)
+        return {"size": np.zeros(0, dtype=np.int64), "coordinate_sum": empty.astype(np.float64), "bbox_start": empty, "bbox_stop": empty}
+    index = np.arange(1, count + 1)
+    size = np.bincount(labels.ravel(), minlength=count + 1)[1:].astype(np.int64)
+    centroid = np.array(ndimage.center_of_mass(mask, labels, index), dtype=np.float64).reshape(count, len(chunk))
+    boxes = ndimage.find_objects(labels)
+    return {"size": size,
+            "coordinate_sum": (centroid + start) * size[:, np.newaxis],
+            "bbox_start": np.array([[s.start for s in box] for box in boxes], dtype=np.int64) + start,
+            "bbox_stop": np.array([[s.stop for s in box] for box in boxes], dtype=np.int64) + start}
+
+
+def _global_labels(local: np.ndarray, region: tuple[slice, ...], chunk_shape: Sequence[int], offsets: np.ndarray) -> np.ndarray:
+    """Local labels of a region spanning several chunks made unique by adding the offset of their chunk."""
+    chunk_index = np.ix_(*[np.arange(s.start, s.stop) // size for s, size in zip(region, chunk_shape)])
+    return np.where(local > 0, local.astype(np.int64) + offsets[chunk_index], 0)
+
+
+def _seam_pairs(output_path: str, chunk: tuple[slice, ...], chunk_shape: Sequence[int], offsets: np.ndarray,
+                structure: np.ndarray) -> np.ndarray:
+    """Pairs of touching labels across the low seams of a chunk, in global ids."""
+    output = open_volume(output_path)
+    neighbours = np.argwhere(structure) - 1
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    for axis, seam in enumerate(chunk):
+        if seam.start == 0:
+            continue
+        # the two voxel layers on both sides of the seam, extended by one voxel
+        # on the low side of the other axes for diagonal connectivity
+        region = tuple(slice(seam.start - 1, seam.start + 1) if a == axis else slice(max(s.start - 1, 0), s.stop)
+                       for a, s in enumerate(chunk))
+        slab = _global_labels(np.asarray(output[region]), region, chunk_shape, offsets)
+        for offset in neighbours[neighbours[:, axis] == 1]:
+            low = [slice(None)] * slab.ndim
+            high = [slice(None)] * slab.ndim
+            for a, step in enumerate(offset):
+                if a == axis:
+                    low[a], high[a] = slice(0, 1), slice(1, 2)
+                elif step == 1:
+                    low[a], high[a] = slice(None, -1), slice(1, None)
+                elif step == -1:
+                    low[a], high[a] = slice(1, None), slice(None, -1)
+            a, b = slab[tuple(low)], slab[tuple(high)]
+            touching = (a > 0) & (b > 0) & (a != b)
+            pairs.append(np.stack([a[touching], b[touching]], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def _relabel_chunk(output_path: str, chunk: tuple[slice, ...], lookup: np.ndarray) -> None:
+    output = open_volume(output_path, mode="r+")
+    output[chunk] = lookup[np.asarray(output[chunk])]
+
+
+def connected_components(input_path: Union[str, Path],
+                         output_path: Union[str, Path],
+                         chunk_shape: Sequence[int],
+                         threshold: float = 0.5,
+                         channel: Optional[int] = 0,
+                         connectivity: int = 1,
+                         min_size: int = 0,
+                         num_workers: Optional[int] = None) -> dict[str, np.ndarray]:
+    """Label the connected components of a thresholded volume, chunk by chunk in parallel.
+
+    input_path: .npy/.zarr volume (e.g. the output of tiled inference) with
+        len(chunk_shape) spatial axes first and an optional trailing channel
+        axis, of which channel is used (any channel but the first, the
+        background, if None). Voxels > threshold are foreground.
+    output_path: .npy/.zarr instance label volume, created with the spatial
+        shape of the input, 0 is the background and instances are numbered
+        from 1 in order of their first chunk.
+    connectivity: 1 for face neighbours, up to the number of spatial axes
+        for edge and corner neighbours.
+    min_size: components with fewer voxels are removed.
+    Returns the per-instance table: label, size, centroid, bbox_start and
+    bbox_stop (exclusive), with a row (or row vector) per instance.
+    """
+    spatial_ndim = len(chunk_shape)
+    shape = tuple(open_volume(input_path).shape[:spatial_ndim])
+    chunk_shape = tuple(min(int(size), limit) for size, limit in zip(chunk_shape, shape))
+    if not 1 <= connectivity <= spatial_ndim:
+        raise ValueError(f"connectivity must be between 1 and {spatial_ndim}, got {connectivity}")
+    structure = ndimage.generate_binary_structure(spatial_ndim, connectivity)
+    dtype = np.uint32 if np.prod(shape) < 2 ** 32 else np.uint64
+    create_volume(output_path, shape, dtype, chunks=chunk_shape)
+    input_path, output_path = str(input_path), str(output_path)
+    chunks = block_grid(shape, chunk_shape)
+    grid_shape = tuple(-(-size // chunk) for size, chunk in zip(shape, chunk_shape))
+
+    with ProcessPoolExecutor(num_workers or os.cpu_count() or 1) as pool:
+        statistics = list(pool.map(_label_chunk, *zip(*[(input_path, output_path, chunk, channel, threshold, structure)
+                                                         for chunk in chunks])))
+        counts = np.array([len(chunk_statistics["size"]) for chunk_statistics in statistics], dtype=np.int64)
+        # global id of the local label l of chunk i: offsets[i] + l
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).reshape(grid_shape)
+        total = int(counts.sum())
+        union_find = UnionFind(total + 1)
+        for pairs in pool.map(_seam_pairs, *zip(*[(output_path, chunk, chunk_shape, offsets, structure) for chunk in chunks])):
+            for i, j in pairs:
+                union_find.union(int(i), int(j))
+        roots = union_find.roots()[1:]
+
+        # merge the statistics of the local labels of every component
+        size = np.concatenate([s["size"] for s in statistics])
+        component_size = np.bincount(roots, weights=size, minlength=total + 1).astype(np.int64)
+        kept = np.flatnonzero(component_size >= max(min_size, 1))
+        lookup = np.zeros(total + 1, dtype=dtype)
+        lookup[kept] = np.arange(1, len(kept) + 1)
+        instances = lookup[roots].astype(np.int64)
+        in_instance = instances > 0
+        coordinate_sum = np.zeros((len(kept) + 1, spatial_ndim))
+        np.add.at(coordinate_sum, instances[in_instance], np.concatenate([s["coordinate_sum"] for s in statistics])[in_instance])
+        bbox_start = np.full((len(kept) + 1, spatial_ndim), np.iinfo(np.int64).max)
+        np.minimum.at(bbox_start, instances[in_instance], np.concatenate([s["bbox_start"] for s in statistics])[in_instance])
+        bbox_stop = np.zeros((len(kept) + 1, spatial_ndim), dtype=np.int64)
+        np.maximum.at(bbox_stop, instances[in_instance], np.concatenate([s["bbox_stop"] for s in statistics])[in_instance])
+
+        final = np.concatenate([[0], instances]).astype(dtype)
+        chunk_lookups = [np.concatenate([[0], final[offset + 1:offset + count + 1]]).astype(dtype)
+                         for offset, count in zip(offsets.ravel(), counts)]
+        list(pool.map(_relabel_chunk, [output_path] * len(chunks), chunks, chunk_lookups))
+
+    instance_size = component_size[kept]
+    return {"label": np.arange(1, len(kept) + 1),
+            "size": instance_size,
+            "centroid": coordinate_sum[1:] / np.maximum(instance_size, 1)[:, np.newaxis],
+            "bbox_start": bbox_start[1:],
+            "bbox_stop": bbox_stop[1:]}
+
+
+def write_instance_table(table: dict[str, np.ndarray], path: Union[str, Path]) -> Path:
+    """Write a per-instance table as csv, vector columns are split per axis (centroid_0, centroid_1, ...)."""
+    columns, values = [], []
+    for name, column in table.items():
+        column = np.asarray(column)
+        if column.ndim == 1:
+            columns.append(name)
+            values.append(column[:, np.newaxis])
+        else:
+            columns.extend(f"{name}_{axis}" for axis in range(column.shape[1]))
+            values.append(column)
+    path = Path(path)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        if values:
+            writer.writerows(np.concatenate([v.astype(object) for v in values], axis=1).tolist())
+    return path
@@ -0,0 +1,13 @@
+"""Post-processing of predicted volumes.
+
+Post-processing plugins read an on-disk prediction (e.g. the output of tiled
+inference) and write a derived on-disk volume, chunk by chunk, so whole-brain
+volumes never need to fit in memory.
+"""
+from pathlib import Path
+from typing import Any, Protocol, Union
+
+
+class PostProcessor(Protocol):
+    def __call__(self, input_path: Union[str, Path], output_path: Union[str, Path]) -> Any:
+        ...
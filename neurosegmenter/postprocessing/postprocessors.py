@@ -0,0 +1,85 @@
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from neurosegmenter.postprocessing import PostProcessor, connected_components, write_instance_table
+from neurosegmenter.plugins import Plugin, PluginType, PluginParameter
+from neurosegmenter.plugins import register_plugin
+
+plugins = []
+
+class ConnectedComponents(Plugin, PostProcessor):
+    """Thresholds a prediction volume and labels its connected components as instances.
+
+    Chunks are labeled in a process pool, labels touching across chunk seams
+    are merged with a union-find and the instance labels are written chunk by
+    chunk. Returns (and optionally writes as csv) the per-instance size,
+    centroid and bounding box.
+    """
+    name: str = "Connected Components"
+    description: str = "Chunked parallel connected component labeling of thresholded predictions"
+    type: PluginType = PluginType.POSTPROCESSING
+    path: str = "postprocessing.connected_components"
+    parameters: list[PluginParameter] = [
+        PluginParameter(name="threshold",
+                        description="Voxels with a prediction > threshold are foreground.",
+                        type=float,
+                        default=0.5,
+                        path="postprocessing.connected_components.threshold"),
+        PluginParameter(name="channel",
+                        description="Channel of the prediction thresholded, if it has a channel axis.",
+                        type=int,
+                        default=0,
+                        path="postprocessing.connected_components.channel"),
+        PluginParameter(name="chunk_shape",
+                        description="Spatial shape of the chunks labeled in parallel, 2 or 3 values.",
+                        type=list,
+                        default=[128, 128, 128],
+                        path="postprocessing.connected_components.chunk_shape"),
+        PluginParameter(name="connectivity",
+                        description="1 for face neighbours, 2 to also connect edge neighbours, 3 corner neighbours (3D only).",
+                        type=int,
+                        default=1,
+                        path="postprocessing.connected_components.connectivity"),
+        PluginParameter(name="min_size",
+                        description="Components with fewer voxels are removed.",
+                        type=int,
+                        default=0,
+                        path="postprocessing.connected_components.min_size"),
+        PluginParameter(name="num_workers",
+                        description="Number of worker processes, if None one per cpu.",
+                        type=int,
+                        default=None,
+                        path="postprocessing.connected_components.num_workers"),
+        PluginParameter(name="stats_path",
+                        description="Path of the csv per-instance statistics table, if None it is only returned.",
+                        type=str,
+                        default=None,
+                        path="postprocessing.connected_components.stats_path"),
+    ]
+
+    threshold: float
+    channel: int
+    chunk_shape: list
+    connectivity: int
+    min_size: int
+    num_workers: Optional[int]
+    stats_path: Optional[str]
+
+    def __call__(self, input_path: Union[str, Path], output_path: Union[str, Path]) -> dict[str, np.ndarray]:
+        table = connected_components(input_path, output_path, self.chunk_shape,
+                                     threshold=self.threshold,
+                                     channel=self.channel,
+                                     connectivity=self.connectivity,
+                                     min_size=self.min_size,
+                                     num_workers=self.num_workers)
+        if self.stats_path is not None:
+            write_instance_table(table, self.stats_path)
+        return table
+
+plugins.append(ConnectedComponents)
+
+
+for plugin in plugins:
+    register_plugin(plugin)
@@ -0,0 +1,2 @@
+from neurosegmenter.sweeps.search_space import SearchSpace, Choice, Uniform
+from neurosegmenter.sweeps.scheduler import SweepScheduler, Trial
\ No newline at end of file
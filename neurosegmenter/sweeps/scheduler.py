@@ -0,0 +1,195 @@
+"""Local parallel hyperparameter sweeps.
+
+Trials run in a process pool, every worker pinned to its own set of CPUs
+with the matching number of intra-op threads. Finished trials are memoized by
+configuration hash, objective source hash and budget in a jsonl file, so
+re-running a sweep skips them while editing the objective invalidates them.
+"""
+import json
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+
+import numpy as np
+
+from neurosegmenter.config import ConfigEngine, config_hash, get_cache_dir, source_hash
+from neurosegmenter.sweeps.search_space import SearchSpace
+
+# objective(config, budget) -> score, must be picklable (a module level function)
+Objective = Callable[[dict[str, Any], float], float]
+
+STRATEGIES = ("grid", "random", "successive_halving")
+
+
+@dataclass
+class Trial:
+    config: dict[str, Any]
+    budget: float
+    score: float
+    key: str
+    seconds: float
+    cached: bool = False
+
+
+def _pin_worker(cpu_sets: Any, threads: int) -> None:
+    """Process pool initializer, pins the worker to one of the cpu sets."""
+    cpus = cpu_sets.get()
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "TF_NUM_INTRAOP_THREADS"):
+        os.environ[variable] = str(threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+
+
+def _run_trial(objective: Objective, config: dict[str, Any], budget: float) -> tuple[float, float]:
+    start = time.perf_counter()
+    score = float(objective(config, budget))
+    return score, time.perf_counter() - start
+
+
+class SweepScheduler:
+    """Runs grid, random or successive halving searches over a SearchSpace.
+
+    objective: picklable callable (config, budget) -> score, config maps
+        PluginParameter paths to values and can be bound to plugins with
+        ConfigEngine.bind().
+    mode: "min" or "max", whether lower or higher scores are better.
+    num_workers / threads_per_trial: size of the process pool and number of
+        CPUs (and intra-op threads) given to each trial.
+    successive halving starts n_trials random configurations at min_budget
+        and keeps the best 1/eta of them at every rung, multiplying the budget
+        by eta, until max_budget. The last rung always runs at max_budget:
+        the budget is capped to it, and once a single configuration is left
+        it goes straight to max_budget.
+    Random configurations are drawn from seed, keep it fixed to let re-runs
+    hit the memoized trials. Memoized trials are keyed by the source of the
+    module defining the objective, objective_version invalidates them when
+    something else the objective depends on changes (data, other modules).
+    """
+
+    def __init__(self,
+                 search_space: SearchSpace,
+                 objective: Objective,
+                 strategy: str = "random",
+                 n_trials: int = 16,
+                 grid_points: int = 3,
+                 mode: str = "min",
+                 num_workers: int = 1,
+                 threads_per_trial: Optional[int] = None,
+                 min_budget: float = 1,
+                 max_budget: float = 27,
+                 eta: int = 3,
+                 seed: Optional[int] = 0,
+                 results_path: Optional[Union[str, Path]] = None,
+                 engine: Optional[ConfigEngine] = None,
+                 objective_version: Optional[str] = None) -> None:
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy '{strategy}', expected one of {STRATEGIES}")
+        if mode not in ("min", "max"):
+            raise ValueError(f"Unknown mode '{mode}', expected 'min' or 'max'")
+        self.search_space = search_space
+        self.objective = objective
+        self.strategy = strategy
+        self.n_trials = n_trials
+        self.grid_points = grid_points
+        self.mode = mode
+        self.num_workers = num_workers
+        cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+        self.threads_per_trial = threads_per_trial or max(cpu_count // num_workers, 1)
+        self.min_budget = min_budget
+        self.max_budget = max_budget
+        self.eta = eta
+        self.rng = np.random.default_rng(seed)
+        self.results_path = Path(results_path) if results_path else get_cache_dir("sweeps") / "trials.jsonl"
+        self.engine = engine or ConfigEngine()
+        self.objective_version = objective_version
+        self.trials: list[Trial] = []
+        self._memo = self._load_memo()
+
+    def _load_memo(self) -> dict[str, Trial]:
+        memo = {}
+        if self.results_path.exists():
+            with open(self.results_path) as f:
+                for line in f:
+                    if line.strip():
+                        trial = Trial(**json.loads(line))
+                        memo[trial.key] = trial
+        return memo
+
+    def _save(self, trial: Trial) -> None:
+        with open(self.results_path, "a") as f:
+            f.write(json.dumps(asdict(trial)) + "\n")
+
+    def trial_key(self, config: dict[str, Any], budget: float) -> str:
+        # functools.partial objectives by the function they wrap
+        function = getattr(self.objective, "func", self.objective)
+        objective = f"{function.__module__}.{getattr(function, '__qualname__', repr(function))}"
+        return config_hash({"objective": objective, "source": source_hash(function), "version": self.objective_version,
+                            "config": config, "budget": budget})
+
+    def _cpu_sets(self) -> list[set[int]]:
+        if not hasattr(os, "sched_getaffinity"):
+            return [set() for _ in range(self.num_workers)]
+        cpus = sorted(os.sched_getaffinity(0))
+        return [set(cpus[(i * self.threads_per_trial) % len(cpus):][:self.threads_per_trial]) or set(cpus)
+                for i in range(self.num_workers)]
+
+    def run_configs(self, configs: list[dict[str, Any]], budget: float) -> list[Trial]:
+        """Run (or fetch from the memo) one trial per configuration at a given budget."""
+        for config in configs:
+            result = self.engine.validate(config)
+            if not result.valid:
+                raise ValueError("Invalid sweep configuration:\n" + "\n".join(result.errors))
+        keys = [self.trial_key(config, budget) for config in configs]
+        pending = [(key, config) for key, config in zip(keys, configs) if key not in self._memo]
+        if pending:
+            context = multiprocessing.get_context("spawn")
+            cpu_sets = context.Queue()
+            for cpus in self._cpu_sets():
+                cpu_sets.put(cpus)
+            with ProcessPoolExecutor(self.num_workers, mp_context=context,
+                                     initializer=_pin_worker, initargs=(cpu_sets, self.threads_per_trial)) as pool:
+                futures = {key: (config, pool.submit(_run_trial, self.objective, config, budget)) for key, config in pending}
+                for key, (config, future) in futures.items():
+                    score, seconds = future.result()
+                    trial = Trial(config=config, budget=budget, score=score, key=key, seconds=seconds)
+                    self._memo[key] = trial
+                    self._save(trial)
+        ran = {key for key, _ in pending}
+        trials = [self._memo[key] if key in ran else Trial(**{**asdict(self._memo[key]), "cached": True}) for key in keys]
+        self.trials.extend(trials)
+        return trials
+
+    def _rank(self, trials: list[Trial]) -> list[Trial]:
+        return sorted(trials, key=lambda trial: trial.score, reverse=self.mode == "max")
+
+    def _successive_halving(self) -> list[Trial]:
+        configs = [self.search_space.sample(self.rng) for _ in range(self.n_trials)]
+        budget = self.min_budget
+        while True:
+            trials = self.run_configs(configs, budget)
+            if budget >= self.max_budget:
+                return trials
+            survivors = max(math.floor(len(configs) / self.eta), 1)
+            configs = [trial.config for trial in self._rank(trials)[:survivors]]
+            budget = self.max_budget if len(configs) == 1 else min(budget * self.eta, self.max_budget)
+
+    def run(self) -> list[Trial]:
+        """Run the sweep, returns the trials of the last round sorted best first."""
+        if self.strategy == "grid":
+            trials = self.run_configs(self.search_space.grid(self.grid_points), self.max_budget)
+        elif self.strategy == "random":
+            trials = self.run_configs([self.search_space.sample(self.rng) for _ in range(self.n_trials)], self.max_budget)
+        else:
+            trials = self._successive_halving()
+        return self._rank(trials)
+
+    def best(self) -> Trial:
+        """Best trial among the ones run at the largest budget."""
+        budget = max(trial.budget for trial in self.trials)
+        return self._rank([trial for trial in self.trials if trial.budget == budget])[0]
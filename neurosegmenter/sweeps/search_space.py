@@ -0,0 +1,81 @@
+"""Search spaces over plugin parameters."""
+import itertools
+import math
+from dataclasses import dataclass
+from typing import Any, Optional, Union
+
+import numpy as np
+
+from neurosegmenter.config import ConfigEngine
+
+
+@dataclass
+class Choice:
+    """Discrete set of values."""
+    values: list
+
+    def sample(self, rng: np.random.Generator) -> Any:
+        return self.values[rng.integers(len(self.values))]
+
+    def grid(self, points: int) -> list:
+        return list(self.values)
+
+
+@dataclass
+class Uniform:
+    """Continuous (or integer) range, optionally sampled in log scale."""
+    low: float
+    high: float
+    log: bool = False
+    integer: bool = False
+
+    def _cast(self, value: float) -> Union[int, float]:
+        return int(round(value)) if self.integer else float(value)
+
+    def sample(self, rng: np.random.Generator) -> Union[int, float]:
+        if self.log:
+            return self._cast(math.exp(rng.uniform(math.log(self.low), math.log(self.high))))
+        return self._cast(rng.uniform(self.low, self.high))
+
+    def grid(self, points: int) -> list:
+        values = np.geomspace(self.low, self.high, points) if self.log else np.linspace(self.low, self.high, points)
+        return list(dict.fromkeys(self._cast(value) for value in values))
+
+
+Domain = Union[Choice, Uniform]
+
+
+class SearchSpace:
+    """Mapping from PluginParameter paths to the domain explored for them.
+
+    Paths are checked against the plugin parameters of a ConfigEngine, bool
+    parameters of the given plugins are explored automatically when
+    include_bools is set.
+    """
+
+    def __init__(self,
+                 domains: dict[str, Domain],
+                 engine: Optional[ConfigEngine] = None,
+                 plugins: Optional[list[str]] = None,
+                 include_bools: bool = False) -> None:
+        engine = engine or ConfigEngine()
+        unknown = [path for path in domains if path not in engine.index]
+        if unknown:
+            raise ValueError(f"Search space paths without a plugin parameter: {unknown}")
+        self.domains = dict(domains)
+        if include_bools:
+            for plugin_name in plugins or []:
+                for parameter in engine.plugins[plugin_name].parameters:
+                    if parameter.type is bool and parameter.path not in self.domains:
+                        self.domains[parameter.path] = Choice([True, False])
+
+    def sample(self, rng: np.random.Generator) -> dict[str, Any]:
+        return {path: domain.sample(rng) for path, domain in self.domains.items()}
+
+    def grid(self, points: int = 3) -> list[dict[str, Any]]:
+        paths = list(self.domains)
+        values = [self.domains[path].grid(points) for path in paths]
+        return [dict(zip(paths, combination)) for combination in itertools.product(*values)]
+
+    def __len__(self) -> int:
+        return len(self.domains)
@@ -0,0 +1,2 @@
+from neurosegmenter.training.distributed import DistributedTrainer, get_strategy, is_chief, tf_config, trainer_from_config
+from neurosegmenter.training.launcher import launch_local_workers, free_ports
\ No newline at end of file
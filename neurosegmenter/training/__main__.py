@@ -0,0 +1,37 @@
+"""Distributed training command line.
+
+    python -m neurosegmenter.training --config config.yaml --workers 4
+
+runs 4 local workers, with --workers 1 (the default) the process trains
+alone or joins the cluster described by its TF_CONFIG, e.g. one process per
+node launched with the same configuration.
+"""
+import argparse
+import sys
+from typing import Optional
+
+# train lives in an importable module, spawned workers cannot unpickle functions of __main__
+from neurosegmenter.training.cli import train
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m neurosegmenter.training", description="Data-parallel training of plugin configurations")
+    parser.add_argument("--config", required=True, help="Configuration file (yaml or json) with a training section")
+    parser.add_argument("--workers", type=int, default=1, help="Number of local worker processes")
+    parser.add_argument("--threads-per-worker", type=int, default=None, help="Intra-op threads of every local worker")
+    args = parser.parse_args(argv)
+
+    if args.workers > 1:
+        from neurosegmenter.training.launcher import launch_local_workers
+        histories = launch_local_workers(args.workers, train, args.config, threads_per_worker=args.threads_per_worker)
+        history = histories[0]
+    else:
+        history = train(args.config)
+    if history is not None:
+        for name, values in history.items():
+            print(f"{name}: {values[-1]:.6f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,13 @@
+"""Entry points of the training command line, importable by spawned workers."""
+from typing import Any, Optional
+
+
+def train(config_path: str) -> Optional[dict[str, Any]]:
+    """Train from a configuration file, returns the history of the chief worker."""
+    # local imports, tensorflow must not be initialized before TF_CONFIG is set
+    from neurosegmenter.config import load_config
+    from neurosegmenter.plugins import discover_plugins
+    from neurosegmenter.training.distributed import is_chief, trainer_from_config
+    discover_plugins()
+    history = trainer_from_config(load_config(config_path)).fit()
+    return history.history if is_chief() else None
@@ -0,0 +1,203 @@
+"""Data-parallel training with tf.distribute.MultiWorkerMirroredStrategy.
+
+The cluster comes from the TF_CONFIG environment variable, so the same
+configuration runs as a single process, as several local processes (see
+launch_local_workers) or across nodes. Without TF_CONFIG the strategy runs a
+single worker.
+The datagen batch_size is the global batch size, every worker builds its
+own input pipeline reading only its shard of the patches.
+"""
+import copy
+import json
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import Any, Optional, Sequence
+
+import tensorflow as tf
+from tensorflow import keras
+
+from neurosegmenter.config import ConfigEngine
+from neurosegmenter.metrics import StreamingMetric
+from neurosegmenter.models.precision import loss_scale_optimizer
+from neurosegmenter.plugins import registered_plugins
+
+# keys of the "training" section of a configuration, the other keys are plugin parameters
+TRAINING_KEYS = ("model", "optimizer", "loss", "metrics", "datagen", "callbacks", "epochs", "steps_per_epoch", "save_path")
+
+
+def tf_config(workers: Sequence[str], index: int) -> dict[str, Any]:
+    """TF_CONFIG of the worker at index in a cluster of workers (host:port addresses)."""
+    return {"cluster": {"worker": list(workers)}, "task": {"type": "worker", "index": index}}
+
+
+def cluster_spec() -> dict[str, Any]:
+    """Parsed TF_CONFIG, empty for a single worker."""
+    return json.loads(os.environ.get("TF_CONFIG", "{}"))
+
+
+def is_chief() -> bool:
+    """Whether this process is the chief worker, the one writing logs and models."""
+    spec = cluster_spec()
+    task = spec.get("task", {})
+    if task.get("type") == "chief":
+        return True
+    # without a chief task the first worker acts as chief
+    return task.get("type", "worker") == "worker" and task.get("index", 0) == 0 and "chief" not in spec.get("cluster", {})
+
+
+def worker_name() -> str:
+    """Name of this worker in the cluster, e.g. worker-1."""
+    task = cluster_spec().get("task", {})
+    return f"{task.get('type', 'worker')}-{task.get('index', 0)}"
+
+
+def worker_callback_plugin(plugin: Any) -> Any:
+    """Callback plugin of a non-chief worker, writing its logs to a log_dir/<worker name> subdirectory.
+
+    Only the chief writes to the configured log_dir, so workers never
+    overwrite (or delete) each other's logs.
+    """
+    if is_chief() or getattr(plugin, "log_dir", None) is None:
+        return plugin
+    plugin = copy.copy(plugin)
+    plugin.log_dir = str(Path(plugin.log_dir) / worker_name())
+    return plugin
+
+
+def get_strategy() -> tf.distribute.Strategy:
+    """MultiWorkerMirroredStrategy over the cluster in TF_CONFIG.
+
+    Has to be created before any other tensorflow op runs in the process.
+    """
+    return tf.distribute.MultiWorkerMirroredStrategy()
+
+
+def _keras_name(plugin: Any) -> str:
+    return re.sub(r"[^0-9a-zA-Z]+", "_", plugin.name).strip("_").lower()
+
+
+def _keras_function(plugin: Any) -> Any:
+    """Loss or metric plugin as a function, keras names (and serializes) losses and metrics by function name."""
+    def function(y_true: tf.Tensor, y_pred: tf.Tensor) -> tf.Tensor:
+        return plugin(y_true, y_pred)
+    function.__name__ = _keras_name(plugin)
+    return function
+
+
+def _keras_metric(plugin: Any) -> Any:
+    """Metric plugin for keras compile, streaming metrics keep their counters in tf.Variables."""
+    if isinstance(plugin, StreamingMetric):
+        return plugin.keras_metric(_keras_name(plugin))
+    return _keras_function(plugin)
+
+
+class DistributedTrainer:
+    """Trains a model plugin with optimizer, loss, metric and datagen plugins on all the workers.
+
+    model / optimizer / loss / datagen: plugin instances.
+    metrics / callbacks: lists of plugin instances. Callbacks run on every
+        worker, the ones with a log_dir write to log_dir/<worker name> on
+        the non-chief workers.
+    steps_per_epoch: steps of every epoch, by default samples_per_epoch of
+        the datagen over its (global) batch size. The input pipelines repeat,
+        so all the workers run the same number of steps.
+    save_path: where the chief saves the trained model, the other workers
+        save to a temporary directory (every worker has to take part in saving).
+    """
+
+    def __init__(self,
+                 model: Any,
+                 optimizer: Any,
+                 loss: Any,
+                 datagen: Any,
+                 metrics: Optional[list[Any]] = None,
+                 callbacks: Optional[list[Any]] = None,
+                 epochs: int = 1,
+                 steps_per_epoch: Optional[int] = None,
+                 save_path: Optional[str] = None,
+                 strategy: Optional[tf.distribute.Strategy] = None) -> None:
+        self.model_plugin = model
+        self.optimizer_plugin = optimizer
+        self.loss_plugin = loss
+        self.datagen = datagen
+        self.metric_plugins = metrics or []
+        self.callback_plugins = callbacks or []
+        self.epochs = epochs
+        if steps_per_epoch is None:
+            if not hasattr(datagen, "samples_per_epoch"):
+                raise ValueError("steps_per_epoch is required for datagens without samples_per_epoch")
+            steps_per_epoch = max(datagen.samples_per_epoch // datagen.batch_size, 1)
+        self.steps_per_epoch = steps_per_epoch
+        self.save_path = save_path
+        self.strategy = strategy or get_strategy()
+
+    def dataset_fn(self, input_context: tf.distribute.InputContext) -> tf.data.Dataset:
+        """Input pipeline of one worker, reading its shard with the per-worker batch size."""
+        datagen = copy.copy(self.datagen)
+        datagen.num_shards = input_context.num_input_pipelines
+        datagen.shard_index = input_context.input_pipeline_id
+        datagen.batch_size = max(self.datagen.batch_size // input_context.num_input_pipelines, 1)
+        options = tf.data.Options()
+        # the datagen already shards its patches
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        return datagen.get_dataset().repeat().with_options(options)
+
+    def build(self) -> keras.Model:
+        """Model, optimizer and metrics created and compiled in the strategy scope."""
+        with self.strategy.scope():
+            model = self.model_plugin.get_model()
+            model.compile(optimizer=loss_scale_optimizer(self.optimizer_plugin.get_optimizer(), model),
+                          loss=_keras_function(self.loss_plugin),
+                          metrics=[_keras_metric(plugin) for plugin in self.metric_plugins])
+        return model
+
+    def fit(self) -> keras.callbacks.History:
+        model = self.build()
+        callbacks = [worker_callback_plugin(plugin).get_callback() for plugin in self.callback_plugins]
+        history = model.fit(keras.utils.experimental.DatasetCreator(self.dataset_fn),
+                            epochs=self.epochs,
+                            steps_per_epoch=self.steps_per_epoch,
+                            callbacks=callbacks,
+                            verbose=2 if is_chief() else 0)
+        self.model = model
+        if self.save_path is not None:
+            self.save(model)
+        return history
+
+    def save(self, model: keras.Model) -> None:
+        if is_chief():
+            model.save(self.save_path)
+            return
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model.save(Path(tmp_dir) / "model")
+
+
+def trainer_from_config(config: dict, engine: Optional[ConfigEngine] = None) -> DistributedTrainer:
+    """Trainer of a configuration.
+
+    The "training" section names the plugins (model, optimizer, loss,
+    datagen, metrics and callbacks) and the training settings (epochs,
+    steps_per_epoch, save_path), the other keys are plugin parameters.
+    """
+    config = dict(config)
+    training = config.pop("training", {})
+    unknown = set(training) - set(TRAINING_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown training settings: {sorted(unknown)}")
+    for required in ("model", "optimizer", "loss", "datagen"):
+        if required not in training:
+            raise ValueError(f"The training section has no '{required}' plugin")
+    names = [training[key] for key in ("model", "optimizer", "loss", "datagen")]
+    names += training.get("metrics", []) + training.get("callbacks", [])
+    instances = (engine or ConfigEngine(registered_plugins)).bind(config, plugins=names)
+    return DistributedTrainer(model=instances[training["model"]],
+                              optimizer=instances[training["optimizer"]],
+                              loss=instances[training["loss"]],
+                              datagen=instances[training["datagen"]],
+                              metrics=[instances[name] for name in training.get("metrics", [])],
+                              callbacks=[instances[name] for name in training.get("callbacks", [])],
+                              epochs=training.get("epochs", 1),
+                              steps_per_epoch=training.get("steps_per_epoch"),
+                              save_path=training.get("save_path"))
@@ -0,0 +1,100 @@
+"""Local multi-process clusters, to run distributed training on one machine."""
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import time
+from typing import Any, Callable, Optional
+
+
+def free_ports(n: int) -> list[int]:
+    """n currently free local TCP ports."""
+    sockets = []
+    try:
+        for _ in range(n):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.bind(("localhost", 0))
+            sockets.append(s)
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+
+def _run_worker(target: Callable[..., Any], args: tuple, config: dict[str, Any], threads: Optional[int], results: Any) -> None:
+    # TF_CONFIG has to be set before tensorflow creates the strategy
+    os.environ["TF_CONFIG"] = json.dumps(config)
+    if threads:
+        os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads)
+    try:
+        results.put((config["task"]["index"], target(*args), None))
+    except Exception as e:
+        results.put((config["task"]["index"], None, f"{type(e).__name__}: {e}"))
+
+
+def launch_local_workers(num_workers: int,
+                         target: Callable[..., Any],
+                         *args: Any,
+                         threads_per_worker: Optional[int] = None,
+                         timeout: Optional[float] = None) -> list[Any]:
+    """Run target(*args) in num_workers local processes forming a tf.distribute cluster.
+
+    target must be picklable (a module level function) and create the
+    strategy itself, e.g. through DistributedTrainer. Returns the results of
+    the workers in index order. Raises RuntimeError if any worker failed or
+    exited without reporting (the other workers are then terminated), and
+    TimeoutError if the workers did not finish within timeout seconds.
+    """
+    # local import, the training package imports tensorflow
+    from neurosegmenter.training.distributed import tf_config
+    workers = [f"localhost:{port}" for port in free_ports(num_workers)]
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [context.Process(target=_run_worker, args=(target, args, tf_config(workers, index), threads_per_worker, results))
+                 for index in range(num_workers)]
+    for process in processes:
+        process.start()
+    outputs: dict[int, Any] = {}
+    errors = []
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    try:
+        while len(outputs) < num_workers and not errors:
+            try:
+                index, output, error = results.get(timeout=1.0)
+            except queue.Empty:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(f"Workers {sorted(set(range(num_workers)) - set(outputs))} did not finish in {timeout}s")
+                errors.extend(_lost_workers(processes, outputs, results))
+                continue
+            outputs[index] = output
+            if error:
+                errors.append(f"worker {index}: {error}")
+    finally:
+        for process in processes:
+            # the other workers of a failed cluster may wait on it forever
+            process.join(timeout=1 if errors else None)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+    if errors:
+        raise RuntimeError("Distributed training failed:\n" + "\n".join(errors))
+    return [outputs[index] for index in range(num_workers)]
+
+
+def _lost_workers(processes: list[Any], outputs: dict[int, Any], results: Any) -> list[str]:
+    """Errors of the workers that exited without reporting a result (e.g. killed, or failing before the target ran)."""
+    exited = [index for index, process in enumerate(processes) if index not in outputs and process.exitcode is not None]
+    if not exited:
+        return []
+    # a worker that just exited may have reported right before, drain the queue first
+    try:
+        while True:
+            index, output, error = results.get(timeout=0.5)
+            outputs[index] = output
+            if error:
+                return [f"worker {index}: {error}"]
+    except queue.Empty:
+        pass
+    return [f"worker {index}: exited with code {processes[index].exitcode} without reporting"
+            for index in exited if index not in outputs]
@@ -0,0 +1,2 @@
+from neurosegmenter.volumes.volume import open_volume, create_volume, volume_signature, patch_grid, block_grid, read_patch
+from neurosegmenter.volumes.chunked import ChunkedVolume, downsample
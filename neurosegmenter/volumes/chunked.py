@@ -0,0 +1,286 @@
+"""Chunked on-disk volumes for predictions.
+
+A .chunks volume is a directory holding a volume.json with the metadata and
+one file per chunk, compressed independently, under a directory per pyramid
+level. Chunks are written to a temporary file and renamed into place, so
+threads and processes can write disjoint chunks concurrently without locks.
+
+- Chunks whose values are all fill_value are not stored (and read back as
+  fill_value).
+- Float volumes can be stored quantized to uint8 (values in [0, 1], e.g.
+  probabilities), they are read back as float32.
+- Pyramid level k is the volume downsampled by 2 ** k along the spatial axes,
+  with chunks 2 ** k times smaller: every chunk of level 0 maps to exactly one
+  chunk of every level, which is updated as soon as the level 0 chunk is
+  written.
+"""
+import bz2
+import json
+import lzma
+import os
+import shutil
+import threading
+import zlib
+from pathlib import Path
+from typing import Any, Iterator, Optional, Sequence, Union
+
+import numpy as np
+
+CHUNKED_VERSION = 1
+COMPRESSIONS = ("zlib", "lzma", "bz2", "none")
+DOWNSAMPLINGS = ("mean", "nearest")
+
+
+def _compress(data: bytes, compression: str, level: int) -> bytes:
+    if compression == "zlib":
+        return zlib.compress(data, level)
+    if compression == "lzma":
+        return lzma.compress(data, preset=level)
+    if compression == "bz2":
+        return bz2.compress(data, max(level, 1))
+    return data
+
+
+def _decompress(data: bytes, compression: str) -> bytes:
+    if compression == "zlib":
+        return zlib.decompress(data)
+    if compression == "lzma":
+        return lzma.decompress(data)
+    if compression == "bz2":
+        return bz2.decompress(data)
+    return data
+
+
+def downsample(block: np.ndarray, spatial_ndim: int, method: str = "mean") -> np.ndarray:
+    """Downsample the leading spatial axes of a block by 2, odd sizes are rounded up."""
+    if method == "nearest":
+        return block[tuple(slice(None, None, 2) for _ in range(spatial_ndim))]
+    padding = [(0, size % 2) for size in block.shape[:spatial_ndim]] + [(0, 0)] * (block.ndim - spatial_ndim)
+    block = np.pad(block.astype(np.float32, copy=False), padding, mode="edge")
+    pairs = []
+    for size in block.shape[:spatial_ndim]:
+        pairs.extend([size // 2, 2])
+    block = block.reshape(pairs + list(block.shape[spatial_ndim:]))
+    return block.mean(axis=tuple(range(1, 2 * spatial_ndim, 2)))
+
+
+class ChunkedVolume:
+    """Array-like chunked volume (a level of its pyramid), see the module docstring.
+
+    Supports numpy-style reads and writes of regions (slices with step 1 and
+    integers). Writes covering whole chunks do not read them, partial chunk
+    writes read, merge and rewrite the chunk: concurrent writers must write
+    disjoint chunks.
+    """
+
+    def __init__(self, path: Union[str, Path], mode: str = "r", level: int = 0) -> None:
+        self.path = Path(path)
+        self.mode = mode
+        with open(self.path / "volume.json") as f:
+            self.metadata = json.load(f)
+        if self.metadata["version"] != CHUNKED_VERSION:
+            raise ValueError(f"Unsupported chunked volume version {self.metadata['version']} in {self.path}")
+        if not 0 <= level < self.levels:
+            raise ValueError(f"{self.path} has {self.levels} pyramid levels, got level {level}")
+        self.level_index = level
+        self.spatial_ndim: int = self.metadata["spatial_ndim"]
+        factor = 2 ** level
+        base_shape, base_chunks = self.metadata["shape"], self.metadata["chunks"]
+        self.shape = tuple(-(-size // factor) if axis < self.spatial_ndim else size for axis, size in enumerate(base_shape))
+        self.chunks = tuple(size // factor if axis < self.spatial_ndim else size for axis, size in enumerate(base_chunks))
+        self.dtype = np.dtype(self.metadata["dtype"])
+        self.storage_dtype = np.dtype(np.uint8) if self.metadata["quantize"] else self.dtype
+        self.fill_value = self.metadata["fill_value"]
+
+    @classmethod
+    def create(cls,
+               path: Union[str, Path],
+               shape: Sequence[int],
+               dtype: Any,
+               chunks: Optional[Sequence[int]] = None,
+               compression: str = "zlib",
+               compression_level: int = 1,
+               quantize: bool = False,
+               fill_value: Union[int, float] = 0,
+               levels: int = 1,
+               downsampling: Optional[str] = None,
+               spatial_ndim: Optional[int] = None) -> "ChunkedVolume":
+        """Create an empty volume, replacing an existing one at path.
+
+        chunks: chunk shape, by default 64 voxels along the spatial axes and
+            the whole trailing axes.
+        quantize: store float values in [0, 1] as uint8.
+        levels: number of pyramid levels, including the full resolution,
+            the spatial chunk sizes must be divisible by 2 ** (levels - 1).
+        downsampling: 'mean' or 'nearest', by default 'mean' for floats and
+            'nearest' for integers (e.g. labels).
+        spatial_ndim: number of leading spatial axes, by default
+            min(len(shape), 3).
+        """
+        path = Path(path)
+        dtype = np.dtype(dtype)
+        spatial_ndim = min(len(shape), 3) if spatial_ndim is None else spatial_ndim
+        chunks = tuple(chunks or [64] * spatial_ndim + list(shape[spatial_ndim:]))
+        chunks = tuple(min(int(chunk), int(size)) for chunk, size in zip(chunks, shape))
+        downsampling = downsampling or ("mean" if dtype.kind == "f" else "nearest")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{compression}', expected one of {COMPRESSIONS}")
+        if downsampling not in DOWNSAMPLINGS:
+            raise ValueError(f"Unknown downsampling '{downsampling}', expected one of {DOWNSAMPLINGS}")
+        if quantize and dtype.kind != "f":
+            raise ValueError(f"Only float volumes can be quantized, got {dtype}")
+        if len(chunks) != len(shape):
+            raise ValueError(f"chunks {chunks} and shape {tuple(shape)} have different lengths")
+        if any(chunk % 2 ** (levels - 1) for chunk in chunks[:spatial_ndim]):
+            raise ValueError(f"Spatial chunk sizes {chunks[:spatial_ndim]} must be divisible by 2 ** (levels - 1) = {2 ** (levels - 1)}")
+        if (path / "volume.json").exists():
+            shutil.rmtree(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for level in range(levels):
+            (path / str(level)).mkdir(exist_ok=True)
+        metadata = {
+            "version": CHUNKED_VERSION,
+            "shape": [int(size) for size in shape],
+            "dtype": dtype.str,
+            "chunks": [int(chunk) for chunk in chunks],
+            "compression": compression,
+            "compression_level": compression_level,
+            "quantize": quantize,
+            "fill_value": fill_value,
+            "levels": levels,
+            "downsampling": downsampling,
+            "spatial_ndim": spatial_ndim,
+        }
+        with open(path / "volume.json", "w") as f:
+            json.dump(metadata, f)
+        return cls(path, mode="r+")
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def levels(self) -> int:
+        return self.metadata["levels"]
+
+    def level(self, level: int) -> "ChunkedVolume":
+        """A level of the pyramid, read only."""
+        return ChunkedVolume(self.path, mode="r", level=level)
+
+    def __array__(self, dtype: Any = None) -> np.ndarray:
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def __repr__(self) -> str:
+        return f"ChunkedVolume({str(self.path)!r}, shape={self.shape}, dtype={self.dtype}, chunks={self.chunks}, level={self.level_index})"
+
+    def chunk_grid(self) -> Iterator[tuple[int, ...]]:
+        """Indices of all the chunks."""
+        return np.ndindex(*[-(-size // chunk) for size, chunk in zip(self.shape, self.chunks)])
+
+    def chunk_region(self, index: Sequence[int]) -> tuple[slice, ...]:
+        return tuple(slice(i * chunk, min((i + 1) * chunk, size)) for i, chunk, size in zip(index, self.chunks, self.shape))
+
+    def _chunk_path(self, index: Sequence[int], level: Optional[int] = None) -> Path:
+        level = self.level_index if level is None else level
+        return self.path / str(level) / ".".join(str(i) for i in index)
+
+    def stored_chunks(self) -> int:
+        """Number of chunks stored, the others are empty."""
+        return sum(1 for file in (self.path / str(self.level_index)).iterdir() if not file.name.startswith("."))
+
+    def read_chunk(self, index: Sequence[int]) -> np.ndarray:
+        region = self.chunk_region(index)
+        shape = tuple(s.stop - s.start for s in region)
+        try:
+            data = self._chunk_path(index).read_bytes()
+        except FileNotFoundError:
+            return np.full(shape, self.fill_value, dtype=self.dtype)
+        chunk = np.frombuffer(_decompress(data, self.metadata["compression"]), dtype=self.storage_dtype).reshape(shape)
+        if self.metadata["quantize"]:
+            return (chunk.astype(np.float32) / 255).astype(self.dtype, copy=False)
+        return chunk.copy()
+
+    def _store_chunk(self, index: Sequence[int], level: int, chunk: np.ndarray) -> None:
+        path = self._chunk_path(index, level)
+        if self.metadata["quantize"]:
+            chunk = np.round(np.clip(chunk, 0, 1) * 255).astype(np.uint8)
+            empty = not np.any(chunk != np.round(np.clip(self.fill_value, 0, 1) * 255))
+        else:
+            chunk = np.ascontiguousarray(chunk, dtype=self.storage_dtype)
+            empty = not np.any(chunk != self.fill_value)
+        if empty:
+            path.unlink(missing_ok=True)
+            return
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(_compress(chunk.tobytes(), self.metadata["compression"], self.metadata["compression_level"]))
+        os.replace(tmp_path, path)
+
+    def write_chunk(self, index: Sequence[int], chunk: np.ndarray) -> None:
+        """Write a whole chunk and update the corresponding chunks of the pyramid."""
+        if self.mode == "r":
+            raise ValueError(f"{self.path} is opened read only")
+        if self.level_index:
+            raise ValueError("Pyramid levels are computed from level 0, they cannot be written")
+        chunk = np.asarray(chunk)
+        for level in range(self.levels):
+            if level:
+                chunk = downsample(chunk, self.spatial_ndim, self.metadata["downsampling"])
+            self._store_chunk(index, level, chunk)
+
+    def _region(self, key: Any) -> tuple[tuple[slice, ...], tuple[int, ...]]:
+        """Normalized slices of a numpy-style key and the axes indexed by integers."""
+        key = key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis for k in key):
+            i = next(i for i, k in enumerate(key) if k is Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        region, squeezed = [], []
+        for axis, (k, size) in enumerate(zip(key, self.shape)):
+            if isinstance(k, (int, np.integer)):
+                k = int(k) + size if k < 0 else int(k)
+                if not 0 <= k < size:
+                    raise IndexError(f"index {k} is out of bounds for axis {axis} with size {size}")
+                region.append(slice(k, k + 1))
+                squeezed.append(axis)
+                continue
+            start, stop, step = k.indices(size)
+            if step != 1:
+                raise ValueError("Chunked volumes only support slices with step 1")
+            region.append(slice(start, max(start, stop)))
+        return tuple(region), tuple(squeezed)
+
+    def _chunks_in(self, region: tuple[slice, ...]) -> Iterator[tuple[tuple[int, ...], tuple[slice, ...], tuple[slice, ...]]]:
+        """Chunks intersecting a region, with the intersection in chunk and in region coordinates."""
+        ranges = [range(s.start // chunk, -(-s.stop // chunk)) for s, chunk in zip(region, self.chunks)]
+        for index in np.ndindex(*[len(r) for r in ranges]):
+            index = tuple(r[i] for r, i in zip(ranges, index))
+            chunk_region = self.chunk_region(index)
+            overlap = [slice(max(s.start, c.start), min(s.stop, c.stop)) for s, c in zip(region, chunk_region)]
+            yield (index,
+                   tuple(slice(o.start - c.start, o.stop - c.start) for o, c in zip(overlap, chunk_region)),
+                   tuple(slice(o.start - s.start, o.stop - s.start) for o, s in zip(overlap, region)))
+
+    def __getitem__(self, key: Any) -> np.ndarray:
+        region, squeezed = self._region(key)
+        output = np.full(tuple(s.stop - s.start for s in region), self.fill_value, dtype=self.dtype)
+        if output.size:
+            for index, in_chunk, in_region in self._chunks_in(region):
+                output[in_region] = self.read_chunk(index)[in_chunk]
+        return output.squeeze(axis=squeezed) if squeezed else output
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        region, squeezed = self._region(key)
+        shape = tuple(s.stop - s.start for s in region)
+        value = np.asarray(value, dtype=self.dtype)
+        value = np.broadcast_to(np.expand_dims(value, squeezed) if squeezed and value.ndim == len(shape) - len(squeezed) else value, shape)
+        if not value.size:
+            return
+        for index, in_chunk, in_region in self._chunks_in(region):
+            chunk_shape = tuple(s.stop - s.start for s in self.chunk_region(index))
+            if all(s.stop - s.start == size for s, size in zip(in_chunk, chunk_shape)):
+                chunk = value[in_region]
+            else:
+                chunk = self.read_chunk(index)
+                chunk[in_chunk] = value[in_region]
+            self.write_chunk(index, chunk)
@@ -0,0 +1,107 @@
+"""On-disk volume helpers.
+
+Volumes are opened without loading them in memory: .npy files are memory
+mapped, chunked array stores (.zarr) are opened through zarr, which is an
+optional dependency, .chunks volumes (see chunked.py) are read and written
+chunk by chunk.
+"""
+import itertools
+from pathlib import Path
+from typing import Any, Optional, Sequence, Union
+
+import numpy as np
+
+from neurosegmenter.volumes.chunked import ChunkedVolume
+
+PathLike = Union[str, Path]
+
+def _import_zarr() -> Any:
+    try:
+        import zarr
+    except ImportError as e:
+        raise ImportError("zarr is required to read and write chunked array stores, install it with `pip install zarr`") from e
+    return zarr
+
+def is_chunked_store(path: PathLike) -> bool:
+    return Path(path).suffix == ".zarr"
+
+def open_volume(path: PathLike, mode: str = "r") -> Any:
+    """Open an on-disk volume as an array-like object supporting slicing."""
+    path = Path(path)
+    if path.suffix == ".npy":
+        return np.load(path, mmap_mode=mode) # type: ignore
+    if is_chunked_store(path):
+        return _import_zarr().open(str(path), mode=mode)
+    if path.suffix == ".chunks":
+        return ChunkedVolume(path, mode=mode)
+    raise ValueError(f"Unsupported volume format: {path}, expected a .npy file, a .zarr store or a .chunks volume")
+
+def create_volume(path: PathLike,
+                  shape: Sequence[int],
+                  dtype: Any,
+                  chunks: Optional[Sequence[int]] = None,
+                  **options: Any) -> Any:
+    """Create an on-disk volume, a memory mapped .npy file, a chunked .zarr store or a .chunks volume.
+
+    options are passed to ChunkedVolume.create() (compression, quantization, pyramid levels...).
+    """
+    path = Path(path)
+    if path.suffix == ".npy":
+        return np.lib.format.open_memmap(path, mode="w+", shape=tuple(shape), dtype=dtype)
+    if is_chunked_store(path):
+        return _import_zarr().open(str(path), mode="w", shape=tuple(shape), chunks=chunks, dtype=dtype)
+    if path.suffix == ".chunks":
+        return ChunkedVolume.create(path, shape, dtype, chunks=chunks, **options)
+    raise ValueError(f"Unsupported volume format: {path}, expected a .npy file, a .zarr store or a .chunks volume")
+
+def volume_signature(path: PathLike) -> dict[str, int]:
+    """Modification time and size of a volume, used to invalidate data derived from it.
+    
+    For chunked stores (directories) the latest modification time and the
+    total size of the files in the store are used.
+    """
+    path = Path(path)
+    if path.is_dir():
+        stats = [file.stat() for file in path.rglob("*") if file.is_file()]
+        return {"mtime_ns": max((stat.st_mtime_ns for stat in stats), default=0),
+                "size": sum(stat.st_size for stat in stats)}
+    stat = path.stat()
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+def patch_grid(shape: Sequence[int],
+               patch_shape: Sequence[int],
+               stride: Optional[Sequence[int]] = None) -> np.ndarray:
+    """Corners of a regular grid of patches covering the whole volume.
+    
+    The last patch along each axis is shifted back to end at the volume
+    border, so every voxel is covered and no patch crosses the border
+    (unless the volume is smaller than the patch).
+    """
+    stride = patch_shape if stride is None else stride
+    axes = []
+    for size, patch_size, step in zip(shape, patch_shape, stride):
+        last = max(size - patch_size, 0)
+        starts = list(range(0, last + 1, step))
+        if starts[-1] != last:
+            starts.append(last)
+        axes.append(starts)
+    return np.array(list(itertools.product(*axes)), dtype=np.int64).reshape(-1, len(shape))
+
+def block_grid(shape: Sequence[int], block_shape: Sequence[int]) -> list[tuple[slice, ...]]:
+    """Disjoint blocks tiling the volume, the last block along each axis is cropped at the border."""
+    axes = [[slice(start, min(start + size, limit)) for start in range(0, limit, size)]
+            for limit, size in zip(shape, block_shape)]
+    return list(itertools.product(*axes))
+
+def read_patch(volume: Any, corner: Sequence[int], patch_shape: Sequence[int]) -> np.ndarray:
+    """Read a patch from a volume, zero padding the parts outside of it.
+    
+    Only the leading len(patch_shape) axes are patched, trailing axes
+    (e.g. channels) are read whole.
+    """
+    slices = tuple(slice(int(start), int(start) + size) for start, size in zip(corner, patch_shape))
+    patch = np.asarray(volume[slices])
+    missing = [(0, size - actual) for size, actual in zip(patch_shape, patch.shape)]
+    if any(after for _, after in missing):
+        patch = np.pad(patch, missing + [(0, 0)] * (patch.ndim - len(patch_shape)))
+    return patch
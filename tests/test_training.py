@@ -0,0 +1,95 @@
+from typing import Optional
+
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow import keras
+
+from neurosegmenter.plugins import PluginType, discover_plugins, get_plugin, registered_plugins
+from neurosegmenter.training.distributed import DistributedTrainer, get_strategy
+
+
+class TinyModel:
+    """Model plugin of a single convolution, segmentation shaped outputs."""
+    name = "Tiny Model"
+    type = PluginType.MODEL
+    parameters: list = []
+
+    def get_model(self) -> keras.Model:
+        inputs = keras.Input((8, 8, 1))
+        outputs = keras.layers.Conv2D(1, 3, padding="same", activation="sigmoid")(inputs)
+        return keras.Model(inputs, outputs)
+
+
+class ArrayDatagen:
+    """Datagen of random (x, y) patches, or (x, y, w) with constant weight maps, sharded like the datagen plugins."""
+    batch_size = 4
+    samples_per_epoch = 8
+    num_shards = 1
+    shard_index = 0
+
+    def __init__(self, weight: Optional[float] = None) -> None:
+        self.weight = weight
+
+    def get_dataset(self) -> tf.data.Dataset:
+        rng = np.random.default_rng(0)
+        x = rng.random((self.samples_per_epoch, 8, 8, 1), dtype=np.float32)
+        y = (rng.random((self.samples_per_epoch, 8, 8, 1)) > 0.5).astype(np.float32)
+        elements = (x, y) if self.weight is None else (x, y, np.full_like(y, self.weight))
+        return tf.data.Dataset.from_tensor_slices(elements).shard(self.num_shards, self.shard_index).batch(self.batch_size)
+
+
+def loss_plugin_names() -> list[str]:
+    discover_plugins()
+    return sorted(name for name, plugin in registered_plugins.items() if plugin.type == PluginType.LOSS)
+
+
+@pytest.fixture(scope="module")
+def strategy() -> tf.distribute.Strategy:
+    # a single worker cluster, a strategy can only be created once per process
+    return get_strategy()
+
+
+@pytest.mark.parametrize("loss_name", loss_plugin_names())
+def test_trainer_fits_with_every_loss(strategy: tf.distribute.Strategy, loss_name: str) -> None:
+    trainer = DistributedTrainer(model=TinyModel(),
+                                 optimizer=get_plugin("Adam Optimizer")(),
+                                 loss=get_plugin(loss_name)(),
+                                 datagen=ArrayDatagen(),
+                                 epochs=1,
+                                 steps_per_epoch=2,
+                                 strategy=strategy)
+    history = trainer.fit()
+    assert np.isfinite(history.history["loss"][-1])
+
+
+@pytest.mark.parametrize("weight", [0.0, 1.0])
+def test_trainer_applies_weight_maps(strategy: tf.distribute.Strategy, weight: float) -> None:
+    trainer = DistributedTrainer(model=TinyModel(),
+                                 optimizer=get_plugin("Adam Optimizer")(),
+                                 loss=get_plugin("Weighted Binary Cross Entropy Loss")(),
+                                 datagen=ArrayDatagen(weight=weight),
+                                 epochs=1,
+                                 steps_per_epoch=2,
+                                 strategy=strategy)
+    loss = trainer.fit().history["loss"][-1]
+    # the weights reach the loss voxel by voxel, zero weights zero the loss
+    if weight == 0.0:
+        assert loss == 0.0
+    else:
+        assert np.isfinite(loss) and loss > 0.0
+
+
+def test_trainer_streams_metrics(strategy: tf.distribute.Strategy) -> None:
+    trainer = DistributedTrainer(model=TinyModel(),
+                                 optimizer=get_plugin("Adam Optimizer")(),
+                                 loss=get_plugin("Binary Cross Entropy Loss")(),
+                                 datagen=ArrayDatagen(),
+                                 metrics=[get_plugin("Streaming Dice Coefficient")(), get_plugin("Streaming Jaccard Index")()],
+                                 epochs=1,
+                                 steps_per_epoch=2,
+                                 strategy=strategy)
+    history = trainer.fit().history
+    # the counters accumulate in the graph, one score over the whole epoch
+    dice, jaccard = history["streaming_dice_coefficient"][-1], history["streaming_jaccard_index"][-1]
+    assert 0.0 <= jaccard <= dice <= 1.0